@@ -116,7 +116,8 @@ completion and then the next division is loaded.
 The :attr:`Simulation.n_realizations_per_division_max` attribute controls the
 number of realizations per division. The final division may contain fewer than 
 this many realizations if the number of realizations is not divisible by this
-quantity. 
+quantity. Setting it to ``"auto"`` chooses the largest division which fits in
+device memory (see :meth:`Simulation.fit_division_size`).
 
 cl_egans?
 *********
@@ -137,15 +138,44 @@ API
 ***
 
 """
+import os
+import sys
+import collections
+import json
+import struct
+import hashlib
 import numpy
 import cypy as py
 import cypy.cg as cg
-import clq
-import clq.stdlib as clqstd
 import clq.backends.opencl as clqcl
-import clq.backends.opencl.pyocl as cl 
-
-OpenCL = clqcl.Backend()
+import cl_egans.optimize
+import cl_egans.pool
+
+class _LazyModule(object):
+    # Stands in for a module, importing it on first attribute access, so that
+    # specifying, finalizing and generating code for a simulation does not 
+    # load the OpenCL runtime.
+    def __init__(self, name):
+        self._name = name
+        
+    def __getattr__(self, attr):
+        module = self.__dict__.get('_module')
+        if module is None:
+            __import__(self._name)
+            module = self._module = sys.modules[self._name]
+        return getattr(module, attr)
+    
+clq = _LazyModule("clq")
+clqstd = _LazyModule("clq.stdlib")
+cl = _LazyModule("clq.backends.opencl.pyocl")
+
+def opencl_backend():
+    """Returns the cl.oquence OpenCL backend, creating it on first use."""
+    global _opencl_backend
+    if _opencl_backend is None:
+        _opencl_backend = clqcl.Backend()
+    return _opencl_backend
+_opencl_backend = None
 
 class Error(Exception):
     """Base class for errors in pyocl_egans."""
@@ -168,9 +198,39 @@ class Node(cg.Node):
         """
         return self.getrec('model', False)
     
+    vectorizable = False
+    """Whether the code this node inserts into its model's step code is valid
+    when the model's state variables are vectors. Models are only vectorized 
+    (see :data:`Simulation.vector_width`) if every node in them is."""
+
+    def pre_finalize_added(self, node):
+        """Triggers the "pre_finalize" hook of ``node``, which this node's
+        ``pre_finalize`` added to the tree, if the finalize hook has already
+        walked past the place it was added at and so would skip it.
+
+        Nodes added under this node or one of its ancestors are reached by the
+        walk, but not those added under a node which comes earlier in the tree,
+        like a model built before this node's model.
+        """
+        parent = node.parent
+        ancestors = [ ]
+        ancestor = self
+        while ancestor is not None:
+            ancestors.append(ancestor)
+            ancestor = ancestor.parent
+        if any(parent is ancestor for ancestor in ancestors):
+            return
+        for visited in self.sim._iter_nodes():
+            if visited is self:
+                return # comes later, so it will be walked
+            if visited is parent:
+                break
+        node.trigger_hook("pre_finalize")
+
 class StandaloneCode(cg.StandaloneCode, Node):
     """A cl_egans StandaloneCode node. See the 
     `base class <cypy.cg.StandaloneCode>`_."""
+    vectorizable = True # the calculations of a State are elementwise
 
 class Simulation(Node):
     """The root node of a Simulation tree.
@@ -185,16 +245,19 @@ class Simulation(Node):
     
     4. Runtime (:meth:`run`)
     
-    5. Memory deallocation (:meth:`release`)
+    5. Memory deallocation (:meth:`release`). If :data:`buffer_pool` is set, 
+       :class:`Allocation` buffers are returned to it for reuse instead.
     
     """
     @py.autoinit
-    def __init__(self, ctx, #@UnusedVariable
+    def __init__(self, ctx=None, #@UnusedVariable
                  
                  n_realizations=1, #@UnusedVariable
                  n_realizations_per_division_max=1, #@UnusedVariable
                  DT=0.1, #@UnusedVariable,
                  n_timesteps=10000,  #@UnusedVariable
+                 n_burn_in_timesteps=0, #@UnusedVariable
+                 integrator="euler", #@UnusedVariable
                  
                  # Sets it up as root:
                  parent=None, #@UnusedVariable
@@ -212,36 +275,90 @@ class Simulation(Node):
         """The :class:`pyocl.Context` to bind this simulation to.
         
         If not provided during initialization, defaults to the process-wide
-        context, :data:`pyocl.ctx`.
+        context, :data:`pyocl.ctx`, which is looked up on first use so 
+        specifying, finalizing and generating code does not need an OpenCL 
+        runtime.
         """
-        return self._ctx
+        ctx = self._ctx
+        if ctx is None or ctx is py.Default:
+            ctx = self._ctx = cl.ctx
+        return ctx
     
     @ctx.setter
     def ctx(self, value): #@DuplicatedSignature
-        if value is py.Default:
-            value = cl.ctx
         self._ctx = value
         
     @property
     def Naming_prefix(self):
         # so Simulation_ is not added to all variables.
-        return ""   
+        return self.name_prefix
+    
+    name_prefix = ""
+    """A prefix for the names of all nodes in the tree, and so of the 
+    constants and allocations in the generated code. Simulations packed into 
+    one kernel by a :class:`cl_egans.group.SimulationGroup` need distinct 
+    prefixes."""
+    
+    simulation_group = None
+    """The :class:`cl_egans.group.SimulationGroup` this simulation is packed 
+    into, if any. Set by the group."""
     
     DT = None
-    """DT for Euler integration."""
+    """The integration timestep."""
+    
+    integrator = "euler"
+    """The default integration scheme for state variables. 
+    
+    Either ``"euler"`` (forward Euler) or ``"exact"`` (precomputed exponential
+    propagators for linear dynamics, exponential Euler for conductance-based 
+    voltage updates). Nodes look this up recursively, so it can be overridden 
+    on any model, synapse or state by setting an ``integrator`` attribute 
+    there.
+    """
     
     t = "DT*timestep"
     """Expression for calculating t based on DT and the current timestep."""
     
     n_timesteps = None
     """The total number of timesteps the simulation will run."""
+    
+    n_burn_in_timesteps = 0
+    """The number of initial timesteps which are run only once, for a single 
+    realization, before its state is copied into every realization.
+    
+    See :meth:`run`. Probes start recording after the burn-in by default.
+    """
+    
+    termination_check_interval = 100
+    """The number of timesteps between polls of the :class:`TerminationCondition`
+    flags. See :meth:`run`."""
 
     ## element counts relative to various things
     n_realizations = 1
     """The number of realizations of the simulation to run."""
 
     n_realizations_per_division_max = 1
-    """The maximum number of realizations per division."""
+    """The maximum number of realizations per division. 
+    
+    If ``"auto"``, :meth:`finalize` chooses the largest number which fits in
+    device memory. See :meth:`fit_division_size`.
+    """
+    
+    memory_headroom = 0.9
+    """The fraction of the device's global memory which automatic division 
+    sizing may use."""
+    
+    vector_width = 1
+    """The number of consecutive elements of a model each work item updates 
+    together, one of 1, 2, 4, 8 or 16.
+    
+    If greater than 1, each work item loops over batches of ``vector_width`` 
+    elements. Models whose nodes are all ``vectorizable`` update full batches
+    using OpenCL vector types (e.g. ``float4``) and ``select`` instead of 
+    branches, which CPU devices map onto their SIMD units. The last, partial 
+    batch of a model and all of the batches of other models are updated one 
+    element at a time by the scalar code. See :meth:`Model.generate_batch`.
+    """
     
     ############################################################################
     # Specification
@@ -308,6 +425,33 @@ class Simulation(Node):
         return self.n_elms_per_realization * \
                self.n_realizations_per_division_max
 
+    @property
+    def n_batches_per_realization(self):
+        """The number of batches of :data:`vector_width` elements per 
+        realization. Each model's elements start a new batch."""
+        return sum(model.n_batches for model in self.models)
+    
+    @property
+    def n_batches_per_sim(self):
+        """The number of batches the entire simulation is managing."""
+        return self.n_batches_per_realization * self.n_realizations
+    
+    @property
+    def n_batches_per_division_max(self):
+        """The maximum number of batches per division."""
+        return self.n_batches_per_realization * \
+               self.n_realizations_per_division_max
+    
+    @property
+    def model_batch_offsets_map(self):
+        """A map from models to the index of their first batch."""
+        offsets = { }
+        offset = 0
+        for model in self.models:
+            offsets[model] = offset
+            offset += model.n_batches
+        return offsets
+    
     @property
     def n_divisions(self):
         """Returns the number of divisions.
@@ -344,19 +488,116 @@ class Simulation(Node):
         every subsequent time.
         """
         if not self.finalized:
+            if self.n_realizations_per_division_max == "auto":
+                self.n_realizations_per_division_max = \
+                    self.fit_division_size()
             self.trigger_staged_hook('finalize')
             self._finalized = True
             
+    def fit_division_size(self):
+        """Returns the largest number of realizations per division whose memory
+        fits on the device.
+        
+        The fixed and per-realization memory cost of every :class:`MemoryNode`
+        is measured by finalizing the tree for one and for two realizations per
+        division, restoring it to its unfinalized state after each. The total 
+        must fit in :data:`memory_headroom` of ``ctx.device.global_mem_size``
+        and each buffer in ``ctx.device.max_mem_alloc_size``. 
+        
+        Raises an :class:`Error` if not even a single realization fits.
+        """
+        if self.finalized:
+            raise Error("Cannot measure the memory of a finalized simulation.")
+        n_realizations = self.n_realizations
+        one = self._trial_nbytes(1)
+        two = one if n_realizations == 1 else self._trial_nbytes(2)
+        
+        device = self.ctx.device
+        limits = [(int(device.global_mem_size * self.memory_headroom),
+                   sum(one.itervalues()), sum(two.itervalues()))]
+        max_mem_alloc_size = device.max_mem_alloc_size
+        for name, nbytes in one.iteritems():
+            limits.append((max_mem_alloc_size, nbytes, two[name]))
+            
+        n_fit = n_realizations
+        for limit, nbytes_one, nbytes_two in limits:
+            per_realization = nbytes_two - nbytes_one
+            fixed = nbytes_one - per_realization
+            if nbytes_one > limit:
+                raise Error("A single realization needs %d bytes of the %d "
+                            "available." % (nbytes_one, limit))
+            if per_realization > 0:
+                n_fit = min(n_fit, (limit - fixed) // per_realization)
+        return int(n_fit)
+    
+    def _trial_nbytes(self, n_realizations_per_division_max):
+        # Finalizes the tree with the given division size, measures the size
+        # of every MemoryNode, then restores every node's state. Mutable 
+        # containers are copied one level deep, which covers the children 
+        # lists, naming counts and constants that finalization changes.
+        snapshot = [(node, dict((key, _shallow_copy(value)) 
+                                for key, value in node.__dict__.iteritems()))
+                    for node in self._iter_nodes()]
+        try:
+            self.n_realizations_per_division_max = \
+                n_realizations_per_division_max
+            self.trigger_staged_hook('finalize')
+            return dict((node.name, node.nbytes) 
+                        for node in self._iter_nodes() 
+                        if isinstance(node, MemoryNode))
+        finally:
+            for node, state in snapshot:
+                node.__dict__.clear()
+                node.__dict__.update(state)
+                
+    def _iter_nodes(self, node=None):
+        if node is None:
+            node = self
+        yield node
+        for child in getattr(node, 'children', None) or ():
+            for descendant in self._iter_nodes(child):
+                yield descendant
+            
     @staticmethod
     def _assert(guard):
         if not guard:
             raise Error("Assertion failed, cannot continue.")
 
+    def pre_finalize(self):
+        if self.vector_width not in (1, 2, 4, 8, 16):
+            raise Error("vector_width must be 1, 2, 4, 8 or 16.")
+        if self.vector_width > 1:
+            self.vector_zeros
+            
+    @py.lazy(property)
+    def vector_zeros(self):
+        """A :class:`ConstantArray` of :data:`vector_width` zeros, loaded into 
+        ``vector_zero`` to widen scalars in vector code."""
+        return ConstantArray(self, "vector_zeros", 
+                             numpy.zeros(self.vector_width, numpy.float32))
+    
+    @property
+    def vload(self):
+        return "vload%d" % self.vector_width
+    
+    @property
+    def vstore(self):
+        return "vstore%d" % self.vector_width
+    
+    @property
+    def convert_float(self):
+        return "convert_float%d" % self.vector_width
+    
+    @property
+    def convert_int(self):
+        return "convert_int%d" % self.vector_width
+        
     def post_finalize(self):
         # Assertions that should hold for all specifications.
         self._assert(self.n_realizations > 0)
         self._assert(self.n_realizations_per_division_max > 0)
         self._assert(self.n_realizations_per_division_max <= self.n_realizations)
+        self._assert(0 <= self.n_burn_in_timesteps < self.n_timesteps)
         
     @property
     def finalized(self):
@@ -413,7 +654,15 @@ class Simulation(Node):
         else:
             raise Error("Memory was not allocated.")
         
+    buffer_pool = None
+    """A :class:`cl_egans.pool.BufferPool` which :class:`Allocation` buffers 
+    are drawn from and returned to on release, or None to allocate and release
+    them directly."""
+        
     def on_release(self):
+        if self.buffer_pool is not None:
+            return # each MemoryNode releases its own buffer
+        
         # Goes through the list of constants and releases all buffer constants.        
         for constant in self.constants:
             if isinstance(constant, cl.Buffer):
@@ -433,46 +682,98 @@ class Simulation(Node):
         Triggers the "step_kernel" generation hook.
         
         After generation, the ``code`` attribute contains the cl.oquence code 
-        produced. This is also returned.
+        produced. This is also returned. If :data:`optimize_code` is set, the 
+        code is passed through :func:`cl_egans.optimize.optimize` first and the
+        code as produced by the hooks is kept in ``unoptimized_code``.
         """
+        if not self.finalized:
+            self.finalize()
+            
         g = self._make_code_generator()
         self.trigger_staged_cg_hook("step_kernel", g)
-        code = self.code = g.code
+        code = self.unoptimized_code = g.code
+        if self.optimize_code:
+            code = cl_egans.optimize.optimize(code)
+        self.code = code
         self._generated = True
         return code
+    
+    optimize_code = True
+    """Whether to fold constants and eliminate common subexpressions in the 
+    generated code. See :mod:`cl_egans.optimize`."""
 
-    @py.lazy(property)
-    def _step_fn_even(self):
+    @property
+    def code_hash(self):
+        """A SHA-1 hex digest of the generated code. Simulations with equal 
+        hashes share the same step function. Generates the code if needed."""
         if not self.generated:
             self.generate()
+        return hashlib.sha1(self.code).hexdigest()
+
+    @py.lazy(property)
+    def _step_fn_even(self):
         self.trigger_staged_hook("prepare_step_fn_even")        
-        generic_fn = clq.from_source(self.code)
+        generic_fn = self._generic_step_fn
         
-        concrete_fn_args = [OpenCL,
+        concrete_fn_args = [opencl_backend(),
             clqcl.int,
             clqcl.int]
         for constant in self.constants.itervalues():
             concrete_fn_args.append(constant.cl_type)
-            
-        concrete_fn = generic_fn.compile(*concrete_fn_args)
-        return concrete_fn
+        
+        key = (self.code_hash, tuple(concrete_fn_args))
+        return Simulation._cached_step_fn(
+            Simulation._concrete_step_fn_cache, key, 
+            lambda: generic_fn.compile(*concrete_fn_args))
         
     @py.lazy(property)
     def _step_fn_odd(self):
-        if not self.generated:
-            self.generate()
         self.trigger_staged_hook("prepare_step_fn_odd")
-        return clq.from_source(self.code)
+        return self._generic_step_fn
+    
+    @property
+    def _generic_step_fn(self):
+        return Simulation._cached_step_fn(
+            Simulation._generic_step_fn_cache, self.code_hash, 
+            lambda: clq.from_source(self.code))
+    
+    @staticmethod
+    def _cached_step_fn(cache, key, make):
+        fn = cache.pop(key, None)
+        if fn is None:
+            fn = make()
+        cache[key] = fn # most recently used last
+        while len(cache) > Simulation.step_fn_cache_size:
+            cache.popitem(last=False)
+        return fn
+    
+    _generic_step_fn_cache = collections.OrderedDict()
+    _concrete_step_fn_cache = collections.OrderedDict()
+    # Step functions are shared by every simulation in the process with the 
+    # same code, so e.g. a batch of identical simulations compiles only once.
+    
+    step_fn_cache_size = 16
+    """The number of generic and of compiled step functions kept for reuse by
+    later simulations. The least recently used are dropped beyond this, so a
+    long-running process does not hold on to every program it has built."""
     
     @property
     def n_work_items(self):
-        return min(int(py.ceil_int(self.n_elms_per_sim / 256.0)*256), 
+        if self.simulation_group is not None:
+            # every member is run by all of the group's work items
+            return self.simulation_group.n_work_items
+        # one work item per batch, which is one element unless vectorized
+        return min(int(py.ceil_int(self.n_batches_per_sim / 256.0)*256), 
                             self.ctx.device.max_work_items)
         
     @property
     def n_work_items_per_work_group(self):
         return 256
     
+    @property
+    def n_work_groups(self):
+        return self.n_work_items / self.n_work_items_per_work_group
+    
     @property
     def _size_calculator(self):
         # round to nearest multiple of 256        
@@ -486,21 +787,30 @@ class Simulation(Node):
         return getattr(self, "_generated", False)
         
     def in_step_kernel(self, g):
+        self._add_builtin_constants()
+        
+        "def step_fn(" >> g
+        py.join(py.cons(("timestep", "realization_start"), 
+                         self.constants.iterkeys()), 
+                  ",\n            ") >> g
+        ("):\n", g.tab) >> g
+        self.trigger_staged_cg_hook("step_kernel_body", g)
+        
+    def _add_builtin_constants(self):
         # TODO: Get rid of these once globals work
         constants = self.constants
         constants['get_global_id'] = clqcl.get_global_id
         constants['get_global_size'] = clqcl.get_global_size
         constants['min'] = clqcl.min
+        constants['max'] = clqcl.max
         constants['atom_add'] = clqcl.atom_add
         constants['atom_inc'] = clqcl.atom_inc 
         constants['log'] = clqcl.log
-        
-        "def step_fn(" >> g
-        py.join(py.cons(("timestep", "realization_start"), 
-                         self.constants.iterkeys()), 
-                  ",\n            ") >> g
-        ("):\n", g.tab) >> g
-        self.trigger_staged_cg_hook("step_kernel_body", g)
+        constants['exp'] = clqcl.exp
+        if self.vector_width > 1:
+            for name in (self.vload, self.vstore, self.convert_float, 
+                         self.convert_int, 'select', 'any'):
+                constants[name] = getattr(clqcl, name)
         
     def in_step_kernel_body(self, g):
         self.trigger_staged_cg_hook("thread_idx_calculations", g)
@@ -511,8 +821,15 @@ class Simulation(Node):
         gid = get_global_id(0)
         gsize = get_global_size(0)
         """ << g
+        if self.vector_width > 1:
+            """
+            vector_zero = vload(0, vector_zeros)
+            """ << g
         
     def in_main_loop(self, g):
+        if self.vector_width > 1:
+            self._generate_batch_loop(g)
+            return
         """
         first_idx_sim = realization_start * n_elms_per_realization
         last_idx_sim = min(first_idx_sim + n_elms_per_division_max, n_elms_per_sim)
@@ -520,6 +837,26 @@ class Simulation(Node):
         """ << g
         g.append(g.tab)
         self.trigger_staged_cg_hook('loop_body', g)
+        g.append((g.untab, "\n"))
+        
+    def _generate_batch_loop(self, g):
+        """
+        first_idx_sim = realization_start * n_elms_per_realization
+        first_batch = realization_start * n_batches_per_realization
+        last_batch = min(first_batch + n_batches_per_division_max, n_batches_per_sim)
+        for idx_batch in (first_batch + gid, last_batch, gsize):
+            realization_num = idx_batch / n_batches_per_realization
+            idx_batch_realization = idx_batch - realization_num * n_batches_per_realization
+        """ << g
+        g.append(g.tab)
+        p = cg.Partitioner(g.append, "idx_batch_realization", min_start=0, 
+                           max_end=self.n_batches_per_realization)
+        batch_offsets = self.model_batch_offsets_map
+        for model in self.models:
+            batch_offset = batch_offsets[model]
+            p.next(start=batch_offset, end=batch_offset + model.n_batches,
+                   code=model.generate_batch)
+        g.append((g.untab, "\n"))
         
     def in_loop_body(self, g):
         self.trigger_staged_cg_hook("element_idx_calculations", g)
@@ -560,30 +897,72 @@ class Simulation(Node):
         5. After the simulation is complete and the Context's queue is flushed,
            the "on_run_complete" hook is triggered with the :class:`RunInfo`
            instance.
+           
+        If :data:`n_burn_in_timesteps` is non-zero, before the first division
+        the memory is initialized for a single realization and it alone is run 
+        for that many timesteps, triggering the "on_burn_in_timestep_complete"
+        hook with a :class:`TimestepInfo` after each (but not 
+        "on_timestep_complete", so probes do not record the burn-in.) The 
+        "on_capture_warm_state" hook is then 
+        triggered with a :class:`WarmState`, into which nodes copy their 
+        per-realization state. After each division is initialized, the 
+        "on_fork_warm_state" hook is triggered with the :class:`WarmState` and 
+        the :class:`TimestepInfo` so nodes can copy it into every realization,
+        and the division continues from the end of the burn-in. Random number 
+        generator state is initialized per division as usual, so the 
+        realizations diverge from there.
+        
+        Every :data:`termination_check_interval` timesteps, the 
+        "on_check_termination" hook is triggered with the :class:`TimestepInfo`
+        instance, whose ``terminated`` array has an entry for each realization 
+        in the division. If a :class:`TerminationCondition` has marked every 
+        realization as terminated, the division is stopped early: 
+        ``stopped_early`` is set on the :class:`TimestepInfo` before 
+        "on_division_complete" is triggered, and the division's final timestep
+        and the reasons are recorded in ``terminations`` on the 
+        :class:`RunInfo`.
+        
+        If :meth:`restore` was called, the run resumes from the division and 
+        timestep stored in the checkpoint, without initializing the memory for
+        that division.
         """
         n_timesteps = self.n_timesteps
         step_fn_even = self._step_fn_even
         step_fn_odd = self._step_fn_odd
+        check_interval = self.termination_check_interval
         
         run_info = self.RunInfo(n_timesteps)
         
         # 1.
         self.trigger_hook("prepare_run", run_info)
         
-        for division_num in xrange(self.n_divisions):
+        resume_division, resume_timestep = self._resume_position
+        self._resume_position = (0, 0)
+        n_burn_in_timesteps = self.n_burn_in_timesteps
+        if n_burn_in_timesteps and (resume_division, resume_timestep) == (0, 0):
+            self._burn_in(run_info)
+        
+        for division_num in xrange(resume_division, self.n_divisions):
             max_realizations = self.n_realizations_per_division_max
             realization_start = numpy.int32(division_num * max_realizations)
-            n_realizations = realization_start + max_realizations
+            n_realizations = max_realizations
             total_realizations = self.n_realizations
-            if n_realizations > total_realizations:
+            if realization_start + n_realizations > total_realizations:
                 n_realizations = total_realizations - realization_start
             timestep_info = self.TimestepInfo(run_info, division_num,
                 realization_start, n_realizations)
             
             # 2.
-            self.trigger_hook("on_initialize_memory", timestep_info)
-            
-            timestep = numpy.int32(0)
+            if division_num == resume_division and resume_timestep > 0:
+                timestep = numpy.int32(resume_timestep)
+            else:
+                self.trigger_hook("on_initialize_memory", timestep_info)
+                timestep = numpy.int32(0)
+                if n_burn_in_timesteps:
+                    self.trigger_hook("on_fork_warm_state", self.warm_state,
+                                      timestep_info)
+                    timestep = numpy.int32(n_burn_in_timesteps)
+                
             while timestep < n_timesteps:                
                 timestep_info.timestep = timestep
                 
@@ -592,21 +971,91 @@ class Simulation(Node):
                 else:
                     step_fn_odd(timestep, realization_start)
                 
+                self._run_position = (division_num, timestep + 1)
                 self.trigger_hook("on_timestep_complete", timestep_info)
                 
                 timestep += 1
+                if timestep % check_interval == 0 and timestep < n_timesteps:
+                    if self._check_termination(timestep_info):
+                        break
+            self._run_position = (division_num + 1, 0)
             self.trigger_hook("on_division_complete", timestep_info)
             
         self.ctx.queue.finish() # wait for everything to complete
         self.trigger_hook("on_run_complete", run_info)
         
+    def _check_termination(self, timestep_info):
+        timestep_info.terminated = numpy.zeros(timestep_info.n_realizations, 
+                                               bool)
+        timestep_info.termination_reasons = set()
+        self.trigger_hook("on_check_termination", timestep_info)
+        if not timestep_info.terminated.all():
+            return False
+        
+        timestep_info.stopped_early = True
+        timestep_info.run_info.terminations[timestep_info.division_num] = (
+            timestep_info.timestep, sorted(timestep_info.termination_reasons))
+        return True
+        
+    def _burn_in(self, run_info):
+        # Running with realization_start set to the final realization makes the
+        # main loop cover exactly one realization, stored in the first slot.
+        step_fn_even = self._step_fn_even
+        step_fn_odd = self._step_fn_odd
+        realization_start = numpy.int32(self.n_realizations - 1)
+        timestep_info = self.TimestepInfo(run_info, -1, realization_start, 1)
+        self.trigger_hook("on_initialize_memory", timestep_info)
+        
+        timestep = numpy.int32(0)
+        while timestep < self.n_burn_in_timesteps:
+            timestep_info.timestep = timestep
+            if timestep % 2 == 0:
+                step_fn_even(timestep, realization_start)
+            else:
+                step_fn_odd(timestep, realization_start)
+            self.trigger_hook("on_burn_in_timestep_complete", timestep_info)
+            timestep += 1
+        
+        self.ctx.queue.finish()
+        warm_state = self.warm_state = self.WarmState()
+        self.trigger_hook("on_capture_warm_state", warm_state)
+        
+    warm_state = None
+    """The :class:`WarmState` captured at the end of the burn-in, if any."""
+        
+    class WarmState(dict):
+        """A map from :class:`MemoryNode` names to host copies of the first 
+        realization's slice of their buffers at the end of the burn-in."""
+        
+    def on_save_checkpoint(self, info):
+        warm_state = self.warm_state
+        if warm_state is not None:
+            for name, array in warm_state.iteritems():
+                info.add_array(self._warm_state_prefix + name, array)
+    
+    def on_restore_checkpoint(self, info):
+        prefix = self._warm_state_prefix
+        warm_state = self.WarmState()
+        for name, array in info.arrays.iteritems():
+            if name.startswith(prefix):
+                warm_state[name[len(prefix):]] = numpy.array(array)
+        self.warm_state = warm_state if warm_state else None
+        
+    _warm_state_prefix = "__warm_state__"
+        
     class RunInfo(object):
         """Contains information associated with a call to :meth:`run`."""
         def __init__(self, n_timesteps):
             self.n_timesteps = n_timesteps
+            self.terminations = { }
             
         n_timesteps = None
         """The number of timesteps."""
+        
+        terminations = None
+        """A map from the number of each division which was stopped early to 
+        a tuple containing its final timestep and the sorted reasons given by 
+        the :class:`TerminationCondition` nodes which triggered."""
             
     class TimestepInfo(object):
         """Contains information associated with a single timestep for a single 
@@ -618,6 +1067,154 @@ class Simulation(Node):
         
         timestep = 0
         
+        stopped_early = False
+        """Whether the division was stopped early by a 
+        :class:`TerminationCondition`."""
+        
+    ############################################################################
+    # Checkpointing
+    ############################################################################
+    _run_position = (0, 0)
+    # (division_num, timestep) of the next step run will execute
+    
+    _resume_position = (0, 0)
+    # (division_num, timestep) that the next call to run will start from
+    
+    def checkpoint(self, path):
+        """Saves the contents of all device memory, along with the current 
+        division and timestep, to a memory-mapped file at ``path``.
+        
+        Can be called between runs or from an "on_timestep_complete" listener 
+        (see :class:`PeriodicCheckpoint`). Triggers the "on_save_checkpoint" 
+        hook with an instance of :class:`CheckpointInfo`. The file is written 
+        to a temporary path first, so an existing checkpoint is only replaced 
+        once the new one is complete.
+        """
+        if not self.allocated:
+            raise Error("Memory was not allocated.")
+        self.ctx.queue.finish()
+        info = self.CheckpointInfo(self.ctx, self._run_position)
+        self.trigger_hook("on_save_checkpoint", info)
+        tmp_path = path + ".tmp"
+        info.save(tmp_path)
+        os.rename(tmp_path, path)
+        
+    def restore(self, path):
+        """Loads a checkpoint produced by :meth:`checkpoint` onto the device.
+        
+        If not already allocated, calls allocate first. Triggers the 
+        "on_restore_checkpoint" hook with an instance of 
+        :class:`CheckpointInfo`. Memory initializers are not run. The next call 
+        to :meth:`run` resumes from the checkpointed division and timestep.
+        """
+        if not self.allocated:
+            self.allocate()
+        info = self.CheckpointInfo.load(self.ctx, path)
+        self.trigger_hook("on_restore_checkpoint", info)
+        self._resume_position = self._run_position = info.position
+        
+    class CheckpointInfo(object):
+        """The contents of a checkpoint.
+        
+        The file consists of a magic string, the length of a JSON header 
+        describing each entry, the header, and then the raw contents of each 
+        entry, aligned to :data:`alignment` bytes.
+        """
+        def __init__(self, ctx, position, arrays=None):
+            self.ctx = ctx
+            self.position = tuple(int(x) for x in position)
+            self._entries = []
+            self.arrays = arrays if arrays is not None else {}
+            
+        position = None
+        """(division_num, timestep) of the next step to run."""
+            
+        arrays = None
+        """After :meth:`load`, a map from entry names to read-only memory-mapped
+        arrays."""
+            
+        magic = "CLEGANS_CHECKPOINT_1"
+        alignment = 64
+        
+        def add_buffer(self, name, buffer):
+            """Adds the contents of a device buffer."""
+            self._add(name, buffer, buffer.shape, cl.Buffer.infer_dtype(buffer))
+            
+        def add_array(self, name, array):
+            """Adds the contents of a host array."""
+            self._add(name, array, array.shape, array.dtype)
+            
+        def _add(self, name, source, shape, dtype):
+            if name in self.arrays or any(entry[0] == name 
+                                          for entry in self._entries):
+                raise Error("Duplicate checkpoint entry: %s" % name)
+            self._entries.append((name, source, tuple(shape), 
+                                  numpy.dtype(dtype)))
+            
+        def __getitem__(self, name):
+            try:
+                return self.arrays[name]
+            except KeyError:
+                raise Error("Checkpoint has no entry named %s." % name)
+            
+        def save(self, path):
+            """Writes the entries added so far to ``path``."""
+            alignment = self.alignment
+            header = {"position": list(self.position), "entries": []}
+            offset = 0
+            for name, _, shape, dtype in self._entries:
+                header["entries"].append({"name": name, "shape": list(shape),
+                    "dtype": dtype.str, "offset": offset})
+                nbytes = int(numpy.prod(shape)) * dtype.itemsize
+                offset += py.int_div_round_up(nbytes, alignment) * alignment
+            header_str = json.dumps(header)
+            data_start = len(self.magic) + 8 + len(header_str)
+            data_start = py.int_div_round_up(data_start, alignment) * alignment
+            
+            with open(path, "wb") as f:
+                f.write(self.magic)
+                f.write(struct.pack("<Q", len(header_str)))
+                f.write(header_str)
+                f.truncate(data_start + offset)
+                
+            ctx = self.ctx
+            for (name, source, shape, dtype), entry in zip(self._entries, 
+                                                          header["entries"]):
+                if not shape or 0 in shape:
+                    continue
+                target = numpy.memmap(path, dtype, "r+", 
+                                      data_start + entry["offset"], shape)
+                if isinstance(source, numpy.ndarray):
+                    target[...] = source
+                else:
+                    ctx.memcpy(target, source)
+                target.flush()
+                del target
+        
+        @classmethod
+        def load(cls, ctx, path):
+            """Memory-maps the checkpoint at ``path``."""
+            with open(path, "rb") as f:
+                magic = f.read(len(cls.magic))
+                if magic != cls.magic:
+                    raise Error("%s is not a checkpoint file." % path)
+                header_len, = struct.unpack("<Q", f.read(8))
+                header = json.loads(f.read(header_len))
+            alignment = cls.alignment
+            data_start = len(cls.magic) + 8 + header_len
+            data_start = py.int_div_round_up(data_start, alignment) * alignment
+            
+            arrays = {}
+            for entry in header["entries"]:
+                shape = tuple(entry["shape"])
+                dtype = numpy.dtype(str(entry["dtype"]))
+                if not shape or 0 in shape:
+                    arrays[entry["name"]] = numpy.empty(shape, dtype)
+                else:
+                    arrays[entry["name"]] = numpy.memmap(path, dtype, "r", 
+                        data_start + entry["offset"], shape)
+            return cls(ctx, header["position"], arrays)
+        
     ############################################################################
     # RNG
     ############################################################################
@@ -640,6 +1237,12 @@ class Simulation(Node):
     def randn(self):
         self.rng # initialize RNG if not already
         return "randn"
+    
+    @property
+    def rng_state(self):
+        """The state of the :class:`RNG`, to pass to the random number 
+        functions."""
+        return self.rng.rng_state
 
 class Model(Node):
     """Specifies the behavior of a contiguous range of elements."""
@@ -678,6 +1281,111 @@ class Model(Node):
         """
         idx_model = idx_realization - offset
         """ << g
+        
+    ## Vectorized Code Generation
+    @property
+    def n_batches(self):
+        """The number of batches of :data:`Simulation.vector_width` elements
+        this model's elements are split into per realization."""
+        return py.int_div_round_up(self.count, self.sim.vector_width)
+    
+    @property
+    def batch_offset(self):
+        """The index of this model's first batch in a realization."""
+        return self.sim.model_batch_offsets_map[self]
+    
+    @property
+    def vectorized(self):
+        """Whether full batches of this model are updated using vector code,
+        which requires every node in the model to be ``vectorizable``."""
+        return (self.sim.vector_width > 1 and 
+                all(getattr(node, 'vectorizable', False)
+                    for node in self.sim._iter_nodes(self)))
+    
+    vector_code = False
+    """True while the vector code of the model is being generated, so nodes 
+    can emit vector loads and stores instead of scalar ones."""
+    
+    vector_suffix = "_vec"
+    """Appended to the names of the locals holding vectors in vector code. The
+    scalar code of a partial batch or of another model in the same step 
+    function declares the plain names with scalar types."""
+    
+    def local_name(self, name):
+        """Returns the name of the local ``name`` in the code being generated,
+        with :data:`vector_suffix` appended in vector code."""
+        if self.vector_code:
+            return name + self.vector_suffix
+        return name
+    
+    def generate_batch(self, g):
+        """Generates the code updating the batch starting at element 
+        ``idx_model_first`` when :data:`Simulation.vector_width` is greater 
+        than 1. If the model is :data:`vectorized`, full batches are updated
+        by the "model_vector_code" hook, with :data:`vector_code` set. 
+        Otherwise, and for the last batch if it is partial, the elements are 
+        updated one at a time by the regular scalar code.
+        """
+        self.trigger_staged_cg_hook("batch", g)
+        
+    def in_batch(self, g):
+        """
+        idx_model_first = (idx_batch_realization - batch_offset) * vector_width
+        """ << g
+        partial = self.count % self.sim.vector_width != 0
+        if not self.vectorized:
+            self.generate_lanes(g, partial)
+            return
+        
+        if partial:
+            ("if idx_model_first + vector_width <= count:\n", g.tab) >> g
+        self.vector_code = True
+        try:
+            self.trigger_staged_cg_hook("model_vector_code", g)
+        finally:
+            self.vector_code = False
+        if partial:
+            (g.untab, "else:\n", g.tab) >> g
+            self.generate_lanes(g, True)
+            g.untab >> g
+        
+    def generate_lanes(self, g, partial):
+        """Generates a loop updating each element of the batch in turn using 
+        the scalar step code. If ``partial``, the batch may be cut short by the
+        end of the model."""
+        if partial:
+            """
+            n_lanes = min(vector_width, count - idx_model_first)
+            """ << g
+        else:
+            """
+            n_lanes = vector_width
+            """ << g
+        """
+        for lane in (0, n_lanes, 1):
+        """ << g
+        g.tab >> g
+        self.generate_lane_idx_calculations(g)
+        self.generate_step_kernel(g)
+        (g.untab, "\n") >> g
+        
+    def generate_lane_idx_calculations(self, g):
+        """Generates the element indices of element ``lane`` of the batch."""
+        """
+        idx_sim = realization_num * n_elms_per_realization + offset + idx_model_first + lane
+        """ << g
+        self.sim.trigger_staged_cg_hook("element_idx_calculations", g)
+
+_cl_dtype_sizes = {
+    "char": 1, "uchar": 1, "short": 2, "ushort": 2, "half": 2,
+    "int": 4, "uint": 4, "float": 4, 
+    "long": 8, "ulong": 8, "double": 8
+}
+
+def _shallow_copy(value):
+    if isinstance(value, (list, dict, set)):
+        return type(value)(value)
+    return value
 
 class MemoryNode(Node):
     """Represents a Node containing a memory element.
@@ -692,18 +1400,51 @@ class MemoryNode(Node):
         cg.Node.__init__(self, parent=parent, basename=basename, args=args,
                       kwargs=kwargs)
         
+    vectorizable = True # inserts no code
+        
     @property
     def _CG_expression(self):
         # for proper substitution
         return self.name
     
-    @py.lazy(property)
+    @property
     def buffer(self):
-        """The :class:`pyocl.Buffer` corresponding to this memory node."""
-        buffer = self.fn(*self.args, **self.kwargs)
-        self.sim.constants[self.name] = buffer
+        """The :class:`pyocl.Buffer` corresponding to this memory node.
+        
+        Created on first access and dropped when the simulation is released.
+        """
+        buffer = self._buffer
+        if buffer is None:
+            buffer = self._buffer = self._create_buffer()
+            self.sim.constants[self.name] = buffer
         return buffer
+    
+    _buffer = None
+    
+    def _create_buffer(self):
+        return self.fn(*self.fn_args, **self.kwargs)
+    
+    def on_release(self):
+        buffer = self._buffer
+        if buffer is not None:
+            self._buffer = None
+            if self.sim.buffer_pool is not None:
+                self._release_buffer(buffer)
+            
+    def _release_buffer(self, buffer):
+        buffer.release()
        
+    @property
+    def fn_args(self):
+        """The positional arguments passed to :data:`fn`."""
+        return self.args
+    
+    @property
+    def nbytes(self):
+        """The size of the buffer in bytes, available before allocation."""
+        array = self.fn_args[0]
+        return array.nbytes
+        
     def on_allocate(self):
         self.buffer # make sure its been created
         
@@ -715,16 +1456,105 @@ class MemoryNode(Node):
         
     def on_calculate_total_memory_usage(self, accumulator):
         accumulator += self.buffer.size
+        
+    checkpointed = True
+    """Whether the contents of this buffer are saved by 
+    :meth:`Simulation.checkpoint`."""
+    
+    realization_major = False
+    """Whether this buffer is a flat array made up of one equally sized block per
+    realization slot in the division. If so, it is copied from the first 
+    realization into all of them after a burn-in (see 
+    :data:`Simulation.n_burn_in_timesteps`)."""
+    
+    def on_capture_warm_state(self, warm_state):
+        if self.realization_major:
+            buffer = self.buffer
+            block_size = buffer.shape[0] / self.sim.n_realizations_per_division_max
+            warm_state[self.name] = self.sim.ctx.from_device(buffer)[0:block_size]
+            
+    def on_fork_warm_state(self, warm_state, timestep_info): #@UnusedVariable
+        if self.realization_major:
+            n_realizations = self.sim.n_realizations_per_division_max
+            self.sim.ctx.memcpy(self.buffer, 
+                                numpy.tile(warm_state[self.name], n_realizations))
+        
+    def on_save_checkpoint(self, info):
+        if self.checkpointed:
+            info.add_buffer(self.name, self.buffer)
+        
+    def on_restore_checkpoint(self, info):
+        if self.checkpointed:
+            array = info[self.name]
+            buffer = self.buffer
+            if (array.shape != tuple(buffer.shape) or 
+                array.dtype != cl.Buffer.infer_dtype(buffer)):
+                raise Error("Checkpoint entry %s does not match its buffer." % 
+                            self.name)
+            self.sim.ctx.memcpy(buffer, numpy.ascontiguousarray(array))
     
 class Allocation(MemoryNode):
-    """Represents an uninitialized memory allocation, using Context.alloc."""
+    """Represents an uninitialized memory allocation, using Context.alloc.
+    
+    The shape may be given as a function returning the shape, which is called
+    when the buffer is created. This allows the shape to depend on quantities,
+    like :data:`Simulation.n_realizations_per_division_max`, which are only 
+    known once the simulation is finalized.
+    """
     @property
     def fn(self):
         """:meth:`pyocl.Context.alloc`"""
         return self.sim.ctx.alloc
     
+    @property
+    def fn_args(self):
+        shape, cl_dtype = self.args
+        if py.is_callable(shape):
+            shape = shape()
+        return shape, cl_dtype
+    
+    def _create_buffer(self):
+        pool = self.sim.buffer_pool
+        if pool is None:
+            return MemoryNode._create_buffer(self)
+        return pool.alloc(*self.fn_args)
+    
+    def _release_buffer(self, buffer):
+        self.sim.buffer_pool.give_back(buffer)
+    
+    @property
+    def nbytes(self):
+        shape, cl_dtype = self.fn_args
+        return int(numpy.prod(shape)) * _cl_dtype_sizes[cl_dtype.name]
+    
+class LocalAllocation(MemoryNode):
+    """Represents a per-work-group local memory allocation, using 
+    Context.alloc_local. Only exists during a kernel launch, so it does not
+    count towards device memory usage and is not checkpointed."""
+    checkpointed = False
+    
+    @property
+    def fn(self):
+        """:meth:`pyocl.Context.alloc_local`"""
+        return self.sim.ctx.alloc_local
+    
+    @property
+    def nbytes(self):
+        return 0
+    
+    def _release_buffer(self, buffer):
+        pass
+    
+    def on_print_memory_summary(self):
+        pass
+    
+    def on_calculate_total_memory_usage(self, accumulator):
+        pass
+    
 class ConstantArray(MemoryNode):
     """Represents a constant array over all realizations, using Context.In."""
+    checkpointed = False # re-uploaded from the host by allocate
+    
     @property
     def fn(self):
         """:meth:`pyocl.Context.In`"""
@@ -749,7 +1579,7 @@ class RNG(Node):
     @py.autoinit
     def __init__(self, parent, basename="RNG"): pass
     
-    randf = clqstd.simple_randf
+    randf = None
     """The base random number function to use. Defaults to 
     :data:`clqstd.simple_randf`."""
     
@@ -759,13 +1589,17 @@ class RNG(Node):
     
     @py.lazy(property)
     def rng_state(self):
-        return Allocation(self, "rng_state", 
-            (self.sim.n_work_items,), clqcl.int)
+        return Allocation(self, "rng_state", self._rng_state_shape, clqcl.int)
+    
+    def _rng_state_shape(self):
+        return (self.sim.n_work_items,)
 
     def pre_finalize(self):
         self.rng_state
         
         sim = self.sim
+        if self.randf is None:
+            self.randf = clqstd.simple_randf
         if self.initializer is None:
             self.initializer = self.randf.initializer
 
@@ -777,7 +1611,7 @@ class RNG(Node):
     
     def on_initialize_memory(self, timestep_info): #@UnusedVariable
         sim = self.sim
-        sim.ctx.memcpy(self.state.buffer, self.initializer(sim.n_work_items))
+        sim.ctx.memcpy(self.rng_state.buffer, self.initializer(sim.n_work_items))
         
 class Probe(Node):
     """Abstract base class for all data probes."""
@@ -791,12 +1625,14 @@ class ConstrainedProbe(Probe):
     
     @py.autoinit
     def __init__(self, parent, basename="ConstrainedProbe",
-                 t_range=(0, None, 1),
+                 t_range=(None, None, 1),
                  idx="idx_model",
                  idx_range=(0, None, 1)): pass
                  
     def on_finalize(self):
         t_range = list(self.t_range)
+        if t_range[0] is None:
+            t_range[0] = self.sim.n_burn_in_timesteps
         if t_range[1] is None:
             t_range[1] = self.sim.n_timesteps
         if len(t_range) == 2:
@@ -812,7 +1648,8 @@ class ConstrainedProbe(Probe):
         self.idx_range = tuple(idx_range)
         
     t_range = None
-    """The range (start, stop, step) of timesteps."""
+    """The range (start, stop, step) of timesteps. A start of ``None`` means
+    the end of the burn-in (see :data:`Simulation.n_burn_in_timesteps`)."""
     
     idx_range = None
     """The range (start, stop, step) of indices."""
@@ -856,11 +1693,29 @@ class ConstrainedProbe(Probe):
         t_range = self.t_range
         return int((t_range[1] - t_range[0])/t_range[2])
     
+    def t_stop_reached(self, timestep_info):
+        """The timestep the division which just completed stopped sampling at:
+        ``t_stop``, or the one after its final timestep if it was stopped 
+        early before then."""
+        if timestep_info.stopped_early:
+            return min(self.t_stop, timestep_info.timestep + 1)
+        return self.t_stop
+    
+    def n_samples_taken(self, timestep_info):
+        """The number of timesteps the division which just completed was 
+        sampled at, which is :data:`total_n_timesteps` unless it was stopped
+        early."""
+        if not timestep_info.stopped_early:
+            return self.total_n_timesteps
+        return py.int_div_round_up(
+            max(self.t_stop_reached(timestep_info) - self.t_start, 0), 
+            self.t_step)
+    
     @property
     def n_elms(self):
-        """int((idx_stop - idx_start)/idx_step)"""
+        """The number of indices in idx_range."""
         idx_range = self.idx_range
-        return int((idx_range[1] - idx_range[0]/idx_range[2]))
+        return py.int_div_round_up(idx_range[1] - idx_range[0], idx_range[2])
     
     @property
     def n_realizations(self):
@@ -966,6 +1821,19 @@ class PerElementProbe(ConstrainedProbe):
                 self.trigger_hook("on_buffer_full", timestep_info, 
                                   timesteps_elapsed)
                 
+    def on_division_complete(self, timestep_info):
+        # flush the partially filled buffer if the division was stopped early
+        if timestep_info.stopped_early:
+            timestep = min(timestep_info.timestep, self.t_stop - 1)
+            timesteps_elapsed = self.timesteps_elapsed(timestep)
+            buffer_timepoints = self.buffer_timepoints
+            if (timesteps_elapsed > 0 and 
+                timesteps_elapsed % buffer_timepoints != 0):
+                timesteps_elapsed = buffer_timepoints * py.int_div_round_up(
+                    timesteps_elapsed, buffer_timepoints)
+                self.trigger_hook("on_buffer_full", timestep_info, 
+                                  timesteps_elapsed)
+                
     def timesteps_elapsed(self, timestep):
         return (timestep - self.t_start)/self.t_step + 1
     
@@ -1030,6 +1898,13 @@ class AccumulateOnHost(Node):
                                :], parent.allocation.buffer)
         self.data = data_buffer
         parent.trigger_hook("on_process_data", data_buffer, self)
+        
+    def on_save_checkpoint(self, info):
+        info.add_array(self.name, self.data_buffer)
+        
+    def on_restore_checkpoint(self, info):
+        self.data_buffer[...] = info[self.name]
+        self.data = self.data_buffer
 
 class ExpressionProbe(PerElementProbe):
     """A :class:`PerElementProbe` which records the value of the provided expression
@@ -1055,4 +1930,374 @@ class ExpressionProbe(PerElementProbe):
         allocation[buffer_idx_expression] = expression
         """ << g
         self.unconstrain(g)
-        
\ No newline at end of file
+        
+
+class PeriodicCheckpoint(Node):
+    """Calls :meth:`Simulation.checkpoint` every ``interval`` timesteps, so a
+    preempted run can be resumed using :meth:`Simulation.restore`."""
+    
+    @py.autoinit
+    def __init__(self, parent, path, interval=1000, 
+                 basename="PeriodicCheckpoint"): pass
+    
+    path = None
+    """The path to write the checkpoint to. Overwritten each time."""
+    
+    interval = None
+    """The number of timesteps between checkpoints."""
+    
+    def on_timestep_complete(self, timestep_info):
+        if (timestep_info.timestep + 1) % self.interval == 0:
+            self.sim.checkpoint(self.path)
+
+class RunningStatisticsProbe(ConstrainedProbe):
+    """A :class:`ConstrainedProbe` which keeps the running mean, variance, 
+    minimum and maximum of the provided expression for each element in device
+    memory, using Welford's algorithm.
+    
+    Only the final values are copied to the host, after each division, into the
+    ``mean_data``, ``variance_data``, ``min_data`` and ``max_data`` arrays of 
+    shape ``(n_realizations, n_elms)``.
+    """
+    
+    @py.autoinit
+    def __init__(self, parent, basename="RunningStatisticsProbe",
+                 expression=None,
+                 hook=None): pass
+    
+    expression = None
+    """The expression to accumulate statistics of."""
+    
+    hook = None
+    """The code generation hook to sample the expression in."""
+    
+    @property
+    def n_samples(self):
+        """The number of samples taken per element over a full division."""
+        return self.total_n_timesteps
+    
+    sample_counts = None
+    """After allocation, the number of samples taken per element in each 
+    realization, which is less than :data:`n_samples` for divisions stopped 
+    early."""
+    
+    def on_finalize(self):
+        super(RunningStatisticsProbe, self).on_finalize()
+        
+        assert self.expression
+        assert self.hook
+        
+        shape = (self.n_realizations * self.n_elms,)
+        self.mean_allocation = Allocation(self, "mean", shape, clqcl.float)
+        self.m2_allocation = Allocation(self, "m2", shape, clqcl.float)
+        self.min_allocation = Allocation(self, "min", shape, clqcl.float)
+        self.max_allocation = Allocation(self, "max", shape, clqcl.float)
+        setattr(self, self.hook, self._insert_code)
+        
+    def on_allocate(self):
+        shape = (self.sim.n_realizations, self.n_elms)
+        self.mean_data = numpy.zeros(shape, numpy.float32)
+        self.variance_data = numpy.zeros(shape, numpy.float32)
+        self.min_data = numpy.zeros(shape, numpy.float32)
+        self.max_data = numpy.zeros(shape, numpy.float32)
+        self.sample_counts = numpy.zeros(self.sim.n_realizations, numpy.int32)
+        
+    _host_arrays = ("mean_data", "variance_data", "min_data", "max_data", 
+                    "sample_counts")
+        
+    def on_save_checkpoint(self, info):
+        for attr in self._host_arrays:
+            info.add_array("%s_%s" % (self.name, attr), getattr(self, attr))
+            
+    def on_restore_checkpoint(self, info):
+        for attr in self._host_arrays:
+            getattr(self, attr)[...] = info["%s_%s" % (self.name, attr)]
+        
+    def on_initialize_memory(self, timestep_info): #@UnusedVariable
+        clqstd.ew_set_0(self.mean_allocation.buffer)
+        clqstd.ew_set_0(self.m2_allocation.buffer)
+        
+    def _insert_code(self, g):
+        self.constrain(g)
+        """
+        stat_idx = (realization_num - realization_start)*n_elms + idx_expr
+        stat_x = expression
+        stat_n = (timestep - t_start)/t_step + 1
+        stat_delta = stat_x - mean_allocation[stat_idx]
+        stat_mean = mean_allocation[stat_idx] + stat_delta/stat_n
+        mean_allocation[stat_idx] = stat_mean
+        m2_allocation[stat_idx] = m2_allocation[stat_idx] + stat_delta*(stat_x - stat_mean)
+        if stat_n == 1:
+            min_allocation[stat_idx] = stat_x
+            max_allocation[stat_idx] = stat_x
+        else:
+            min_allocation[stat_idx] = min(min_allocation[stat_idx], stat_x)
+            max_allocation[stat_idx] = max(max_allocation[stat_idx], stat_x)
+        """ << g
+        self.unconstrain(g)
+        
+    idx_expr = "(idx - idx_start)/idx_step"
+        
+    def on_division_complete(self, timestep_info):
+        get = self.sim.ctx.from_device
+        shape = (self.n_realizations, self.n_elms)
+        start = timestep_info.realization_start
+        end = start + timestep_info.n_realizations
+        n = timestep_info.n_realizations
+        
+        mean = get(self.mean_allocation.buffer).reshape(shape)[0:n]
+        m2 = get(self.m2_allocation.buffer).reshape(shape)[0:n]
+        n_samples = self.n_samples_taken(timestep_info)
+        self.sample_counts[start:end] = n_samples
+        self.mean_data[start:end] = mean
+        self.variance_data[start:end] = m2 / max(n_samples - 1, 1)
+        self.min_data[start:end] = get(
+            self.min_allocation.buffer).reshape(shape)[0:n]
+        self.max_data[start:end] = get(
+            self.max_allocation.buffer).reshape(shape)[0:n]
+
+class ReducedExpressionProbe(ConstrainedProbe):
+    """A :class:`ConstrainedProbe` which records a reduction (``"sum"``, 
+    ``"mean"``, ``"max"`` or ``"min"``) of the provided expression over the 
+    elements in ``idx_range``, producing one value per timestep and 
+    realization rather than one per element.
+    
+    Each sampled timestep, elements write the expression into a scratch buffer.
+    At the start of the next timestep, after the main loop, every work group 
+    reduces its share of the scratch buffer in local memory and writes one 
+    partial result per realization. The partial results are copied back and
+    combined across work groups on the host after each division, into the 
+    ``data`` array of shape ``(total_n_timesteps, n_realizations)``. A final 
+    sample taken on the last timestep is reduced on the host from the scratch 
+    buffer. If a division is stopped early, the rows of ``data`` after its 
+    final sample are left zero.
+    """
+    
+    @py.autoinit
+    def __init__(self, parent, basename="ReducedExpressionProbe",
+                 expression=None,
+                 hook=None,
+                 reduction="mean"): pass
+    
+    expression = None
+    """The expression to reduce."""
+    
+    hook = None
+    """The code generation hook to sample the expression in."""
+    
+    reduction = None
+    """One of ``"sum"``, ``"mean"``, ``"max"`` or ``"min"``."""
+    
+    _combiners = {
+        "sum": ("a + b", "0.0", numpy.sum),
+        "mean": ("a + b", "0.0", numpy.sum),
+        "max": ("max(a, b)", "-3.402823e38", numpy.max),
+        "min": ("min(a, b)", "3.402823e38", numpy.min),
+    }
+    
+    def pre_finalize(self):
+        constants = self.sim.constants
+        constants['get_local_id'] = clqcl.get_local_id
+        constants['get_local_size'] = clqcl.get_local_size
+        constants['get_group_id'] = clqcl.get_group_id
+        constants['get_num_groups'] = clqcl.get_num_groups
+        constants['barrier'] = clqcl.barrier
+        constants['CLK_LOCAL_MEM_FENCE'] = clqcl.CLK_LOCAL_MEM_FENCE
+    
+    def on_finalize(self):
+        super(ReducedExpressionProbe, self).on_finalize()
+        
+        assert self.expression
+        assert self.hook
+        if self.reduction not in self._combiners:
+            raise Error("Unknown reduction: %s" % self.reduction)
+        
+        sim = self.sim
+        scratch_shape = (self.n_realizations * self.n_elms,)
+        self.scratch_even = Allocation(self, "scratch_even", scratch_shape, 
+                                       clqcl.float)
+        self.scratch_odd = Allocation(self, "scratch_odd", scratch_shape, 
+                                      clqcl.float)
+        self.partials = Allocation(self, "partials", self._partials_shape, 
+                                   clqcl.float)
+        self.local_partials = LocalAllocation(self, "local_partials", 
+            (sim.n_work_items_per_work_group,), clqcl.float)
+        setattr(self, self.hook, self._insert_code)
+        
+    def _partials_shape(self):
+        return (self.total_n_timesteps, self.n_realizations, 
+                self.sim.n_work_groups)
+        
+    def on_allocate(self):
+        self.data = numpy.zeros((self.total_n_timesteps, 
+                                 self.sim.n_realizations), numpy.float32)
+        
+    def on_save_checkpoint(self, info):
+        info.add_array(self.name + "_data", self.data)
+        
+    def on_restore_checkpoint(self, info):
+        self.data[...] = info[self.name + "_data"]
+        
+    def on_initialize_memory(self, timestep_info): #@UnusedVariable
+        clqstd.ew_set_0(self.partials.buffer)
+        
+    @property
+    def combine(self):
+        """The expression combining two partial results a and b."""
+        return self._combiners[self.reduction][0]
+    
+    @property
+    def identity(self):
+        """The identity element of the reduction."""
+        return self._combiners[self.reduction][1]
+    
+    def _insert_code(self, g):
+        self.constrain(g)
+        """
+        scratch = scratch_even if timestep % 2 == 0 else scratch_odd
+        scratch[(realization_num - realization_start)*n_elms + idx_expr] = expression
+        """ << g
+        self.unconstrain(g)
+        
+    idx_expr = "(idx - idx_start)/idx_step"
+        
+    def post_main_loop(self, g):
+        # the scratch buffer written during the previous timestep is complete
+        # now, since kernel launches are globally synchronized
+        constraints = ["timestep >= t_start + 1", "timestep < t_stop + 1"]
+        if self.t_step != 1:
+            constraints.append("(timestep - 1 - t_start) % t_step == 0")
+        ("if %s:\n" % " and ".join(constraints), g.tab) >> g
+        """
+        prev_scratch = scratch_odd if timestep % 2 == 0 else scratch_even
+        sample_idx = (timestep - 1 - t_start)/t_step
+        lid = get_local_id(0)
+        lsize = get_local_size(0)
+        group = get_group_id(0)
+        n_groups = get_num_groups(0)
+        for reduce_r in (0, n_realizations, 1):
+            a = identity
+            for reduce_i in (gid, n_elms, gsize):
+                b = prev_scratch[reduce_r*n_elms + reduce_i]
+                a = combine
+            local_partials[lid] = a
+            barrier(CLK_LOCAL_MEM_FENCE)
+            reduce_s = lsize / 2
+            while reduce_s > 0:
+                if lid < reduce_s:
+                    a = local_partials[lid]
+                    b = local_partials[lid + reduce_s]
+                    local_partials[lid] = combine
+                barrier(CLK_LOCAL_MEM_FENCE)
+                reduce_s = reduce_s / 2
+            if lid == 0:
+                partials[(sample_idx*n_realizations + reduce_r)*n_groups + group] = local_partials[0]
+            barrier(CLK_LOCAL_MEM_FENCE)
+        """ << g
+        g.untab >> g
+        
+    def on_division_complete(self, timestep_info):
+        get = self.sim.ctx.from_device
+        n = timestep_info.n_realizations
+        start = timestep_info.realization_start
+        reduce_fn = self._combiners[self.reduction][2]
+        
+        n_samples = self.n_samples_taken(timestep_info)
+        if not n_samples:
+            return
+        data = reduce_fn(get(self.partials.buffer)[0:n_samples, 0:n, :], 
+                         axis=2)
+        
+        # the final sample has no following timestep to reduce it in
+        last_t = self.t_start + (n_samples - 1) * self.t_step
+        if timestep_info.stopped_early:
+            final_timestep = timestep_info.timestep
+        else:
+            final_timestep = self.sim.n_timesteps - 1
+        if last_t == final_timestep:
+            if last_t % 2 == 0:
+                scratch = self.scratch_even
+            else:
+                scratch = self.scratch_odd
+            values = get(scratch.buffer).reshape((self.n_realizations, 
+                                                  self.n_elms))[0:n]
+            data[-1] = reduce_fn(values, axis=1)
+        
+        if self.reduction == "mean":
+            data = data / self.n_elms
+        self.data[0:n_samples, start:start + n] = data
+
+class TerminationCondition(Node):
+    """Stops a division early once every realization in it has satisfied a 
+    condition.
+    
+    If ``condition`` holds for any element of a realization in ``hook``, the 
+    first such timestep is recorded in a device flag for that realization. The
+    flags are polled every :data:`Simulation.termination_check_interval` 
+    timesteps. The timestep at which each realization terminated is stored in
+    ``terminated_at`` (-1 if it never did). 
+    
+    For example, to stop when any voltage becomes NaN::
+    
+        TerminationCondition(model, condition="v != v", 
+                             hook="post_read_state", reason="nan")
+                             
+    Subclasses may set the flag from other hooks instead.
+    """
+    
+    @py.autoinit
+    def __init__(self, parent, basename="TerminationCondition",
+                 condition=None,
+                 hook=None,
+                 reason=None): pass
+    
+    condition = None
+    """The condition to check."""
+    
+    hook = None
+    """The code generation hook to check the condition in."""
+    
+    reason = None
+    """A description of the condition, recorded when it triggers. Defaults to
+    the name of the node."""
+    
+    def on_finalize(self):
+        if self.reason is None:
+            self.reason = self.name
+        self.flag = Allocation(self, "flag", 
+            (self.sim.n_realizations_per_division_max,), clqcl.int)
+        if self.hook is not None:
+            assert self.condition
+            setattr(self, self.hook, self._insert_code)
+            
+    def on_allocate(self):
+        self.terminated_at = numpy.empty(self.sim.n_realizations, numpy.int32)
+        self.terminated_at.fill(-1)
+        
+    def on_initialize_memory(self, timestep_info): #@UnusedVariable
+        clqstd.ew_set_0(self.flag.buffer)
+        
+    def _insert_code(self, g):
+        """
+        if condition:
+            flag_idx = realization_num - realization_start
+            if flag[flag_idx] == 0:
+                flag[flag_idx] = timestep + 1
+        """ << g
+        
+    def on_check_termination(self, timestep_info):
+        n = timestep_info.n_realizations
+        start = timestep_info.realization_start
+        flags = self.sim.ctx.from_device(self.flag.buffer)[0:n]
+        triggered = flags > 0
+        if triggered.any():
+            terminated_at = self.terminated_at[start:start + n]
+            terminated_at[triggered] = flags[triggered] - 1
+            timestep_info.terminated |= triggered
+            timestep_info.termination_reasons.add(self.reason)
+            
+    def on_save_checkpoint(self, info):
+        info.add_array(self.name, self.terminated_at)
+        
+    def on_restore_checkpoint(self, info):
+        self.terminated_at[...] = info[self.name]
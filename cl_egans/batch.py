@@ -0,0 +1,244 @@
+"""Runs many small simulations in a local pool of worker processes.
+
+Sweeps often consist of thousands of jobs whose simulations are identical
+except for their seeds or initial conditions. Running each as its own
+:class:`Simulation <cl_egans.Simulation>` wastes both compilation time and
+device occupancy. :class:`BatchRunner` instead packs compatible jobs into the
+realizations of a single run, all in one division, and spreads the runs with
+the same generated code over as few worker processes as keep every worker
+busy, so each step function is compiled at most once per worker (see
+:data:`Simulation.code_hash <cl_egans.Simulation.code_hash>`).
+
+A :class:`Job` names a ``build`` function, which constructs the simulation for
+a list of per-realization parameters, and a ``collect`` function, which
+extracts one realization's result after the run. Both must be defined at
+module level so they can be sent to the workers::
+
+    def build(shared, params_list):
+        sim = Simulation(n_realizations=len(params_list), **shared)
+        neurons = ReducedLIF(sim, "LIF", count=302)
+        InitializeFromHost(neurons.v, lambda shape, dtype: numpy.concatenate(
+            [initial_v(params, 302) for params in params_list]).astype(dtype))
+        sim.probe = SpikeCountProbe(neurons)
+        return sim
+
+    def collect(sim, realization_num):
+        return sim.probe.counts[realization_num]
+
+    jobs = [Job(build, collect, shared={"n_timesteps": 10000},
+                params={"seed": seed}) for seed in xrange(1000)]
+    results = BatchRunner(n_processes=4).run(jobs)
+
+Jobs are packed together only if they have the same ``build`` and ``collect``
+functions and equal ``shared`` parameters, which should therefore contain
+everything that affects the generated code. The runner sets
+:data:`n_realizations_per_division_max
+<cl_egans.Simulation.n_realizations_per_division_max>` of each simulation to
+its number of realizations, so use ``max_realizations_per_run`` to bound the
+memory of a run.
+"""
+import time
+import collections
+import multiprocessing
+import cypy as py
+from cl_egans import Error
+
+class Job(object):
+    """A simulation to run as part of a batch."""
+    @py.autoinit
+    def __init__(self, build, collect, shared=None, params=None,
+                 name=None): pass
+
+    build = None
+    """A module-level function taking ``shared`` and a list of per-realization
+    ``params`` and returning an unfinalized :class:`Simulation
+    <cl_egans.Simulation>` with one realization per entry."""
+
+    collect = None
+    """A module-level function taking the simulation after its run and a
+    realization number and returning the (picklable) result for that
+    realization's job."""
+
+    shared = None
+    """Parameters which must be equal for jobs to share a run."""
+
+    params = None
+    """Parameters specific to this job, like its seed or initial conditions."""
+
+    name = None
+    """A name for the job, reported in its :class:`JobResult`. Defaults to its
+    position in the batch."""
+
+    @property
+    def pack_key(self):
+        """Jobs with equal pack keys can run as realizations of one run."""
+        build, collect = self.build, self.collect
+        shared = self.shared or { }
+        return ((build.__module__, build.__name__),
+                (collect.__module__, collect.__name__),
+                repr(sorted(shared.iteritems())))
+
+class JobResult(object):
+    """The result of a :class:`Job`, with timing information."""
+    @py.autoinit
+    def __init__(self, name, result, code_hash, run_num, realization_num,
+                 n_realizations, build_time, compile_time, run_time): pass
+
+    name = None
+    """The name of the job."""
+
+    result = None
+    """The value returned by the job's ``collect`` function."""
+
+    code_hash = None
+    """The hash of the generated code of the run containing the job."""
+
+    run_num = None
+    """The number of the run containing the job within the batch."""
+
+    realization_num = None
+    """The realization the job occupied in its run."""
+
+    n_realizations = None
+    """The number of realizations in the run, including padding."""
+
+    build_time = None
+    """Seconds spent building, finalizing and allocating the run."""
+
+    compile_time = None
+    """Seconds spent compiling the run's step function (near zero if it was
+    already compiled for an earlier run)."""
+
+    run_time = None
+    """Seconds spent running the run and collecting its results."""
+
+    @property
+    def amortized_time(self):
+        """The run's total time divided by its number of realizations."""
+        total = self.build_time + self.compile_time + self.run_time
+        return total / self.n_realizations
+
+class BatchRunner(object):
+    """Runs a list of :class:`Job` instances in a pool of worker processes.
+
+    Jobs are grouped by :data:`Job.pack_key` and split into runs of at most
+    ``max_realizations_per_run`` realizations each. The runs of a group are
+    made equal in size, padding the last one with copies of its final job, so
+    they all share one step function. The runs whose generated code has the
+    same hash are split into up to ``n_processes`` tasks, each run by one 
+    worker, one run after another.
+
+    If ``n_processes`` is 0, the runs are executed in the calling process.
+    """
+    @py.autoinit
+    def __init__(self, n_processes=None, max_realizations_per_run=None): pass
+
+    n_processes = None
+    """The number of worker processes, or None for one per CPU."""
+
+    max_realizations_per_run = None
+    """The maximum number of jobs packed into one run, or None for no
+    limit."""
+
+    def run(self, jobs):
+        """Runs the jobs and returns a list with a :class:`JobResult` for each,
+        in the same order."""
+        jobs = list(jobs)
+        tasks = self.plan(jobs)
+        if self.n_processes == 0:
+            outputs = map(_run_task, tasks)
+        else:
+            pool = multiprocessing.Pool(self.n_processes)
+            try:
+                outputs = pool.map(_run_task, tasks, chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+
+        results = [None] * len(jobs)
+        for output in outputs:
+            for job_idx, result in output:
+                results[job_idx] = result
+        return results
+
+    def plan(self, jobs):
+        """Returns the tasks sent to the workers: lists of runs with the same
+        code hash, each run a tuple ``(run_num, build, collect, shared,
+        params_list, names, job_idxs)``."""
+        n_processes = self.n_processes
+        if n_processes is None:
+            n_processes = multiprocessing.cpu_count()
+        groups = collections.OrderedDict()
+        for job_idx, job in enumerate(jobs):
+            groups.setdefault(job.pack_key, [ ]).append(job_idx)
+
+        tasks = { }
+        task_order = [ ]
+        run_num = 0
+        for job_idxs in groups.itervalues():
+            first = jobs[job_idxs[0]]
+            shared = first.shared or { }
+            n_jobs = len(job_idxs)
+            max_size = self.max_realizations_per_run or n_jobs
+            n_runs = py.int_div_round_up(n_jobs, max_size)
+            run_size = py.int_div_round_up(n_jobs, n_runs)
+
+            code_hash = _build(first.build, shared,
+                               [first.params] * run_size).code_hash
+            if code_hash not in tasks:
+                tasks[code_hash] = [ ]
+                task_order.append(code_hash)
+
+            for start in xrange(0, n_jobs, run_size):
+                run_idxs = job_idxs[start:start + run_size]
+                params_list = [jobs[idx].params for idx in run_idxs]
+                params_list += [params_list[-1]] * (run_size - len(run_idxs))
+                names = [jobs[idx].name if jobs[idx].name is not None else idx
+                         for idx in run_idxs]
+                tasks[code_hash].append((run_num, first.build, first.collect,
+                    shared, params_list, names, run_idxs))
+                run_num += 1
+        split_tasks = [ ]
+        for code_hash in task_order:
+            runs = tasks[code_hash]
+            task_size = py.int_div_round_up(len(runs), max(n_processes, 1))
+            for start in xrange(0, len(runs), task_size):
+                split_tasks.append(runs[start:start + task_size])
+        return split_tasks
+
+def _build(build, shared, params_list):
+    # builds a run with all of its realizations in one division
+    sim = build(shared, params_list)
+    if sim.n_realizations != len(params_list):
+        raise Error("build returned %d realizations for %d parameters." %
+                    (sim.n_realizations, len(params_list)))
+    if sim.finalized:
+        raise Error("build must return an unfinalized simulation.")
+    sim.n_realizations_per_division_max = len(params_list)
+    return sim
+
+def _run_task(task):
+    # Runs in the worker; the step function cache is shared between runs.
+    output = [ ]
+    for run_num, build, collect, shared, params_list, names, job_idxs in task:
+        start = time.time()
+        sim = _build(build, shared, params_list)
+        sim.allocate()
+        code_hash = sim.code_hash
+        compile_start = time.time()
+        sim._step_fn_even #@NoEffect
+        sim._step_fn_odd #@NoEffect
+        run_start = time.time()
+        sim.run()
+        collected = [collect(sim, realization_num)
+                     for realization_num in xrange(len(job_idxs))]
+        sim.release()
+        end = time.time()
+
+        for realization_num, job_idx in enumerate(job_idxs):
+            output.append((job_idx, JobResult(names[realization_num],
+                collected[realization_num], code_hash, run_num,
+                realization_num, len(params_list),
+                compile_start - start, run_start - compile_start,
+                end - run_start)))
+    return output
@@ -0,0 +1,738 @@
+"""Static estimates of the cost of a step, and roofline reports.
+
+:func:`estimate_step_cost` walks the step function generated for a finalized
+simulation and counts the bytes each memory access reads or writes, and the
+arithmetic operations it performs, weighted by how many times each statement
+runs in one timestep of a division. Accesses are attributed to the
+:class:`MemoryNode <cl_egans.MemoryNode>` whose buffer they touch, so the
+traffic of each :class:`State <cl_egans.spiking.State>`, receiver, probe and
+connectivity array can be told apart.
+
+The estimate is static, so some runtime behaviour is assumed:
+
+- Conditions which only depend on the step function's arguments and on
+  element indices, like the branches selecting a model or skipping the updates
+  of slow states, are evaluated for a sample of the elements of the first
+  division and of consecutive timesteps midway through the run, so they are
+  weighted exactly.
+- Branches taken when an element spikes run with ``spike_probability``. Other
+  data-dependent branches run with ``branch_probability``.
+- Loops with bounds which are not known statically, like those over the
+  neighbors of a spiking element, run ``loop_trips`` times.
+- Every subscript is a memory access: caches and the reuse of a value read by
+  several hooks are not modelled. Operations include integer index arithmetic
+  and comparisons, and calls to ``exp``, ``log`` and other transcendental
+  functions are counted separately.
+
+:func:`roofline_report` combines an estimate with a measured run time::
+
+    start = time.time()
+    sim.run()
+    run_time = time.time() - start
+    roofline_report(sim, run_time, peak_bandwidth=192.0,
+                    loop_trips={"i": 100})
+"""
+import ast
+import collections
+import cypy as py
+from cl_egans import Error, MemoryNode, Allocation, LocalAllocation, \
+    _cl_dtype_sizes
+from cl_egans.optimize import _fold_binop, _step_functions
+
+def estimate_step_cost(sim, spike_probability=None, branch_probability=0.5,
+                       loop_trips=1.0):
+    """Returns a :class:`StepCost` estimating the work done by one step of
+    ``sim``, generating its code first if needed.
+
+    ``spike_probability`` is the probability that an element spikes in a
+    timestep, by default that of an element firing at 10 Hz if :data:`DT
+    <cl_egans.Simulation.DT>` is in ms. ``loop_trips`` is the assumed number of
+    iterations of loops whose bounds are not known statically: a number, or a
+    dict from loop variable names to numbers (any other loop runs once).
+    """
+    if sim.simulation_group is not None:
+        raise Error("Cannot estimate the cost of a member of a group.")
+    if not sim.generated:
+        sim.generate()
+    if spike_probability is None:
+        spike_probability = min(0.01 * sim.DT, 1.0)
+    walker = _CostWalker(sim, spike_probability, branch_probability,
+                         loop_trips)
+    walker.walk(sim.code)
+    return StepCost(sim, walker.accesses, walker.n_ops, walker.n_special)
+
+class StepCost(object):
+    """An estimate of the memory traffic and arithmetic of one step (i.e. one
+    timestep of one division) of a simulation."""
+    @py.autoinit
+    def __init__(self, sim, accesses, n_ops, n_special): pass
+
+    accesses = None
+    """An ordered dict from buffer names to the :class:`BufferAccesses` of
+    each buffer the step function touches."""
+
+    n_ops = None
+    """The number of arithmetic, comparison and logical operations per step.
+    Operations on vectors count once per lane."""
+
+    n_special = None
+    """The number of calls to transcendental functions per step."""
+
+    @property
+    def n_elements(self):
+        """The number of elements simulated by each step."""
+        return self.sim.n_elms_per_division_max
+
+    @property
+    def bytes_read(self):
+        """Bytes read from global memory per step."""
+        return sum(access.bytes_read for access in self.accesses.itervalues()
+                   if not access.local)
+
+    @property
+    def bytes_written(self):
+        """Bytes written to global memory per step."""
+        return sum(access.bytes_written
+                   for access in self.accesses.itervalues()
+                   if not access.local)
+
+    @property
+    def bytes_total(self):
+        """Bytes moved to and from global memory per step."""
+        return self.bytes_read + self.bytes_written
+
+    @property
+    def local_bytes(self):
+        """Bytes moved to and from local memory per step."""
+        return sum(access.bytes_read + access.bytes_written
+                   for access in self.accesses.itervalues() if access.local)
+
+    @property
+    def bytes_per_element(self):
+        """Bytes moved to and from global memory per element per step."""
+        return self.bytes_total / float(self.n_elements)
+
+    @property
+    def ops_per_element(self):
+        """Operations per element per step."""
+        return self.n_ops / float(self.n_elements)
+
+    @property
+    def arithmetic_intensity(self):
+        """Operations per byte of global memory traffic."""
+        if not self.bytes_total:
+            return float('inf')
+        return self.n_ops / self.bytes_total
+
+    def by_owner(self):
+        """Returns an ordered dict from the class names of the nodes owning
+        buffers (e.g. ``State`` or ``AtomicReceiver``) to the bytes moved to
+        and from global memory per step in their buffers."""
+        totals = collections.OrderedDict()
+        for access in self.accesses.itervalues():
+            if not access.local:
+                kind = access.owner_kind
+                totals[kind] = totals.get(kind, 0.0) + access.bytes_total
+        return totals
+
+    def print_summary(self):
+        """Prints a plain text summary of the estimate."""
+        n = float(self.n_elements)
+        print "=== Step cost estimate: %d elements per step ===" % \
+            self.n_elements
+        for access in sorted(self.accesses.itervalues(),
+                             key=lambda access: -access.bytes_total):
+            print "%40s: %9.2f B read, %9.2f B written per element%s [%s]" % (
+                access.name, access.bytes_read / n, access.bytes_written / n,
+                " (local)" if access.local else "", access.owner_kind)
+        for kind, total in self.by_owner().iteritems():
+            print "%40s: %9.2f B per element" % (kind, total / n)
+        print "%40s: %9.2f B read, %9.2f B written per element" % ("TOTAL",
+            self.bytes_read / n, self.bytes_written / n)
+        print "%40s: %9.2f ops, %.2f transcendental per element" % (
+            "arithmetic", self.n_ops / n, self.n_special / n)
+        print "%40s: %9.3f ops/B" % ("arithmetic intensity",
+                                     self.arithmetic_intensity)
+
+class BufferAccesses(object):
+    """The estimated accesses to one buffer per step."""
+    def __init__(self, node, element_size, local):
+        self.node = node
+        self.element_size = element_size
+        self.local = local
+        self.bytes_read = 0.0
+        self.bytes_written = 0.0
+        self.n_atomics = 0.0
+
+    node = None
+    """The :class:`MemoryNode <cl_egans.MemoryNode>` of the buffer."""
+
+    element_size = None
+    """The size of an element of the buffer in bytes."""
+
+    local = None
+    """Whether the buffer is in local memory."""
+
+    bytes_read = None
+    """Bytes read per step."""
+
+    bytes_written = None
+    """Bytes written per step."""
+
+    n_atomics = None
+    """Atomic operations on the buffer per step."""
+
+    @property
+    def name(self):
+        return self.node.name
+
+    @property
+    def bytes_total(self):
+        return self.bytes_read + self.bytes_written
+
+    @property
+    def owner_kind(self):
+        """The class name of the node owning the buffer."""
+        owner = self.node.parent
+        if owner is None or owner is self.node.sim:
+            owner = self.node
+        return type(owner).__name__
+
+def roofline_report(sim, run_time, cost=None, peak_bandwidth=None,
+                    peak_gops=None, **cost_options):
+    """Prints a roofline report for a run of ``sim`` on ``sim.ctx.device``
+    which took ``run_time`` seconds, and returns the :class:`Roofline`.
+
+    ``cost`` is a :class:`StepCost`, by default estimated by calling
+    :func:`estimate_step_cost` with ``cost_options``. ``peak_bandwidth`` is the
+    device's global memory bandwidth in GB/s, which OpenCL cannot report, and
+    ``peak_gops`` its peak operation rate in Gop/s, by default estimated by
+    :func:`estimate_peak_gops`. Without a peak bandwidth, only the achieved
+    rates are reported.
+    """
+    if cost is None:
+        cost = estimate_step_cost(sim, **cost_options)
+    if peak_gops is None:
+        peak_gops = estimate_peak_gops(sim.ctx.device)
+    roofline = Roofline(cost, run_time / n_steps_per_run(sim), peak_bandwidth,
+                        peak_gops)
+    roofline.print_summary()
+    return roofline
+
+def n_steps_per_run(sim):
+    """The number of steps :meth:`Simulation.run <cl_egans.Simulation.run>`
+    launches, including the burn-in."""
+    n_burn_in = sim.n_burn_in_timesteps
+    return n_burn_in + sim.n_divisions * (sim.n_timesteps - n_burn_in)
+
+def estimate_peak_gops(device):
+    """Estimates the peak operation rate of an OpenCL device in Gop/s from its
+    compute units, clock frequency and preferred float vector width, counting
+    a fused multiply-add as two operations, or returns None if the device does
+    not report them."""
+    n_units = getattr(device, "max_compute_units", None)
+    clock = getattr(device, "max_clock_frequency", None) # MHz
+    if not n_units or not clock:
+        return None
+    width = getattr(device, "preferred_vector_width_float", None) or 1
+    return n_units * clock * width * 2 / 1000.0
+
+class Roofline(object):
+    """A :class:`StepCost` combined with a measured step time and the peaks of
+    the device."""
+    @py.autoinit
+    def __init__(self, cost, step_time, peak_bandwidth=None,
+                 peak_gops=None): pass
+
+    cost = None
+    """The :class:`StepCost` of the simulation."""
+
+    step_time = None
+    """The measured seconds per step."""
+
+    peak_bandwidth = None
+    """The device's global memory bandwidth in GB/s, or None if unknown."""
+
+    peak_gops = None
+    """The device's peak operation rate in Gop/s, or None if unknown."""
+
+    @property
+    def achieved_bandwidth(self):
+        """The achieved global memory bandwidth in GB/s."""
+        return self.cost.bytes_total / self.step_time / 1e9
+
+    @property
+    def achieved_gops(self):
+        """The achieved operation rate in Gop/s."""
+        return self.cost.n_ops / self.step_time / 1e9
+
+    @property
+    def ridge_point(self):
+        """The arithmetic intensity, in ops/B, above which the device is
+        compute-bound, or None if a peak is unknown."""
+        if self.peak_bandwidth is None or self.peak_gops is None:
+            return None
+        return self.peak_gops / self.peak_bandwidth
+
+    @property
+    def bound(self):
+        """``"memory"`` or ``"compute"``, or None if a peak is unknown."""
+        ridge_point = self.ridge_point
+        if ridge_point is None:
+            return None
+        if self.cost.arithmetic_intensity < ridge_point:
+            return "memory"
+        return "compute"
+
+    @property
+    def attainable_gops(self):
+        """The operation rate the roofline allows at the step's arithmetic
+        intensity, in Gop/s, or None if the peak bandwidth is unknown."""
+        if self.peak_bandwidth is None:
+            return None
+        gops = self.cost.arithmetic_intensity * self.peak_bandwidth
+        if self.peak_gops is not None:
+            gops = min(gops, self.peak_gops)
+        return gops
+
+    @property
+    def efficiency(self):
+        """The achieved fraction of the attainable operation rate, or None if
+        it is unknown."""
+        attainable_gops = self.attainable_gops
+        if not attainable_gops:
+            return None
+        return self.achieved_gops / attainable_gops
+
+    def print_summary(self):
+        """Prints the estimate followed by the roofline."""
+        cost = self.cost
+        cost.print_summary()
+        print "=== Roofline for simulation running on", \
+            cost.sim.ctx.device.name, "==="
+        print "%40s: %9.3f ms" % ("step time", self.step_time * 1000.0)
+        print "%40s: %9.3f GB/s%s" % ("achieved bandwidth",
+            self.achieved_bandwidth, _of(self.peak_bandwidth, "GB/s"))
+        print "%40s: %9.3f Gop/s%s" % ("achieved arithmetic",
+            self.achieved_gops, _of(self.peak_gops, "Gop/s"))
+        if self.ridge_point is not None:
+            print "%40s: %9.3f ops/B" % ("ridge point", self.ridge_point)
+            print "%40s: %s-bound" % ("bound", self.bound)
+        if self.efficiency is not None:
+            print "%40s: %9.3f Gop/s (%.1f%% achieved)" % ("attainable",
+                self.attainable_gops, 100.0 * self.efficiency)
+
+################################################################################
+# Internals
+################################################################################
+def _of(peak, units):
+    if peak is None:
+        return ""
+    return " of %.3f %s peak" % (peak, units)
+
+_max_samples = 1024 # element indices tried when evaluating conditions
+
+_n_timestep_samples = 64 # timesteps tried when evaluating conditions
+
+_special_functions = set(("exp", "log", "sqrt", "pow", "sin", "cos", "tanh",
+                          "exp2", "log2", "rsqrt"))
+
+class _Unknown(Exception):
+    pass
+
+def _evaluate(node, env):
+    # evaluates an expression over known names with C semantics, raising
+    # _Unknown if it depends on anything else
+    if isinstance(node, ast.Num):
+        return node.n
+    if isinstance(node, ast.Name):
+        if node.id in env:
+            return env[node.id]
+        if node.id in ("True", "False"):
+            return node.id == "True"
+        raise _Unknown()
+    if isinstance(node, ast.BinOp):
+        value = _fold_binop(node.op, _evaluate(node.left, env),
+                            _evaluate(node.right, env))
+        if value is None:
+            raise _Unknown()
+        return value
+    if isinstance(node, ast.UnaryOp):
+        operand = _evaluate(node.operand, env)
+        if isinstance(node.op, ast.USub):
+            return -operand
+        if isinstance(node.op, ast.Not):
+            return not operand
+        if isinstance(node.op, ast.UAdd):
+            return operand
+        raise _Unknown()
+    if isinstance(node, ast.Compare):
+        left = _evaluate(node.left, env)
+        for op, comparator in zip(node.ops, node.comparators):
+            right = _evaluate(comparator, env)
+            if not _compare(op, left, right):
+                return False
+            left = right
+        return True
+    if isinstance(node, ast.BoolOp):
+        values = [_evaluate(value, env) for value in node.values]
+        if isinstance(node.op, ast.And):
+            return all(values)
+        return any(values)
+    if isinstance(node, ast.IfExp):
+        if _evaluate(node.test, env):
+            return _evaluate(node.body, env)
+        return _evaluate(node.orelse, env)
+    if (isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and
+            node.func.id in ("min", "max") and len(node.args) == 2):
+        args = [_evaluate(arg, env) for arg in node.args]
+        return min(args) if node.func.id == "min" else max(args)
+    if (isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and
+            node.func.id in env):
+        return env[node.func.id] # e.g. get_global_id(0)
+    raise _Unknown()
+
+def _compare(op, left, right):
+    if isinstance(op, ast.Lt):
+        return left < right
+    if isinstance(op, ast.LtE):
+        return left <= right
+    if isinstance(op, ast.Gt):
+        return left > right
+    if isinstance(op, ast.GtE):
+        return left >= right
+    if isinstance(op, ast.Eq):
+        return left == right
+    if isinstance(op, ast.NotEq):
+        return left != right
+    raise _Unknown()
+
+def _try_evaluate(node, env):
+    try:
+        return _evaluate(node, env)
+    except (_Unknown, ZeroDivisionError, TypeError):
+        return _unknown
+
+_unknown = object()
+
+def _is_spike_branch(stmt):
+    # SpikingModel.in_spike_processing ends both of its branches with a pass
+    # in case no hook writes code into them
+    return (stmt.orelse and isinstance(stmt.body[-1], ast.Pass) and
+            isinstance(stmt.orelse[-1], ast.Pass))
+
+def _call_name(node):
+    if isinstance(node, ast.Call) and isinstance(node.func, ast.Name):
+        return node.func.id
+    return None
+
+def _vector_size(name, prefix):
+    if name is not None and name.startswith(prefix):
+        size = name[len(prefix):]
+        if size.isdigit():
+            return int(size)
+    return None
+
+class _CostWalker(object):
+    def __init__(self, sim, spike_probability, branch_probability,
+                 loop_trips):
+        self.sim = sim
+        self.spike_probability = spike_probability
+        self.branch_probability = branch_probability
+        self.loop_trips = loop_trips
+        self.vector_width = sim.vector_width
+        self.n_work_items = sim.n_work_items
+
+        self.buffers = { }
+        for node in sim._iter_nodes():
+            if isinstance(node, MemoryNode):
+                self.buffers[node.name] = node
+        self.accesses = collections.OrderedDict()
+        self.aliases = { }
+        self.vectors = set()
+        self.n_ops = 0.0
+        self.n_special = 0.0
+
+    def walk(self, code):
+        fn = _step_functions(ast.parse(code))[0]
+        # the first work item of the first division, at consecutive timesteps
+        # midway through the run
+        n_timesteps = self.sim.n_timesteps
+        n = min(n_timesteps, _n_timestep_samples)
+        first = max(min(n_timesteps // 2, n_timesteps - n), 0)
+        envs = [{"timestep": timestep, "realization_start": 0,
+                 "get_global_id": 0, "get_global_size": self.n_work_items}
+                for timestep in xrange(first, first + n)]
+        self.block(fn.body, float(self.n_work_items), envs)
+
+    ############################################################################
+    # Statements
+    ############################################################################
+    def block(self, body, weight, envs):
+        # each env holds the known values for one sampled element, so
+        # conditions on element indices can be weighted by the fraction of
+        # samples satisfying them
+        for stmt in body:
+            envs = self.statement(stmt, weight, envs)
+        return envs
+
+    def statement(self, stmt, weight, envs):
+        if isinstance(stmt, ast.Assign):
+            self.expression(stmt.value, weight)
+            for target in stmt.targets:
+                if isinstance(target, ast.Name):
+                    self.assign(target.id, stmt.value, envs)
+                else:
+                    self.expression(target, weight)
+        elif isinstance(stmt, ast.AugAssign):
+            self.expression(stmt.value, weight)
+            self.operation(stmt, weight)
+            if isinstance(stmt.target, ast.Subscript):
+                self.access(stmt.target.value, weight, read=1, written=1)
+                self.expression(stmt.target.slice, weight)
+            elif isinstance(stmt.target, ast.Name):
+                for env in envs:
+                    env.pop(stmt.target.id, None)
+        elif isinstance(stmt, ast.Expr):
+            self.expression(stmt.value, weight)
+        elif isinstance(stmt, ast.If):
+            return self.branch(stmt, weight, envs)
+        elif isinstance(stmt, ast.For):
+            return self.for_loop(stmt, weight, envs)
+        elif isinstance(stmt, ast.While):
+            trips = self.trips(None)
+            self.expression(stmt.test, weight * (trips + 1))
+            envs = self.forget(stmt.body, envs)
+            self.block(stmt.body, weight * trips, envs)
+        return envs
+
+    def assign(self, name, value, envs):
+        for env in envs:
+            result = _try_evaluate(value, env)
+            if result is _unknown:
+                env.pop(name, None)
+            else:
+                env[name] = result
+        pointed = self.pointed_buffers(value)
+        if pointed:
+            self.aliases[name] = pointed
+        else:
+            self.aliases.pop(name, None)
+        if self.is_vector(value):
+            self.vectors.add(name)
+        else:
+            self.vectors.discard(name)
+
+    def forget(self, body, envs):
+        # values assigned in a block are unknown after it runs an unknown
+        # number of times
+        names = set(n.id for stmt in body for n in ast.walk(stmt)
+                    if isinstance(n, ast.Name) and
+                    isinstance(n.ctx, ast.Store))
+        return [dict((k, v) for k, v in env.iteritems() if k not in names)
+                for env in envs]
+
+    def branch(self, stmt, weight, envs):
+        self.expression(stmt.test, weight)
+        results = [_try_evaluate(stmt.test, env) for env in envs]
+        if _unknown not in results:
+            taken = [env for env, result in zip(envs, results) if result]
+            not_taken = [env for env, result in zip(envs, results)
+                         if not result]
+            fraction = len(taken) / float(len(envs))
+            if taken:
+                taken = self.block(stmt.body, weight * fraction, taken)
+            if not_taken:
+                not_taken = self.block(stmt.orelse, weight * (1 - fraction),
+                                       not_taken)
+            return taken + not_taken
+
+        p = self.probability(stmt)
+        self.block(stmt.body, weight * p, [dict(env) for env in envs])
+        self.block(stmt.orelse, weight * (1 - p), [dict(env) for env in envs])
+        return self.forget(stmt.body + stmt.orelse, envs)
+
+    def probability(self, stmt):
+        p = self.spike_probability
+        any_p = 1.0 - (1.0 - p) ** self.vector_width
+        if _is_spike_branch(stmt):
+            return p
+        if _call_name(stmt.test) == "any":
+            return any_p # some lane of a vector spiked
+        for n in ast.walk(stmt.test):
+            if (isinstance(n, ast.Name) and n.id in self.buffers and
+                    self.buffers[n.id].basename == "spike_mask"):
+                return p / any_p if any_p else 0.0 # a lane which spiked
+        return self.branch_probability
+
+    def for_loop(self, stmt, weight, envs):
+        if not (isinstance(stmt.target, ast.Name) and
+                isinstance(stmt.iter, ast.Tuple) and len(stmt.iter.elts) == 3):
+            trips = self.trips(None)
+            self.block(stmt.body, weight * trips, self.forget(stmt.body, envs))
+            return self.forget(stmt.body, envs)
+        name = stmt.target.id
+        start, stop, step = stmt.iter.elts
+        if isinstance(step, ast.Name) and step.id == "gsize":
+            # a grid-stride loop: all work items together cover the range
+            # once, taking gid = 0 for the start
+            bounds = set((_try_evaluate(start, env), _try_evaluate(stop, env))
+                         for env in envs)
+            if len(bounds) == 1 and _unknown not in list(bounds)[0]:
+                first, last = bounds.pop()
+                n = max(last - first, 0)
+                self.expression(stop, weight)
+                if not n:
+                    return envs
+                n_samples = min(n, _max_samples)
+                samples = [dict(envs[i % len(envs)],
+                                **{name: first + i * n // n_samples})
+                           for i in xrange(n_samples)]
+                self.block(stmt.body, weight * n / self.n_work_items, samples)
+                return self.forget(stmt.body, envs)
+
+        trip_counts = [ ]
+        for env in envs:
+            values = [_try_evaluate(bound, env) for bound in (start, stop, step)]
+            if _unknown in values or values[2] <= 0:
+                break
+            trip_counts.append(max(py.int_div_round_up(values[1] - values[0],
+                                                       values[2]), 0))
+        if envs and len(trip_counts) == len(envs):
+            trips = sum(trip_counts) / float(len(envs))
+            if sum(trip_counts) <= _max_samples:
+                # unroll the samples so conditions on the loop variable are
+                # also evaluated
+                inner = [ ]
+                for env, n in zip(envs, trip_counts):
+                    first = _evaluate(start, env)
+                    step_value = _evaluate(step, env)
+                    for i in xrange(n):
+                        inner.append(dict(env, **{name: first +
+                                                  i * step_value}))
+                if inner:
+                    self.expression(stmt.iter, weight * (trips + 1))
+                    self.block(stmt.body, weight * trips, inner)
+                return self.forget(stmt.body, envs)
+        else:
+            trips = self.trips(name)
+        self.expression(stmt.iter, weight * (trips + 1))
+        inner = self.forget(stmt.body + [stmt.target], envs)
+        self.block(stmt.body, weight * trips, inner)
+        return self.forget(stmt.body, envs)
+
+    def trips(self, name):
+        loop_trips = self.loop_trips
+        if isinstance(loop_trips, dict):
+            return float(loop_trips.get(name, 1.0))
+        return float(loop_trips)
+
+    ############################################################################
+    # Expressions
+    ############################################################################
+    def expression(self, node, weight):
+        if not weight:
+            return
+        if isinstance(node, ast.Subscript):
+            self.access(node.value, weight,
+                        read=isinstance(node.ctx, ast.Load),
+                        written=isinstance(node.ctx, ast.Store))
+            self.expression(node.slice, weight)
+            return
+        if isinstance(node, ast.Call):
+            self.call(node, weight)
+            return
+        if isinstance(node, (ast.BinOp, ast.UnaryOp, ast.Compare, ast.BoolOp,
+                             ast.IfExp)):
+            self.operation(node, weight)
+        for child in ast.iter_child_nodes(node):
+            self.expression(child, weight)
+
+    def operation(self, node, weight):
+        if isinstance(node, ast.Compare):
+            n = len(node.ops)
+        elif isinstance(node, ast.BoolOp):
+            n = len(node.values) - 1
+        else:
+            n = 1
+        self.n_ops += n * weight * self.width(node)
+
+    def call(self, node, weight):
+        name = _call_name(node)
+        args = node.args
+        load_size = _vector_size(name, "vload")
+        store_size = _vector_size(name, "vstore")
+        if load_size is not None and len(args) == 2:
+            self.access(args[1], weight, read=load_size)
+        elif store_size is not None and len(args) == 3:
+            self.access(args[2], weight, written=store_size)
+        elif name is not None and name.startswith("atom_") and args:
+            self.access(args[0], weight, read=1, written=1, atomic=True)
+        else:
+            if name in _special_functions:
+                self.n_special += weight * self.width(node)
+            elif name in ("min", "max", "select"):
+                self.operation(node, weight)
+            for arg in args:
+                if isinstance(arg, ast.Name) and arg.id in self.buffers:
+                    # passed to a helper, like the state of the RNG
+                    self.access(arg, weight, read=1, written=1)
+                else:
+                    self.expression(arg, weight)
+            return
+        for arg in args:
+            self.expression(arg, weight)
+
+    def access(self, pointer, weight, read=0, written=0, atomic=False):
+        buffers = self.pointed_buffers(pointer)
+        if not buffers:
+            return
+        share = weight / len(buffers)
+        for name in buffers:
+            accesses = self.accesses.get(name)
+            if accesses is None:
+                accesses = self.accesses[name] = self.buffer_accesses(name)
+            size = accesses.element_size
+            accesses.bytes_read += share * read * size
+            accesses.bytes_written += share * written * size
+            if atomic:
+                accesses.n_atomics += share
+
+    def buffer_accesses(self, name):
+        node = self.buffers[name]
+        if isinstance(node, (Allocation, LocalAllocation)):
+            cl_dtype = node.args[1]
+            size = _cl_dtype_sizes.get(cl_dtype.name, 4)
+        else:
+            size = node.args[0].dtype.itemsize
+        return BufferAccesses(node, size, isinstance(node, LocalAllocation))
+
+    def pointed_buffers(self, node):
+        # the buffers a pointer expression like target + offset + neighbors[i]
+        # may point into, ignoring any indices read from memory
+        if isinstance(node, ast.Name):
+            if node.id in self.buffers:
+                return (node.id,)
+            return self.aliases.get(node.id, ())
+        if isinstance(node, ast.BinOp):
+            return self.pointed_buffers(node.left) or \
+                self.pointed_buffers(node.right)
+        if isinstance(node, ast.IfExp):
+            buffers = self.pointed_buffers(node.body)
+            return buffers + tuple(name for name in
+                                   self.pointed_buffers(node.orelse)
+                                   if name not in buffers)
+        return ()
+
+    def is_vector(self, node):
+        for n in ast.walk(node):
+            if isinstance(n, ast.Name) and n.id in self.vectors:
+                return True
+            if _vector_size(_call_name(n), "vload") is not None:
+                return True
+        return False
+
+    def width(self, node):
+        if self.vector_width > 1 and self.is_vector(node):
+            return self.vector_width
+        return 1
@@ -0,0 +1,292 @@
+"""Packs several independent simulations into a single kernel launch.
+
+Small networks, like the 302-neuron C. elegans circuit, fill only a fraction of
+a device, and :data:`Simulation.n_realizations
+<cl_egans.Simulation.n_realizations>` only replicates one tree. A
+:class:`SimulationGroup` instead concatenates the element ranges of several
+different :class:`Simulation <cl_egans.Simulation>` trees and generates one
+step function which updates all of them, so each timestep is a single launch::
+
+    sim_a = Simulation(ctx, name_prefix="a_", n_realizations=16,
+                       n_realizations_per_division_max=16)
+    ...
+    sim_b = Simulation(ctx, name_prefix="b_", n_realizations=4,
+                       n_realizations_per_division_max=4)
+    ...
+    group = SimulationGroup([sim_a, sim_b])
+    group.allocate()
+    group.run()
+
+Each member keeps its own index range, constants, allocations and probes, and
+its hooks are triggered as if it had been run on its own. Members must:
+
+- be bound to the same context and run for the same number of timesteps,
+- have distinct :data:`Simulation.name_prefix
+  <cl_egans.Simulation.name_prefix>` values, so their constants do not clash,
+- run all of their realizations in a single division, without a burn-in.
+
+:class:`TerminationCondition <cl_egans.TerminationCondition>` flags are
+written as usual but not polled, and checkpointing is not supported. Local
+variables in the generated code are shared between the members' branches, so
+models which give the same local variable different types cannot be grouped.
+"""
+import collections
+import hashlib
+import numpy
+import cypy as py
+import cypy.cg as cg
+import cl_egans
+from cl_egans import Error, Simulation, opencl_backend, clq, clqcl
+
+class SimulationGroup(object):
+    """A set of simulations run by one step function.
+
+    The members are finalized, allocated, generated and run together; see the
+    corresponding methods of :class:`Simulation <cl_egans.Simulation>`.
+    """
+    @py.autoinit
+    def __init__(self, members): pass
+
+    members = None
+    """The sequence of :class:`Simulation <cl_egans.Simulation>` instances run
+    together."""
+
+    optimize_code = True
+    """Whether to optimize the generated code. See :mod:`cl_egans.optimize`."""
+
+    ############################################################################
+    # Finalization
+    ############################################################################
+    def finalize(self):
+        """Finalizes every member and checks that they can be grouped.
+
+        Does nothing every time after the first.
+        """
+        if self.finalized:
+            return
+        members = self.members = tuple(self.members)
+        if not members:
+            raise Error("A group needs at least one simulation.")
+
+        first = members[0]
+        for member in members:
+            member.simulation_group = self
+            member.finalize()
+            if member.ctx is not first.ctx:
+                raise Error("Grouped simulations must share a context.")
+            if member.n_timesteps != first.n_timesteps:
+                raise Error("Grouped simulations must have the same "
+                            "n_timesteps.")
+            if member.n_burn_in_timesteps:
+                raise Error("Grouped simulations cannot have a burn-in.")
+            if member.n_divisions != 1:
+                raise Error("Grouped simulations must run in a single "
+                            "division.")
+            if member.vector_width != 1:
+                raise Error("Grouped simulations cannot be vectorized.")
+
+        prefixes = [member.name_prefix for member in members]
+        if len(set(prefixes)) != len(prefixes):
+            raise Error("Grouped simulations need distinct name_prefix "
+                        "values.")
+        self._finalized = True
+
+    @property
+    def finalized(self):
+        """Returns whether :meth:`finalize` has been called yet."""
+        return getattr(self, '_finalized', False)
+
+    @property
+    def member_offsets(self):
+        """The first element index of each member in the group's range."""
+        offsets = [ ]
+        offset = 0
+        for member in self.members:
+            offsets.append(offset)
+            offset += member.n_elms_per_sim
+        return tuple(offsets)
+
+    @property
+    def n_elms(self):
+        """The total number of elements across all members."""
+        return sum(member.n_elms_per_sim for member in self.members)
+
+    ############################################################################
+    # Memory
+    ############################################################################
+    def allocate(self):
+        """Finalizes the group if needed and allocates every member."""
+        self.finalize()
+        for member in self.members:
+            member.allocate()
+
+    def release(self):
+        """Releases every member."""
+        for member in self.members:
+            member.release()
+
+    ############################################################################
+    # Code Generation
+    ############################################################################
+    @property
+    def constants(self):
+        """The union of the members' constants, in the order they are passed
+        to the step function."""
+        constants = collections.OrderedDict()
+        for member in self.members:
+            member._add_builtin_constants()
+            for name, value in member.constants.iteritems():
+                if constants.get(name, value) is not value:
+                    raise Error("Constant %s differs between grouped "
+                                "simulations." % name)
+                constants[name] = value
+        return constants
+
+    def generate(self):
+        """Generates the group's step function, finalizing first if needed.
+
+        The members' element ranges are concatenated and covered by one
+        grid-stride loop. Each member's loop body is generated in a branch of
+        it, with ``idx_sim`` relative to the start of the member's range. The
+        members' "pre_step_kernel_body", "pre_main_loop" and "post_main_loop"
+        hooks are triggered in order outside the loop.
+        """
+        self.finalize()
+        members = self.members
+        constants = self.constants
+
+        g = members[0]._make_code_generator()
+        "def step_fn(" >> g
+        py.join(py.cons(("timestep", "realization_start"),
+                        constants.iterkeys()),
+                ",\n            ") >> g
+        ("):\n", g.tab) >> g
+        for member in members:
+            member.trigger_cg_hook("pre_step_kernel_body", g)
+        """
+        gid = get_global_id(0)
+        gsize = get_global_size(0)
+        """ << g
+        for member in members:
+            member.trigger_cg_hook("pre_main_loop", g)
+
+        g.append("for idx_group in (gid, %d, gsize):\n" % self.n_elms)
+        g.append(g.tab)
+        p = cg.Partitioner(g.append, "idx_group",
+                           min_start=0, max_end=self.n_elms)
+        for member, offset in zip(members, self.member_offsets):
+            p.next(start=offset, end=offset + member.n_elms_per_sim,
+                   code=self._member_loop_body(member, offset))
+        g.append((g.untab, "\n"))
+
+        for member in members:
+            member.trigger_cg_hook("post_main_loop", g)
+
+        code = self.unoptimized_code = g.code
+        if self.optimize_code:
+            code = cl_egans.optimize.optimize(code)
+        self.code = code
+        self._generated = True
+        return code
+
+    @staticmethod
+    def _member_loop_body(member, offset):
+        def code(g):
+            g.append("first_idx_sim = 0\n"
+                     "idx_sim = idx_group - %d\n" % offset)
+            member.trigger_staged_cg_hook("loop_body", g)
+        return code
+
+    @property
+    def generated(self):
+        """Returns whether :meth:`generate` has been called yet."""
+        return getattr(self, "_generated", False)
+
+    @property
+    def code_hash(self):
+        """A SHA-1 hex digest of the generated code."""
+        if not self.generated:
+            self.generate()
+        return hashlib.sha1(self.code).hexdigest()
+
+    @py.lazy(property)
+    def _step_fn_even(self):
+        for member in self.members:
+            member.trigger_staged_hook("prepare_step_fn_even")
+        concrete_fn_args = [opencl_backend(), clqcl.int, clqcl.int]
+        for constant in self.constants.itervalues():
+            concrete_fn_args.append(constant.cl_type)
+
+        generic_fn = self._generic_step_fn
+        key = (self.code_hash, tuple(concrete_fn_args))
+        return Simulation._cached_step_fn(
+            Simulation._concrete_step_fn_cache, key,
+            lambda: generic_fn.compile(*concrete_fn_args))
+
+    @py.lazy(property)
+    def _step_fn_odd(self):
+        for member in self.members:
+            member.trigger_staged_hook("prepare_step_fn_odd")
+        return self._generic_step_fn
+
+    @property
+    def _generic_step_fn(self):
+        return Simulation._cached_step_fn(
+            Simulation._generic_step_fn_cache, self.code_hash,
+            lambda: clq.from_source(self.code))
+
+    @property
+    def n_work_items(self):
+        """Enough work items to cover every member's elements, up to the
+        device limit."""
+        ctx = self.members[0].ctx
+        return min(int(py.ceil_int(self.n_elms / 256.0)*256),
+                   ctx.device.max_work_items)
+
+    ############################################################################
+    # Runtime
+    ############################################################################
+    def run(self):
+        """Runs every member for their common number of timesteps.
+
+        Each member's hooks are triggered as by :meth:`Simulation.run
+        <cl_egans.Simulation.run>` for a single division, with its own
+        :class:`RunInfo <cl_egans.Simulation.RunInfo>` and
+        :class:`TimestepInfo <cl_egans.Simulation.TimestepInfo>`.
+        """
+        self.allocate()
+        members = self.members
+        n_timesteps = members[0].n_timesteps
+        step_fn_even = self._step_fn_even
+        step_fn_odd = self._step_fn_odd
+        realization_start = numpy.int32(0)
+
+        infos = [ ]
+        for member in members:
+            run_info = member.RunInfo(n_timesteps)
+            member.trigger_hook("prepare_run", run_info)
+            timestep_info = member.TimestepInfo(run_info, 0,
+                realization_start, member.n_realizations)
+            member.trigger_hook("on_initialize_memory", timestep_info)
+            infos.append((member, run_info, timestep_info))
+
+        timestep = numpy.int32(0)
+        while timestep < n_timesteps:
+            if timestep % 2 == 0:
+                step_fn_even(timestep, realization_start)
+            else:
+                step_fn_odd(timestep, realization_start)
+
+            for member, run_info, timestep_info in infos:
+                timestep_info.timestep = timestep
+                member._run_position = (0, timestep + 1)
+                member.trigger_hook("on_timestep_complete", timestep_info)
+            timestep += 1
+
+        for member, run_info, timestep_info in infos:
+            member._run_position = (1, 0)
+            member.trigger_hook("on_division_complete", timestep_info)
+
+        members[0].ctx.queue.finish()
+        for member, run_info, timestep_info in infos:
+            member.trigger_hook("on_run_complete", run_info)
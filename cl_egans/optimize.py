@@ -0,0 +1,510 @@
+"""Optimization passes applied to generated cl.oquence code.
+
+Identifier substitution inlines simulation constants directly into the
+generated source, so the step function is full of expressions like
+``0.1/20.0*v`` and ``idx_realization - 0`` and recomputes the same index
+arithmetic in several hooks. The passes here work on the Python abstract syntax
+tree of the generated code:
+
+- :func:`fold_constants` evaluates arithmetic on literals (using C semantics
+  for integer division and remainder) and removes integer identities.
+- :func:`hoist_invariants` moves arithmetic which only depends on the step
+  function's arguments out of the main loop.
+- :func:`eliminate_common_subexpressions` computes repeated pure arithmetic
+  subexpressions once into a temporary.
+
+Only arithmetic over names and literals is ever moved or shared. Calls and
+memory reads are left where they are, since they may have side effects or
+observe writes made in between.
+
+:func:`optimize` runs all of the passes and returns the new source. It is
+called by :meth:`Simulation.generate <cl_egans.Simulation.generate>` unless
+:data:`Simulation.optimize_code <cl_egans.Simulation.optimize_code>` is
+``False``.
+"""
+import ast
+import math
+
+def optimize(code):
+    """Returns an optimized version of the provided step function source."""
+    tree = ast.parse(code)
+    tree = fold_constants(tree)
+    hoist_invariants(tree)
+    eliminate_common_subexpressions(tree)
+    return unparse(tree)
+
+################################################################################
+# Constant Folding
+################################################################################
+def fold_constants(tree):
+    """Folds arithmetic on numeric literals in place and returns the tree."""
+    return ast.fix_missing_locations(_ConstantFolder().visit(tree))
+
+def _is_num(node):
+    return isinstance(node, ast.Num) and not isinstance(node.n, bool)
+
+def _is_int_literal(node, value):
+    return (_is_num(node) and isinstance(node.n, (int, long)) and
+            node.n == value)
+
+def _c_div(a, b):
+    # integer division truncates towards zero in C
+    q = abs(a) // abs(b)
+    if (a < 0) != (b < 0):
+        q = -q
+    return q
+
+def _c_mod(a, b):
+    return a - b*_c_div(a, b)
+
+def _fold_binop(op, a, b):
+    ints = isinstance(a, (int, long)) and isinstance(b, (int, long))
+    if isinstance(op, ast.Add):
+        return a + b
+    if isinstance(op, ast.Sub):
+        return a - b
+    if isinstance(op, ast.Mult):
+        return a * b
+    if isinstance(op, ast.Div):
+        if b == 0:
+            return None
+        return _c_div(a, b) if ints else float(a) / b
+    if isinstance(op, ast.Mod):
+        if not ints or b == 0:
+            return None
+        return _c_mod(a, b)
+    if ints:
+        if isinstance(op, ast.BitAnd):
+            return a & b
+        if isinstance(op, ast.BitOr):
+            return a | b
+        if isinstance(op, ast.BitXor):
+            return a ^ b
+        if isinstance(op, ast.LShift) and b >= 0:
+            return a << b
+        if isinstance(op, ast.RShift) and b >= 0:
+            return a >> b
+    return None
+
+class _ConstantFolder(ast.NodeTransformer):
+    def visit_BinOp(self, node):
+        self.generic_visit(node)
+        left, right, op = node.left, node.right, node.op
+        if _is_num(left) and _is_num(right):
+            value = _fold_binop(op, left.n, right.n)
+            if value is not None and not (isinstance(value, float) and
+                                          (math.isinf(value) or
+                                           math.isnan(value))):
+                return ast.copy_location(ast.Num(n=value), node)
+            return node
+
+        # integer identities don't change the type of the other operand
+        if isinstance(op, (ast.Add, ast.Sub)) and _is_int_literal(right, 0):
+            return left
+        if isinstance(op, ast.Add) and _is_int_literal(left, 0):
+            return right
+        if isinstance(op, (ast.Mult, ast.Div)) and _is_int_literal(right, 1):
+            return left
+        if isinstance(op, ast.Mult) and _is_int_literal(left, 1):
+            return right
+        return node
+
+    def visit_UnaryOp(self, node):
+        self.generic_visit(node)
+        operand = node.operand
+        if _is_num(operand):
+            if isinstance(node.op, ast.USub):
+                return ast.copy_location(ast.Num(n=-operand.n), node)
+            if isinstance(node.op, ast.UAdd):
+                return operand
+        return node
+
+################################################################################
+# Code Motion
+################################################################################
+def _is_pure(node):
+    """Arithmetic over names and literals only."""
+    if isinstance(node, (ast.Name, ast.Num)):
+        return True
+    if isinstance(node, ast.BinOp):
+        return _is_pure(node.left) and _is_pure(node.right)
+    if isinstance(node, ast.UnaryOp):
+        return _is_pure(node.operand)
+    return False
+
+def _is_candidate(node):
+    if isinstance(node, ast.BinOp):
+        return _is_pure(node)
+    if isinstance(node, ast.UnaryOp):
+        return not _is_num(node.operand) and _is_pure(node)
+    return False
+
+def _names_in(node):
+    return set(n.id for n in ast.walk(node) if isinstance(n, ast.Name))
+
+def _assigned_names(node):
+    names = set()
+    for n in ast.walk(node):
+        if isinstance(n, ast.Name) and isinstance(n.ctx, ast.Store):
+            names.add(n.id)
+    return names
+
+def _walk_all_candidates(stmt):
+    """Yields (key, expression) for each candidate expression in stmt."""
+    for n in ast.walk(stmt):
+        if isinstance(n, ast.expr) and _is_candidate(n):
+            yield ast.dump(n), n
+
+class _Replacer(ast.NodeTransformer):
+    def __init__(self, key, name):
+        self.key = key
+        self.name = name
+
+    def visit(self, node):
+        if isinstance(node, ast.expr) and ast.dump(node) == self.key:
+            return ast.copy_location(ast.Name(id=self.name, ctx=ast.Load()),
+                                     node)
+        return ast.NodeTransformer.visit(self, node)
+
+class _TemporaryNamer(object):
+    def __init__(self, tree, prefix):
+        self.used = _names_in(tree)
+        self.prefix = prefix
+        self.count = 0
+
+    def next(self):
+        while True:
+            name = "%s%d" % (self.prefix, self.count)
+            self.count += 1
+            if name not in self.used:
+                self.used.add(name)
+                return name
+
+def _step_functions(tree):
+    return [node for node in tree.body if isinstance(node, ast.FunctionDef)]
+
+def _n_leading_execs(body):
+    n = 0
+    for stmt in body:
+        if not isinstance(stmt, ast.Exec):
+            break
+        n += 1
+    return n
+
+def hoist_invariants(tree, prefix="invariant_"):
+    """Moves arithmetic depending only on never-assigned function arguments out
+    of loops to the top of each function (after any leading ``exec``
+    statements.)"""
+    namer = _TemporaryNamer(tree, prefix)
+    for fn in _step_functions(tree):
+        invariant = set(arg.id for arg in fn.args.args)
+        for stmt in fn.body:
+            invariant -= _assigned_names(stmt)
+
+        hoisted = []
+        loops = [n for n in ast.walk(fn) if isinstance(n, (ast.For, ast.While))]
+        while True:
+            found = None
+            for loop in loops:
+                for key, expr in _walk_all_candidates(loop):
+                    if _names_in(expr) <= invariant:
+                        # smallest first, so larger invariants reuse them
+                        if found is None or len(key) < len(found[0]):
+                            found = (key, expr)
+            if found is None:
+                break
+            name = namer.next()
+            invariant.add(name)
+            key, expr = found
+            hoisted.append(ast.Assign(
+                targets=[ast.Name(id=name, ctx=ast.Store())], value=expr))
+            fn.body = [_Replacer(key, name).visit(stmt) for stmt in fn.body]
+            loops = [n for n in ast.walk(fn)
+                     if isinstance(n, (ast.For, ast.While))]
+
+        if hoisted:
+            n = _n_leading_execs(fn.body)
+            fn.body[n:n] = hoisted
+    ast.fix_missing_locations(tree)
+    return tree
+
+def eliminate_common_subexpressions(tree, prefix="cse_"):
+    """Computes pure arithmetic subexpressions which occur more than once in a
+    block into a temporary, placed before the first statement using them.
+
+    An expression is only shared if none of its names can be reassigned between
+    its first and last use. Expressions used only inside a single nested block
+    are handled within that block, so they aren't computed on paths where they
+    were not needed before.
+    """
+    namer = _TemporaryNamer(tree, prefix)
+    for fn in _step_functions(tree):
+        fn.body = _cse_block(fn.body, namer)
+    ast.fix_missing_locations(tree)
+    return tree
+
+def _cse_block(body, namer):
+    while True:
+        found = _find_common_subexpression(body)
+        if found is None:
+            break
+        key, expr, first, last = found
+        name = _existing_name(body, key, first, last)
+        if name is not None:
+            # the first use already stores it in a variable
+            replacer = _Replacer(key, name)
+            body = body[:first + 1] + [
+                replacer.visit(stmt) for stmt in body[first + 1:]]
+        else:
+            name = namer.next()
+            replacer = _Replacer(key, name)
+            body = body[:first] + [ast.Assign(
+                targets=[ast.Name(id=name, ctx=ast.Store())], value=expr)] + [
+                replacer.visit(stmt) for stmt in body[first:]]
+
+    for stmt in body:
+        for field in ('body', 'orelse'):
+            block = getattr(stmt, field, None)
+            if isinstance(block, list) and block:
+                setattr(stmt, field, _cse_block(block, namer))
+    return body
+
+def _find_common_subexpression(body):
+    occurrences = {}
+    exprs = {}
+    for i, stmt in enumerate(body):
+        for key, expr in _walk_all_candidates(stmt):
+            occurrences.setdefault(key, []).append(i)
+            exprs.setdefault(key, expr)
+
+    best = None
+    for key, stmt_idxs in occurrences.iteritems():
+        if len(stmt_idxs) < 2:
+            continue
+        first, last = stmt_idxs[0], stmt_idxs[-1]
+        if first == last and _is_compound(body[first]):
+            continue # leave it to the nested block
+        if _is_valid(body, exprs[key], first, last):
+            if best is None or len(key) > len(best[0]):
+                best = (key, exprs[key], first, last)
+    return best
+
+def _existing_name(body, key, first, last):
+    stmt = body[first]
+    if (isinstance(stmt, ast.Assign) and len(stmt.targets) == 1 and
+        isinstance(stmt.targets[0], ast.Name) and
+        ast.dump(stmt.value) == key):
+        name = stmt.targets[0].id
+        if name in _names_in(stmt.value):
+            return None
+        for later in body[first + 1:last + 1]:
+            if name in _assigned_names(later):
+                return None
+        return name
+    return None
+
+def _is_compound(stmt):
+    return isinstance(stmt, (ast.If, ast.For, ast.While))
+
+def _is_valid(body, expr, first, last):
+    names = _names_in(expr)
+    assigned = set()
+    if first != last or _is_compound(body[first]):
+        assigned |= _assigned_names(body[first])
+    for stmt in body[first + 1:last]:
+        assigned |= _assigned_names(stmt)
+    if last != first and _is_compound(body[last]):
+        assigned |= _assigned_names(body[last])
+    return not (names & assigned)
+
+################################################################################
+# Unparsing
+################################################################################
+def unparse(tree):
+    """Produces source code from an abstract syntax tree of generated code."""
+    lines = []
+    _Unparser(lines).visit(tree)
+    return "\n".join(lines) + "\n"
+
+_BINOP_PRECEDENCE = {
+    ast.BitOr: (6, "|"), ast.BitXor: (7, "^"), ast.BitAnd: (8, "&"),
+    ast.LShift: (9, "<<"), ast.RShift: (9, ">>"),
+    ast.Add: (10, "+"), ast.Sub: (10, "-"),
+    ast.Mult: (11, "*"), ast.Div: (11, "/"), ast.FloorDiv: (11, "//"),
+    ast.Mod: (11, "%"),
+    ast.Pow: (13, "**"),
+}
+
+_UNARYOP = {ast.USub: "-", ast.UAdd: "+", ast.Invert: "~", ast.Not: "not "}
+
+_CMPOP = {ast.Eq: "==", ast.NotEq: "!=", ast.Lt: "<", ast.LtE: "<=",
+          ast.Gt: ">", ast.GtE: ">=", ast.Is: "is", ast.IsNot: "is not",
+          ast.In: "in", ast.NotIn: "not in"}
+
+class _Unparser(object):
+    def __init__(self, lines):
+        self.lines = lines
+        self.indent = 0
+
+    def line(self, text):
+        self.lines.append("    "*self.indent + text)
+
+    def visit(self, node):
+        return getattr(self, "visit_" + node.__class__.__name__)(node)
+
+    def block(self, body):
+        self.indent += 1
+        for stmt in body:
+            self.visit(stmt)
+        self.indent -= 1
+
+    ## Statements
+    def visit_Module(self, node):
+        for stmt in node.body:
+            self.visit(stmt)
+
+    def visit_FunctionDef(self, node):
+        args = [self.expr(arg) for arg in node.args.args]
+        self.line("def %s(%s):" % (node.name, ",\n            ".join(args)))
+        self.block(node.body)
+
+    def visit_Assign(self, node):
+        targets = " = ".join(self.expr(target) for target in node.targets)
+        self.line("%s = %s" % (targets, self.expr(node.value)))
+
+    def visit_AugAssign(self, node):
+        self.line("%s %s= %s" % (self.expr(node.target),
+                                 _BINOP_PRECEDENCE[type(node.op)][1],
+                                 self.expr(node.value)))
+
+    def visit_Expr(self, node):
+        self.line(self.expr(node.value))
+
+    def visit_Exec(self, node):
+        self.line("exec %s" % self.expr(node.body))
+
+    def visit_Pass(self, node): #@UnusedVariable
+        self.line("pass")
+
+    def visit_Break(self, node): #@UnusedVariable
+        self.line("break")
+
+    def visit_Continue(self, node): #@UnusedVariable
+        self.line("continue")
+
+    def visit_Return(self, node):
+        if node.value is None:
+            self.line("return")
+        else:
+            self.line("return %s" % self.expr(node.value))
+
+    def visit_If(self, node, keyword="if"):
+        self.line("%s %s:" % (keyword, self.expr(node.test)))
+        self.block(node.body)
+        orelse = node.orelse
+        if len(orelse) == 1 and isinstance(orelse[0], ast.If):
+            self.visit_If(orelse[0], "elif")
+        elif orelse:
+            self.line("else:")
+            self.block(orelse)
+
+    def visit_For(self, node):
+        self.line("for %s in %s:" % (self.expr(node.target),
+                                     self.expr(node.iter)))
+        self.block(node.body)
+
+    def visit_While(self, node):
+        self.line("while %s:" % self.expr(node.test))
+        self.block(node.body)
+
+    ## Expressions
+    def expr(self, node, precedence=0):
+        text, own_precedence = getattr(self, "expr_" +
+                                       node.__class__.__name__)(node)
+        if own_precedence < precedence:
+            return "(" + text + ")"
+        return text
+
+    def expr_Name(self, node):
+        return node.id, 100
+
+    def expr_Num(self, node):
+        n = node.n
+        if isinstance(n, float):
+            text = repr(n)
+        else:
+            text = str(n)
+        if n < 0:
+            return text, 12
+        return text, 100
+
+    def expr_Str(self, node):
+        return repr(node.s), 100
+
+    def expr_BinOp(self, node):
+        precedence, op = _BINOP_PRECEDENCE[type(node.op)]
+        if isinstance(node.op, ast.Pow):
+            left = self.expr(node.left, precedence + 1)
+            right = self.expr(node.right, precedence)
+        else:
+            left = self.expr(node.left, precedence)
+            right = self.expr(node.right, precedence + 1)
+        return "%s %s %s" % (left, op, right), precedence
+
+    def expr_UnaryOp(self, node):
+        if isinstance(node.op, ast.Not):
+            return "not " + self.expr(node.operand, 4), 4
+        return _UNARYOP[type(node.op)] + self.expr(node.operand, 12), 12
+
+    def expr_BoolOp(self, node):
+        if isinstance(node.op, ast.And):
+            precedence, op = 3, " and "
+        else:
+            precedence, op = 2, " or "
+        return op.join(self.expr(value, precedence + 1)
+                       for value in node.values), precedence
+
+    def expr_Compare(self, node):
+        parts = [self.expr(node.left, 6)]
+        for op, comparator in zip(node.ops, node.comparators):
+            parts.append(_CMPOP[type(op)])
+            parts.append(self.expr(comparator, 6))
+        return " ".join(parts), 5
+
+    def expr_IfExp(self, node):
+        return "%s if %s else %s" % (self.expr(node.body, 2),
+                                     self.expr(node.test, 2),
+                                     self.expr(node.orelse, 1)), 1
+
+    def expr_Call(self, node):
+        args = [self.expr(arg, 1) for arg in node.args]
+        args.extend("%s=%s" % (keyword.arg, self.expr(keyword.value, 1))
+                    for keyword in node.keywords)
+        return "%s(%s)" % (self.expr(node.func, 100), ", ".join(args)), 100
+
+    def expr_Attribute(self, node):
+        return "%s.%s" % (self.expr(node.value, 100), node.attr), 100
+
+    def expr_Subscript(self, node):
+        return "%s[%s]" % (self.expr(node.value, 100),
+                           self.slice(node.slice)), 100
+
+    def slice(self, node):
+        if isinstance(node, ast.Index):
+            return self.expr(node.value)
+        if isinstance(node, ast.Slice):
+            parts = [self.expr(part) if part is not None else ""
+                     for part in (node.lower, node.upper)]
+            if node.step is not None:
+                parts.append(self.expr(node.step))
+            return ":".join(parts)
+        raise NotImplementedError(node.__class__.__name__)
+
+    def expr_Tuple(self, node):
+        elts = [self.expr(elt, 1) for elt in node.elts]
+        if len(elts) == 1:
+            return "(%s,)" % elts[0], 100
+        return "(%s)" % ", ".join(elts), 100
+
+    def expr_List(self, node):
+        return "[%s]" % ", ".join(self.expr(elt, 1) for elt in node.elts), 100
@@ -0,0 +1,144 @@
+"""A pool of device buffers reused across allocations.
+
+Sweeps often build, run and release many simulations with identical buffer
+shapes. Instead of releasing the buffers of an :class:`Allocation
+<cl_egans.Allocation>` when the simulation is released, a :class:`BufferPool`
+keeps them, bucketed by data type and shape, and hands them out again to the
+next allocation asking for the same shape.
+
+Set :data:`Simulation.buffer_pool <cl_egans.Simulation.buffer_pool>` to use
+one, typically the pool shared by all simulations on a context::
+
+    sim.buffer_pool = BufferPool.for_context(ctx)
+
+Buffers drawn from a pool are not initialized, just like fresh allocations.
+"""
+import collections
+
+class BufferPool(object):
+    """A size-bucketed pool of uninitialized buffers on one context.
+
+    When the pool holds more than ``max_bytes`` (if not None), or a bucket
+    holds more than ``max_buffers_per_bucket`` buffers, the least recently
+    returned buffers are released.
+    """
+    def __init__(self, ctx, max_bytes=None, max_buffers_per_bucket=None):
+        self.ctx = ctx
+        self.max_bytes = max_bytes
+        self.max_buffers_per_bucket = max_buffers_per_bucket
+        self._buckets = collections.OrderedDict()
+        self._keys = { }
+        self.pooled_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    ctx = None
+    """The context the buffers belong to."""
+
+    max_bytes = None
+    """The maximum total size of the buffers held by the pool, or None."""
+
+    max_buffers_per_bucket = None
+    """The maximum number of buffers held for each data type and shape, or
+    None."""
+
+    pooled_bytes = 0
+    """The total size of the buffers currently held by the pool."""
+
+    hits = 0
+    """The number of requests served by a pooled buffer."""
+
+    misses = 0
+    """The number of requests which needed a new buffer."""
+
+    evictions = 0
+    """The number of buffers released to respect the caps."""
+
+    @classmethod
+    def for_context(cls, ctx, **kwargs):
+        """Returns the pool shared by everything using ``ctx``, creating it
+        with the provided keyword arguments if needed."""
+        pool = getattr(ctx, "buffer_pool", None)
+        if pool is None:
+            pool = ctx.buffer_pool = cls(ctx, **kwargs)
+        return pool
+
+    @property
+    def hit_rate(self):
+        """The fraction of requests served by a pooled buffer."""
+        n_requests = self.hits + self.misses
+        if n_requests == 0:
+            return 0.0
+        return float(self.hits) / n_requests
+
+    @property
+    def n_pooled(self):
+        """The number of buffers currently held by the pool."""
+        return sum(len(bucket) for bucket in self._buckets.itervalues())
+
+    def alloc(self, shape, cl_dtype):
+        """Returns a buffer with the provided shape and data type, like
+        ``ctx.alloc``, reusing a pooled one if available."""
+        key = (cl_dtype.name, tuple(shape))
+        bucket = self._buckets.get(key)
+        if bucket:
+            buffer = bucket.pop()
+            if not bucket:
+                del self._buckets[key]
+            self.pooled_bytes -= buffer.size
+            self.hits += 1
+        else:
+            buffer = self.ctx.alloc(shape, cl_dtype)
+            self.misses += 1
+        self._keys[id(buffer)] = key
+        return buffer
+
+    def give_back(self, buffer):
+        """Returns a buffer obtained from :meth:`alloc` to the pool."""
+        key = self._keys.pop(id(buffer))
+        max_bytes = self.max_bytes
+        if max_bytes is not None and buffer.size > max_bytes:
+            buffer.release()
+            self.evictions += 1
+            return
+
+        buckets = self._buckets
+        bucket = buckets.pop(key, [ ])
+        bucket.append(buffer)
+        buckets[key] = bucket # most recently returned bucket is last
+        self.pooled_bytes += buffer.size
+
+        max_buffers_per_bucket = self.max_buffers_per_bucket
+        if max_buffers_per_bucket is not None:
+            while len(bucket) > max_buffers_per_bucket:
+                self._evict(key)
+        if max_bytes is not None:
+            while self.pooled_bytes > max_bytes:
+                self._evict(next(iter(buckets)))
+
+    def _evict(self, key):
+        bucket = self._buckets[key]
+        buffer = bucket.pop(0)
+        if not bucket:
+            del self._buckets[key]
+        self.pooled_bytes -= buffer.size
+        self.evictions += 1
+        buffer.release()
+
+    def clear(self):
+        """Releases every pooled buffer."""
+        for bucket in self._buckets.itervalues():
+            for buffer in bucket:
+                buffer.release()
+        self._buckets.clear()
+        self.pooled_bytes = 0
+
+    def print_summary(self):
+        """Prints the pool's statistics."""
+        print "=== Buffer pool: %d buffers, %.2f MB ===" % (self.n_pooled,
+            self.pooled_bytes / 1024.0 / 1024.0)
+        print "%40s: %d" % ("hits", self.hits)
+        print "%40s: %d" % ("misses", self.misses)
+        print "%40s: %d" % ("evictions", self.evictions)
+        print "%40s: %.2f" % ("hit rate", self.hit_rate)
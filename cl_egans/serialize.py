@@ -0,0 +1,207 @@
+"""Declarative serialization and content hashing of simulation trees.
+
+:func:`to_spec` converts an unfinalized :class:`Simulation
+<cl_egans.Simulation>` tree into a JSON-compatible *spec*: the class and
+attributes of every node, in depth-first order, with references to other
+nodes replaced by their position in that order. :func:`from_spec` rebuilds an
+equivalent tree, e.g. in a worker process, without running the user code that
+built the original. :func:`spec_hash` is a stable hash of a spec, suitable as
+a cache key for compiled kernels or warm-start states.
+
+Attribute values may be numbers, strings, tuples, lists, dicts, numpy arrays,
+cl.oquence types, module-level functions and classes, bound methods of nodes
+in the tree and instances of module-level classes with serializable
+attributes. Lambdas and nested functions cannot be serialized; use a
+descriptor like :class:`Fill <cl_egans.spiking.Fill>` or a module-level
+function instead, e.g. for ``InitializeFromHost.array_producer``.
+
+The context is not serialized: rebuilt trees use the provided context or,
+lazily, the default one.
+"""
+import sys
+import json
+import types
+import base64
+import hashlib
+import numpy
+import clq.backends.opencl as clqcl
+from cl_egans import Error, Node
+
+format_version = "cl_egans.spec/1"
+"""Identifies the layout of specs produced by :func:`to_spec`."""
+
+def to_spec(sim):
+    """Returns the JSON-compatible spec of an unfinalized simulation tree."""
+    if sim.finalized:
+        raise Error("Only unfinalized simulations can be serialized.")
+    nodes = list(_iter_nodes(sim))
+    encoder = _Encoder(dict((id(node), idx)
+                            for idx, node in enumerate(nodes)))
+    return {
+        "format": format_version,
+        "nodes": [{"class": _global_name(type(node)),
+                   "state": encoder.encode_state(node)} for node in nodes]
+    }
+
+def from_spec(spec, ctx=None):
+    """Rebuilds the simulation tree described by a spec and returns its root.
+
+    The root is bound to ``ctx`` if provided.
+    """
+    if spec.get("format") != format_version:
+        raise Error("Unknown spec format: %r" % spec.get("format"))
+    node_specs = spec["nodes"]
+    nodes = [ ]
+    for node_spec in node_specs:
+        cls = _import_global(node_spec["class"])
+        nodes.append(cls.__new__(cls))
+    decoder = _Decoder(nodes)
+    for node, node_spec in zip(nodes, node_specs):
+        node.__dict__.update((str(key), decoder.decode(value))
+                             for key, value in node_spec["state"])
+    sim = nodes[0]
+    sim._ctx = ctx
+    return sim
+
+def spec_hash(spec):
+    """Returns a SHA-1 hex digest of a spec, stable across processes."""
+    canonical = json.dumps(spec, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha1(canonical).hexdigest()
+
+def content_hash(sim):
+    """Returns the :func:`spec_hash` of an unfinalized simulation tree."""
+    return spec_hash(to_spec(sim))
+
+def dumps(sim):
+    """Returns the spec of a simulation tree as a JSON string."""
+    return json.dumps(to_spec(sim), sort_keys=True)
+
+def loads(s, ctx=None):
+    """Rebuilds a simulation tree from a JSON string produced by
+    :func:`dumps`."""
+    return from_spec(json.loads(s), ctx)
+
+################################################################################
+# Internals
+################################################################################
+def _iter_nodes(node):
+    yield node
+    for child in node.children or ():
+        for descendant in _iter_nodes(child):
+            yield descendant
+
+def _global_name(obj):
+    module_name = getattr(obj, "__module__", None)
+    name = getattr(obj, "__name__", None)
+    if module_name is None or name is None:
+        return None
+    module = sys.modules.get(module_name)
+    if getattr(module, name, None) is not obj:
+        return None
+    return "%s:%s" % (module_name, name)
+
+def _import_global(global_name):
+    module_name, name = global_name.split(":")
+    __import__(module_name)
+    return getattr(sys.modules[module_name], name)
+
+_unserialized = frozenset(("_ctx",))
+# Attributes which are reset rather than serialized.
+
+class _Encoder(object):
+    def __init__(self, node_idxs):
+        self.node_idxs = node_idxs
+
+    def encode_state(self, node):
+        state = [ ]
+        for key in sorted(node.__dict__):
+            value = None if key in _unserialized else node.__dict__[key]
+            where = "%s.%s" % (type(node).__name__, key)
+            state.append([key, self.encode(value, where)])
+        return state
+
+    def encode(self, value, where):
+        if isinstance(value, numpy.generic):
+            return {"__scalar__": value.item(), "dtype": value.dtype.str}
+        if value is None or isinstance(value, (bool, int, long, float)):
+            return value
+        if isinstance(value, basestring):
+            return {"__str__": value} if isinstance(value, str) else value
+        if isinstance(value, list):
+            return [self.encode(item, where) for item in value]
+        if isinstance(value, tuple):
+            return {"__tuple__": [self.encode(item, where) for item in value]}
+        if isinstance(value, dict):
+            items = [[self.encode(k, where), self.encode(v, where)]
+                     for k, v in value.iteritems()]
+            items.sort(key=lambda item: json.dumps(item[0], sort_keys=True))
+            return {"__dict__": items}
+        if isinstance(value, Node):
+            try:
+                return {"__node__": self.node_idxs[id(value)]}
+            except KeyError:
+                raise Error("%s refers to a node outside the tree." % where)
+        if isinstance(value, numpy.ndarray):
+            array = numpy.ascontiguousarray(value)
+            return {"__array__": base64.b64encode(array.tostring()),
+                    "dtype": array.dtype.str,
+                    "shape": list(array.shape)}
+        if isinstance(value, types.MethodType) and value.im_self is not None:
+            return {"__method__": self.encode(value.im_self, where),
+                    "name": value.im_func.__name__}
+
+        cl_type_name = getattr(value, "name", None)
+        if (isinstance(cl_type_name, basestring) and
+            getattr(clqcl, cl_type_name, None) is value):
+            return {"__cl_type__": cl_type_name}
+
+        global_name = _global_name(value)
+        if global_name is not None:
+            return {"__global__": global_name}
+        if isinstance(value, (types.FunctionType, types.BuiltinFunctionType,
+                              type, types.ClassType)):
+            raise Error("%s is %r, which is not defined at module level." %
+                        (where, value))
+
+        cls_name = _global_name(type(value))
+        if cls_name is not None and hasattr(value, "__dict__"):
+            return {"__object__": cls_name,
+                    "state": self.encode(value.__dict__, where)}
+        raise Error("Cannot serialize %s: %r" % (where, value))
+
+class _Decoder(object):
+    def __init__(self, nodes):
+        self.nodes = nodes
+
+    def decode(self, value):
+        if isinstance(value, list):
+            return [self.decode(item) for item in value]
+        if not isinstance(value, dict):
+            return value
+        if "__str__" in value:
+            return str(value["__str__"])
+        if "__tuple__" in value:
+            return tuple(self.decode(item) for item in value["__tuple__"])
+        if "__dict__" in value:
+            return dict((self.decode(k), self.decode(v))
+                        for k, v in value["__dict__"])
+        if "__node__" in value:
+            return self.nodes[value["__node__"]]
+        if "__array__" in value:
+            data = base64.b64decode(value["__array__"])
+            array = numpy.frombuffer(data, numpy.dtype(str(value["dtype"])))
+            return array.reshape(value["shape"]).copy()
+        if "__scalar__" in value:
+            return numpy.dtype(str(value["dtype"])).type(value["__scalar__"])
+        if "__method__" in value:
+            return getattr(self.decode(value["__method__"]), value["name"])
+        if "__cl_type__" in value:
+            return getattr(clqcl, value["__cl_type__"])
+        if "__global__" in value:
+            return _import_global(value["__global__"])
+        if "__object__" in value:
+            cls = _import_global(value["__object__"])
+            obj = cls.__new__(cls)
+            obj.__dict__.update(self.decode(value["state"]))
+            return obj
+        raise Error("Unknown spec entry: %r" % value)
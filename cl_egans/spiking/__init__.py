@@ -1,7 +1,8 @@
 """Spiking neural network simulations."""
+import numpy
 import cypy as py
 import clq.backends.opencl as clqcl
-from cl_egans import Node, StandaloneCode, Allocation
+from cl_egans import Node, StandaloneCode, Allocation, Error
 
 class State(Node):
     """A state variable in a spiking model node."""
@@ -14,6 +15,14 @@ class State(Node):
         pass
         
     def pre_finalize(self):
+        update_period = self.update_period
+        if update_period is not None:
+            if not isinstance(update_period, (int, long)) or update_period < 1:
+                raise Error("The update period of %s must be a positive "
+                            "integer." % self.name)
+            if update_period > 1 and not self.using_independent_update:
+                raise Error("%s has an update period but is updated "
+                            "differently when spiking." % self.name)
         self.allocation
         self.code_node = StandaloneCode(self, hook=self.calculations_hook, 
                                         code=self.calculations)
@@ -50,28 +59,137 @@ class State(Node):
         """
         return self.spike_updater == self.no_spike_updater
 
+    update_period = None
+    """The number of timesteps between updates of this state. On timesteps
+    which are a multiple of the period, the state is updated with a step of
+    ``update_period*DT`` (see :data:`DT`). On the others, its update is skipped
+    and it is only written back if inputs changed the value read, so slow
+    state variables cost less memory bandwidth.
+    
+    Only states updated independently of spiking can have a period. If None,
+    the ``update_period`` of the closest ancestor node setting one is used for
+    such states, so it can be set for e.g. every synapse of a model, and 
+    otherwise 1.
+    """
+    
+    @property
+    def period(self):
+        """The update period in use, see :data:`update_period`."""
+        if self.spike_updater is None and self.no_spike_updater is None:
+            return 1 # never updated
+        if self.update_period is not None:
+            return self.update_period
+        if self.using_independent_update:
+            node = self.parent
+            while node is not None:
+                update_period = getattr(node, "update_period", None)
+                if update_period is not None:
+                    return update_period
+                node = node.parent
+        return 1
+    
+    @property
+    def DT(self):
+        """The step this state is updated with, ``period*DT``, substituted for
+        ``DT`` in its updaters and calculations."""
+        return self.sim.DT * self.period
+
 
     reader = "allocation[idx_state]"
     # The string to use to read the state variable.
+    
+    vector_reader = "vload(0, allocation + idx_state)"
+    # The string to use to read the state variables of a batch in vector code.
+    
+    @property
+    def vectorizable(self):
+        # vector code widens scalars using a float vector
+        return self.cl_dtype is clqcl.float
 
     @py.lazy(property)
     def allocation(self):
         """After allocation, this will be the Allocation containing the state."""
-        count = self.model.count * self.sim.n_realizations_per_division_max
-        return Allocation(self, "buffer", (count,), self.cl_dtype)
+        allocation = Allocation(self, "buffer", self._allocation_shape, 
+                                self.cl_dtype)
+        allocation.realization_major = True
+        return allocation
+    
+    def _allocation_shape(self):
+        return (self.model.count * self.sim.n_realizations_per_division_max,)
 
     def in_read_state(self, g):
-        """
-        name = reader
-        """ << g
+        if self.model.vector_code:
+            reader, stored_reader = self.vector_reader, State.vector_reader
+        else:
+            reader, stored_reader = self.reader, State.reader
+        if self.period > 1 and stored_reader in reader:
+            # keep the stored value to tell whether inputs changed it
+            stored = self._stored
+            ("%s = %s\n" % (stored, stored_reader)) << g
+            reader = reader.replace(stored_reader, stored)
+        ("%s = %s\n" % (self.local_name, reader)) << g
+        
+    @property
+    def local_name(self):
+        """The name of the local holding the value of the state in the code 
+        being generated. See :meth:`Model.local_name 
+        <cl_egans.Model.local_name>`."""
+        return self.model.local_name(self.name)
+        
+    @property
+    def _stored(self):
+        # the value of the state in memory, before inputs were added
+        if self.model.vector_code:
+            reader, stored_reader = self.vector_reader, State.vector_reader
+        else:
+            reader, stored_reader = self.reader, State.reader
+        if stored_reader in reader:
+            return self.model.local_name(self.name + "_stored")
+        return stored_reader
 
     def in_independent_state_updates(self, g):
         if self.using_independent_update:
             independent_updater = self.spike_updater
-            if independent_updater is not None:
+            period = self.period
+            if independent_updater is None:
+                pass
+            elif period > 1 and self.model.vector_code:
+                ("""
+                if timestep %% %d == 0:
+                    vstore(vector_zero + (spike_updater), 0, allocation + idx_state)
+                elif any(local_name != %s):
+                    vstore(vector_zero + (local_name), 0, allocation + idx_state)
+                """ % (period, self._stored)) << g
+            elif period > 1:
+                ("""
+                if timestep %% %d == 0:
+                    allocation[idx_state] = spike_updater
+                elif name != %s:
+                    allocation[idx_state] = name
+                """ % (period, self._stored)) << g
+            elif self.model.vector_code:
+                """
+                vstore(vector_zero + (spike_updater), 0, allocation + idx_state)
+                """ << g
+            else:
                 """
                 allocation[idx_state] = spike_updater
                 """ << g
+                
+    def in_vector_state_updates(self, g):
+        # both updates in one, choosing per element whether it spiked
+        if not self.using_independent_update:
+            spike_updater = self.spike_updater
+            no_spike_updater = self.no_spike_updater
+            if spike_updater is None and no_spike_updater is None:
+                return
+            if spike_updater is None:
+                spike_updater = "local_name"
+            if no_spike_updater is None:
+                no_spike_updater = "local_name"
+            ("vstore(select(vector_zero + (%s), vector_zero + (%s), spiked), "
+             "0, allocation + idx_state)\n" % (no_spike_updater, spike_updater)
+             ) >> g
 
     def in_spike_state_updates(self, g):
         if not self.using_independent_update:
@@ -91,7 +209,7 @@ class State(Node):
     
     @property
     def _CG_expression(self):
-        return self.name
+        return self.local_name
     
     def on_initialize_memory(self, timestep_info): #@UnusedVariable
         initializer = self.initializer
@@ -109,8 +227,43 @@ class InitializeFromHost(Node):
     def __init__(self, parent, array_producer, basename="InitializeFromHost"): 
         pass
     
+    vectorizable = True
+    
     def on_finalize(self):
         def initializer(buffer, count):
             self.sim.ctx.memcpy(buffer, 
                 self.array_producer((count,), buffer.infer_dtype(buffer)))
         self.parent.initializer = initializer
+
+class Fill(object):
+    """An ``array_producer`` for :class:`InitializeFromHost` which sets every
+    element to ``value``. Unlike a lambda, it can be serialized by 
+    :mod:`cl_egans.serialize`."""
+    def __init__(self, value):
+        self.value = value
+        
+    def __call__(self, shape, dtype):
+        array = numpy.empty(shape, dtype)
+        array.fill(self.value)
+        return array
+    
+class Tile(object):
+    """An ``array_producer`` for :class:`InitializeFromHost` which repeats 
+    ``values``, one entry per element of the model, in every realization."""
+    def __init__(self, values):
+        self.values = numpy.asarray(values)
+        
+    def __call__(self, shape, dtype):
+        return numpy.resize(self.values, shape).astype(dtype)
+    
+class Uniform(object):
+    """An ``array_producer`` for :class:`InitializeFromHost` which draws each 
+    element uniformly from [low, high), using ``seed`` if provided."""
+    def __init__(self, low, high, seed=None):
+        self.low = low
+        self.high = high
+        self.seed = seed
+        
+    def __call__(self, shape, dtype):
+        random_state = numpy.random.RandomState(self.seed)
+        return random_state.uniform(self.low, self.high, shape).astype(dtype)
@@ -1,22 +1,65 @@
 """Connectivity and communication stuff lives here."""
 
+import numpy
 import cypy as py
 import clq.backends.opencl as clqcl
-import clq.stdlib as clqstd
-from cl_egans import Node, Allocation
+from cl_egans import Node, Allocation, LocalAllocation, ConstantArray, Error, \
+    clqstd
+
+def unpack_neighbor_data(neighbor_data, count):
+    """Returns the list of neighbor index arrays of each of ``count`` elements
+    in packed neighbor data."""
+    neighbor_data = numpy.asarray(neighbor_data)
+    lists = [ ]
+    for src in xrange(count):
+        offset = neighbor_data[src]
+        size = neighbor_data[offset]
+        lists.append(neighbor_data[offset + 1:offset + 1 + size])
+    return lists
+
+def pack_neighbor_lists(neighbor_lists, dtype=numpy.int32):
+    """Packs a list of neighbor index sequences into the jagged layout read by
+    :class:`AtomicSender`: one offset per element, then for each element its
+    number of neighbors followed by their indices."""
+    count = len(neighbor_lists)
+    sizes = [len(neighbors) for neighbors in neighbor_lists]
+    packed = numpy.empty(count + count + sum(sizes), dtype)
+    offset = count
+    for src, neighbors in enumerate(neighbor_lists):
+        packed[src] = offset
+        packed[offset] = sizes[src]
+        packed[offset + 1:offset + 1 + sizes[src]] = neighbors
+        offset += 1 + sizes[src]
+    return packed
 
 class AtomicSender(Node):
-    """Sends spikes using atomic operations."""
+    """Sends spikes using atomic operations.
+    
+    If ``tile_size`` is set, spikes are first accumulated in local memory. 
+    Each work group keeps a tile of ``tile_size`` consecutive targets of each
+    of the ``tile_targets``, starting at ``tile_origin``. Spikes to targets in
+    the tile are added to it using local atomics, and others are sent directly.
+    After the main loop, each work group adds every nonzero entry of its tile 
+    to the target with a single global atomic. This reduces contention on the 
+    global atomics when the elements of a work group send to overlapping 
+    ranges of targets, as with locally clustered connectivity.
+    """
     
     @py.autoinit
     def __init__(self, parent, basename="AtomicSender"): pass
     
+    vectorizable = True # spikes are sent one element at a time
+    
     neighbor_data = None
     """The jagged matrix of neighbor data."""
     
+    source_idx = "idx_realization"
+    """The index of the sending element in ``neighbor_data``. Use 
+    ``"idx_model"`` if the neighbor data only covers this sender's model."""
+    
     neighbors_calculation = staticmethod(lambda g: 
         """
-        neighbors_offset = neighbor_data[idx_realization]
+        neighbors_offset = neighbor_data[source_idx]
         neighbor_size = neighbor_data[neighbors_offset]
         neighbors = neighbor_data + neighbors_offset + 1
         """ << g)
@@ -31,10 +74,87 @@ class AtomicSender(Node):
     int_weight = 1
     """Expression to use to calculate the integer-valued weight for the spike."""
     
+    target_model = None
+    """The model containing the receivers spikes are sent to. Defaults to this
+    sender's model. Neighbor indices are relative to the target model."""
+    
+    @property
+    def target_count(self):
+        """The number of elements per realization in the target model."""
+        target_model = self.target_model
+        if target_model is None:
+            target_model = self.model
+        return target_model.count
+    
+    tile_size = None
+    """The number of targets, per target allocation, in each work group's 
+    local memory tile, or None to send every spike with a global atomic. The 
+    tiles of all ``tile_targets`` must fit in the device's local memory."""
+    
+    tile_targets = None
+    """The target :class:`Allocation <cl_egans.Allocation>` nodes 
+    ``target_calculation`` chooses between, needed if ``tile_size`` is set."""
+    
+    tile_slot_calculation = "0"
+    """Expression for the position in ``tile_targets`` of the allocation 
+    ``target_calculation`` chooses, for example ``"0 if idx_model < 800 else 
+    1"``."""
+    
+    tile_origin = "tile_group*lsize - (tile_size - lsize)/2"
+    """Expression for the index, in the target allocations, of the first 
+    target in the work group's tile. ``tile_group`` is the work group's index
+    and ``lsize`` the number of work items in it. The default centers the tile
+    on the indices of the elements the work group updates first, which suits 
+    senders whose targets are near their own index in the first model."""
+    
+    @property
+    def tiled(self):
+        """Whether spikes are accumulated in local memory first."""
+        return self.tile_size is not None
+    
+    @property
+    def tile_start(self):
+        return self.name + "_tile_start"
+    
+    @py.lazy(property)
+    def tile(self):
+        """The :class:`LocalAllocation <cl_egans.LocalAllocation>` holding the
+        work group's tile of each target allocation, one after the other."""
+        return LocalAllocation(self, "tile", 
+            (len(self.tile_targets) * self.tile_size,), clqcl.int)
+    
+    def pre_finalize(self):
+        if self.tiled:
+            if not self.tile_targets:
+                raise Error("%s needs tile_targets to use a tile." % self.name)
+            self.tile
+            constants = self.sim.constants
+            constants['get_local_id'] = clqcl.get_local_id
+            constants['get_local_size'] = clqcl.get_local_size
+            constants['get_group_id'] = clqcl.get_group_id
+            constants['barrier'] = clqcl.barrier
+            constants['CLK_LOCAL_MEM_FENCE'] = clqcl.CLK_LOCAL_MEM_FENCE
+            
+    def pre_allocate(self):
+        if self.tiled:
+            local_mem_size = self.sim.ctx.device.local_mem_size
+            tile_nbytes = self.n_tile_entries * 4
+            if tile_nbytes > local_mem_size:
+                raise Error("The tile of %s needs %d bytes of local memory but "
+                            "the device only has %d. Reduce tile_size." % 
+                            (self.name, tile_nbytes, local_mem_size))
+    
     def in_spike_propagation(self, g):
         """
         target = target_calculation
+        target_offset = (realization_num - realization_start)*target_count
         neighbors_calculation
+        """ << g
+        if self._tile_active:
+            """
+            tile_offset = (tile_slot_calculation)*tile_size
+            """ << g
+        """
         for i in (0, neighbor_size, i_stride):
         """ << g
         g.tab << g
@@ -42,11 +162,59 @@ class AtomicSender(Node):
         (g.untab, "\n") << g
         
     def in_spike_send(self, g):
-        "atom_add(target + realization_first_idx_div + neighbors[i], int_weight)" >> g
+        if self._tile_active:
+            """
+            tile_idx = target_offset + neighbors[i] - tile_start
+            if tile_idx >= 0 and tile_idx < tile_size:
+                atom_add(tile + tile_offset + tile_idx, int_weight)
+            else:
+                atom_add(target + target_offset + neighbors[i], int_weight)
+            """ << g
+        else:
+            "atom_add(target + target_offset + neighbors[i], int_weight)" >> g
+        
+    _tile_active = False
+    # True while generating the main loop of a tiled sender. Spikes sent 
+    # elsewhere, e.g. received by a HaloExchange after the flush, go directly.
         
     def pre_step_kernel_body(self, g):
         # TODO: remove this once extension inference works
         g << 'exec "' << clqcl.cl_khr_global_int32_base_atomics.pragma_str << '"\n'
+        if self.tiled:
+            g << 'exec "' << clqcl.cl_khr_local_int32_base_atomics.pragma_str << '"\n'
+        
+    def pre_main_loop(self, g):
+        if self.tiled:
+            """
+            lid = get_local_id(0)
+            lsize = get_local_size(0)
+            tile_group = get_group_id(0)
+            tile_start = tile_origin
+            for tile_k in (lid, n_tile_entries, lsize):
+                tile[tile_k] = 0
+            barrier(CLK_LOCAL_MEM_FENCE)
+            """ << g
+            self._tile_active = True
+            
+    @property
+    def n_tile_entries(self):
+        return len(self.tile_targets) * self.tile_size
+        
+    def post_main_loop(self, g):
+        if self.tiled:
+            self._tile_active = False
+            """
+            barrier(CLK_LOCAL_MEM_FENCE)
+            for tile_k in (lid, tile_size, lsize):
+            """ << g
+            g.tab >> g
+            for slot, target in enumerate(self.tile_targets):
+                ("tile_n = %s[%d + tile_k]\n"
+                 "if tile_n != 0:\n" % (self.tile.name, slot*self.tile_size),
+                 g.tab,
+                 "atom_add(%s + tile_start + tile_k, tile_n)\n" % target.name,
+                 g.untab) >> g
+            g.untab >> g
     
 class AtomicReceiver(Node):
     """Receives spikes and converts them into conductance updates. The parent
@@ -60,23 +228,37 @@ class AtomicReceiver(Node):
     reader = "alloc_in[idx_state]"
     """Readout expression"""
     
-    @py.lazy(property)
+    vector_reader = "convert_float(vload(0, alloc_in + idx_state))"
+    """Readout expression in vector code."""
+    
+    gathered = ()
+    """The names of the spike counts gathered for the current element by 
+    :class:`GatherSender` nodes, which are added to the count read. Set by 
+    them."""
+    
+    vectorizable = True
+    
     def _buffer_size(self):
+        # called when the buffers are created, see Allocation
         return (self.model.count * self.sim.n_realizations_per_division_max,)
     
     @py.lazy(property)
     def alloc_in(self):
-        return Allocation(self, "in", self._buffer_size, clqcl.int)
+        allocation = Allocation(self, "in", self._buffer_size, clqcl.int)
+        allocation.realization_major = True
+        return allocation
     
-    @py.lazy(property)
+    @property
     def buffer_in(self):
         return self.alloc_in.buffer
     
     @py.lazy(property)
     def alloc_out(self):
-        return Allocation(self, "out", self._buffer_size, clqcl.int)
+        allocation = Allocation(self, "out", self._buffer_size, clqcl.int)
+        allocation.realization_major = True
+        return allocation
     
-    @py.lazy(property)
+    @property
     def buffer_out(self):
         return self.alloc_out.buffer
     
@@ -98,9 +280,313 @@ class AtomicReceiver(Node):
         target = self.parent.spike_target
         target.reader = "(%s) + (%s*%s)" % (target.reader, str(self.weight), 
                                             self.name)
+        target.vector_reader = "(%s) + (%s*%s)" % (target.vector_reader, 
+            str(self.weight), self.name + self.model.vector_suffix)
         
     def in_read_incoming_spikes(self, g):
+        if self.model.vector_code:
+            """
+            local_name = vector_reader
+            vstore(convert_int(vector_zero), 0, alloc_in + idx_state)
+            """ << g
+        else:
+            """
+            name = reader
+            reader = 0
+            """ << g
+            for gathered in self.gathered:
+                ("%s += %s\n" % (self.name, gathered)) >> g
+                
+    @property
+    def local_name(self):
+        """The name of the local holding the spike count read, see 
+        :meth:`Model.local_name <cl_egans.Model.local_name>`."""
+        return self.model.local_name(self.name)
+
+class GatherSender(Node):
+    """Sends spikes deterministically and without atomic operations.
+    
+    Delivering spikes amounts to sorting (source, target) pairs by target and
+    summing the weights of each target's segment. Since connectivity is fixed,
+    the pairs are sorted once, on the host: a :class:`GatherTarget` added to 
+    the target model holds the sources of each target's incoming connections,
+    in order. Each timestep, every sending element writes ``int_weight`` if it
+    spiked, or 0, to a buffer of its own. In the next timestep, each target 
+    element sums the entries of its sources and adds the sum to its 
+    :class:`AtomicReceiver`. Results are bit-for-bit reproducible and the cost
+    depends on the number of connections, not on the firing rate.
+    
+    Rows of ``neighbor_data`` must be indexed by the sending model's element 
+    index. ``receivers`` lists the receivers in the target model spikes can be
+    sent to, and ``receiver_slots`` gives the position in ``receivers`` of 
+    each sending element's receiver, or None if there is only one.
+    """
+    @py.autoinit
+    def __init__(self, parent, neighbor_data, receivers, receiver_slots=None,
+                 basename="GatherSender"): pass
+    
+    neighbor_data = None
+    """The host array of packed neighbor data (see 
+    :func:`pack_neighbor_lists`)."""
+    
+    receivers = None
+    """The :class:`AtomicReceiver` nodes spikes are sent to."""
+    
+    receiver_slots = None
+    """The index into ``receivers`` of each sending element, or None."""
+    
+    int_weight = 1
+    """Expression to use to calculate the integer-valued weight for the spike."""
+    
+    target_model = None
+    """The model containing the receivers. Defaults to this sender's model."""
+    
+    def _buffer_size(self):
+        return (self.model.count * self.sim.n_realizations_per_division_max,)
+    
+    @py.lazy(property)
+    def spikes_in(self):
+        """The weights sent in the previous timestep."""
+        allocation = Allocation(self, "spikes_in", self._buffer_size, 
+                                clqcl.int)
+        allocation.realization_major = True
+        return allocation
+    
+    @py.lazy(property)
+    def spikes_out(self):
+        """The weights sent in the current timestep."""
+        allocation = Allocation(self, "spikes_out", self._buffer_size, 
+                                clqcl.int)
+        allocation.realization_major = True
+        return allocation
+    
+    def pre_finalize(self):
+        target_model = self.target_model
+        if target_model is None:
+            target_model = self.model
+        for receiver in self.receivers:
+            if receiver.model is not target_model:
+                raise Error("The receivers of %s must be in its target model."
+                            % self.name)
+        self.spikes_in
+        self.spikes_out
+        self.gather_target = GatherTarget(target_model, sender=self)
+        self.pre_finalize_added(self.gather_target)
+        
+    def on_initialize_memory(self, timestep_info): #@UnusedVariable
+        clqstd.ew_set_0(self.spikes_in.buffer)
+        clqstd.ew_set_0(self.spikes_out.buffer)
+        
+    def on_prepare_step_fn_odd(self):
+        # switch out with in on odd timesteps, like AtomicReceiver
+        constants = self.sim.constants
+        spikes_in = self.spikes_in
+        spikes_out = self.spikes_out
+        constants[spikes_in.name] = spikes_out.buffer
+        constants[spikes_out.name] = spikes_in.buffer
+        
+    def in_independent_state_updates(self, g):
         """
-        name = reader
-        reader = 0
+        spikes_out[idx_state] = 0
         """ << g
+        
+    def in_spike_propagation(self, g):
+        """
+        spikes_out[idx_state] = int_weight
+        """ << g
+        
+class GatherTarget(Node):
+    """The receiving side of a :class:`GatherSender`, added by it to its 
+    target model. Sums, for each receiver, the weights sent by the sources of
+    the current element's incoming connections in the previous timestep."""
+    @py.autoinit
+    def __init__(self, parent, sender, basename="GatherTarget"): pass
+    
+    sender = None
+    """The :class:`GatherSender` this is the target of."""
+    
+    @property
+    def source_count(self):
+        return self.sender.model.count
+    
+    @property
+    def spikes_in(self):
+        return self.sender.spikes_in
+    
+    def gathered(self, slot):
+        """The name of the sum gathered for the receiver in ``slot``."""
+        return "%s_gathered_%d" % (self.name, slot)
+    
+    def incoming_arrays(self):
+        """Returns the offsets, one per receiver and element plus one, into the
+        array of incoming sources, sorted by receiver, element and source."""
+        sender = self.sender
+        count = self.model.count
+        n_slots = len(sender.receivers)
+        neighbor_lists = unpack_neighbor_data(sender.neighbor_data, 
+                                              self.source_count)
+        sources = numpy.concatenate([numpy.repeat(src, len(neighbors)) 
+            for src, neighbors in enumerate(neighbor_lists)] + 
+            [numpy.zeros(0, numpy.int32)]).astype(numpy.int32)
+        targets = numpy.concatenate(list(neighbor_lists) + 
+            [numpy.zeros(0, numpy.int32)]).astype(numpy.int32)
+        if sender.receiver_slots is None:
+            slots = numpy.zeros(len(sources), numpy.int32)
+        else:
+            slots = numpy.asarray(sender.receiver_slots, numpy.int32)[sources]
+        
+        order = numpy.lexsort((sources, targets, slots))
+        keys = slots*count + targets
+        offsets = numpy.zeros(n_slots*count + 1, numpy.int32)
+        offsets[1:] = numpy.cumsum(numpy.bincount(keys, 
+                                                  minlength=n_slots*count))
+        return offsets, sources[order]
+        
+    def pre_finalize(self):
+        offsets, sources = self.incoming_arrays()
+        self.incoming_offsets = ConstantArray(self, "incoming_offsets", 
+                                              offsets)
+        # ConstantArrays cannot be empty
+        self.incoming_sources = ConstantArray(self, "incoming_sources", 
+            numpy.concatenate((sources, numpy.zeros(1, numpy.int32))))
+        for slot, receiver in enumerate(self.sender.receivers):
+            receiver.gathered = tuple(receiver.gathered) + (
+                self.gathered(slot),)
+        
+    def pre_read_incoming_spikes(self, g):
+        """
+        gather_first_source = (realization_num - realization_start)*source_count
+        """ << g
+        for slot in xrange(len(self.sender.receivers)):
+            gathered = self.gathered(slot)
+            offset_idx = "%d + idx_model" % (slot*self.model.count)
+            ("%s = 0\n"
+             "for gather_j in (incoming_offsets[%s], incoming_offsets[%s + 1], 1):\n" 
+             % (gathered, offset_idx, offset_idx), g.tab,
+             "%s += spikes_in[gather_first_source + incoming_sources[gather_j]]\n" 
+             % gathered, g.untab) >> g
+            
+def gap_junction_csr(count, pairs, conductances=1.0, dtype=numpy.float32):
+    """Returns the ``(indptr, indices, conductances)`` arrays of the symmetric
+    compressed sparse row coupling matrix of ``count`` elements joined by gap
+    junctions between each ``(i, j)`` pair, for :class:`GapJunctions`.
+    ``conductances`` is a conductance for every pair or a single one for all.
+    """
+    pairs = numpy.asarray(pairs, numpy.int32).reshape((-1, 2))
+    values = numpy.empty(len(pairs), dtype)
+    values[:] = conductances
+    rows = numpy.concatenate((pairs[:, 0], pairs[:, 1]))
+    cols = numpy.concatenate((pairs[:, 1], pairs[:, 0]))
+    values = numpy.concatenate((values, values))
+    order = numpy.lexsort((cols, rows))
+    indptr = numpy.zeros(count + 1, numpy.int32)
+    indptr[1:] = numpy.cumsum(numpy.bincount(rows, minlength=count))
+    return indptr, cols[order], values[order]
+
+class GapJunctions(Node):
+    """Couples the voltages of the elements of a model through gap junctions,
+    adding ``g_gap*(v_j - v_i)`` to the input current of element ``i`` for 
+    each element ``j`` it is coupled to.
+    
+    The coupling is a sparse matrix in compressed sparse row form (see 
+    :func:`gap_junction_csr`), multiplied with the voltages of the previous 
+    timestep. Each element writes its voltage to one of two buffers, which are
+    swapped every timestep, so reading neighbors' voltages does not race with
+    their updates. Coupling therefore starts with the second timestep.
+    
+    If ``conductances`` is None, every junction has conductance ``g_gap``. If 
+    the model integrates its voltage using exponential Euler (see 
+    :class:`GenericIF <cl_egans.spiking.models.GenericIF>`), the junctions
+    contribute to ``input_conductance`` like conductance-based synapses.
+    """
+    @py.autoinit
+    def __init__(self, parent, indptr, indices, conductances=None, 
+                 g_gap=None, basename="GapJunctions"): pass
+    
+    indptr = None
+    """The host array of row offsets into ``indices``, one per element plus 
+    one."""
+    
+    indices = None
+    """The host array of coupled element indices of each row."""
+    
+    conductances = None
+    """The host array of the conductance of each entry of ``indices``, or 
+    None."""
+    
+    g_gap = None
+    """The conductance of every junction if ``conductances`` is None."""
+    
+    conductance_based = True
+    
+    @property
+    def gap_conductance(self):
+        """Expression for the conductance of junction ``gap_k``."""
+        if self.conductances is None:
+            return str(self.g_gap)
+        return "conductance_data[gap_k]"
+    
+    def _buffer_size(self):
+        return (self.model.count * self.sim.n_realizations_per_division_max,)
+    
+    @py.lazy(property)
+    def voltages_in(self):
+        """The voltages of the previous timestep."""
+        allocation = Allocation(self, "voltages_in", self._buffer_size, 
+                                clqcl.float)
+        allocation.realization_major = True
+        return allocation
+    
+    @py.lazy(property)
+    def voltages_out(self):
+        """The voltages of the current timestep."""
+        allocation = Allocation(self, "voltages_out", self._buffer_size, 
+                                clqcl.float)
+        allocation.realization_major = True
+        return allocation
+    
+    def pre_finalize(self):
+        if len(self.indptr) != self.model.count + 1:
+            raise Error("%s needs one row per element of its model." % 
+                        self.name)
+        if self.conductances is None and self.g_gap is None:
+            raise Error("%s needs conductances or g_gap." % self.name)
+        self.indptr_data = ConstantArray(self, "indptr", 
+            numpy.asarray(self.indptr, numpy.int32))
+        self.indices_data = ConstantArray(self, "indices", 
+            numpy.asarray(self.indices, numpy.int32))
+        if self.conductances is not None:
+            self.conductance_data = ConstantArray(self, "conductances",
+                numpy.asarray(self.conductances, numpy.float32))
+        self.voltages_in
+        self.voltages_out
+        
+    def on_prepare_step_fn_odd(self):
+        # switch out with in on odd timesteps, like AtomicReceiver
+        constants = self.sim.constants
+        voltages_in = self.voltages_in
+        voltages_out = self.voltages_out
+        constants[voltages_in.name] = voltages_out.buffer
+        constants[voltages_out.name] = voltages_in.buffer
+        
+    def in_calculate_inputs(self, g):
+        model = self.model
+        """
+        voltages_out[idx_state] = v
+        if timestep > 0:
+            for gap_k in (indptr_data[idx_model], indptr_data[idx_model + 1], 1):
+                gap_v = voltages_in[(realization_num - realization_start)*count + indices_data[gap_k]]
+        """ << g
+        g.tab << g
+        g.tab << g
+        if (getattr(model, 'using_exact_integration', False) and 
+            model.conductance_based):
+            """
+            input_current += gap_conductance*gap_v
+            input_conductance += gap_conductance
+            """ << g
+        else:
+            """
+            input_current += gap_conductance*(gap_v - v)
+            """ << g
+        (g.untab, g.untab, "\n") << g
@@ -0,0 +1,312 @@
+"""Runs a partitioned network in several processes on one machine.
+
+Like a :class:`PartitionedNetwork
+<cl_egans.spiking.partition.PartitionedNetwork>`, a
+:class:`DistributedNetwork` splits a network into contiguous partitions, but
+runs each in its own worker process with its own context (a device, a CPU
+sub-device or a CPU backend). After every step, each worker copies the spikes
+its boundary elements sent into its slot of a shared-memory ring, waits at a
+barrier for the other workers, and then reads the entries its elements receive
+from their slots. The ring has two slots per worker, used on alternate steps,
+so a single barrier per step suffices: a worker cannot overwrite a slot before
+every other worker has passed the next barrier, and so finished reading it.
+
+``build`` and ``collect`` must be defined at module level, and contexts must
+be created in the workers, after they have started. If ``context_factory`` is
+None, each worker uses its default context, :data:`pyocl.ctx`, which is
+created on first use::
+
+    def make_context(rank):
+        return cl.Context.for_device(0, rank)
+
+    def collect(sim):
+        return sim.probe.counts
+
+    network = DistributedNetwork(build, collect, N, cm.packed(), 4,
+                                 context_factory=make_context)
+    results = network.run()
+    network.print_summary(results)
+
+``build`` is also called in the parent process, without a context, to size
+the ring, so it should not touch the device. :func:`scaling_report` runs the
+same network with increasing numbers of processes and prints how the
+communication time grows.
+"""
+import sys
+import time
+import Queue
+import traceback
+import multiprocessing
+import numpy
+import cypy as py
+from cl_egans import Error
+from cl_egans.spiking.partition import (Partition, find_halo, check_lockstep,
+                                        run_partitions)
+
+class DistributedNetwork(object):
+    """Runs a network split into ``n_processes`` contiguous partitions, each in
+    a worker process.
+
+    ``build`` is called with each :class:`Partition
+    <cl_egans.spiking.partition.Partition>` and must return an unfinalized
+    :class:`Simulation <cl_egans.Simulation>` of its elements containing a
+    :class:`HaloExchange <cl_egans.spiking.partition.HaloExchange>` for it,
+    which is bound to the partition's context. ``collect`` is called with the
+    simulation after its run and returns the (picklable) result of the
+    worker.
+
+    If ``boundaries`` is None, the elements are split evenly.
+    """
+    @py.autoinit
+    def __init__(self, build, collect, count, neighbor_data, n_processes,
+                 boundaries=None, context_factory=None): pass
+
+    build = None
+    """The module-level function building the simulation of a partition."""
+
+    collect = None
+    """The module-level function extracting a worker's result."""
+
+    count = None
+    """The number of elements in the whole network."""
+
+    neighbor_data = None
+    """The packed neighbor data of the whole network, with global
+    indices."""
+
+    n_processes = None
+    """The number of worker processes, and so of partitions."""
+
+    boundaries = None
+    """The first global index of each partition followed by ``count``."""
+
+    context_factory = None
+    """A module-level function returning the context of the worker with the
+    provided rank, or None to use the default context."""
+
+    poll_interval = 1.0
+    """The number of seconds between checks, while waiting for results, that
+    no worker has died without reporting one (e.g. killed or crashed in the
+    OpenCL driver)."""
+
+    @py.lazy(property)
+    def partitions(self):
+        """The :class:`Partition <cl_egans.spiking.partition.Partition>` of
+        each worker. Their contexts are set in the workers."""
+        n = self.n_processes
+        boundaries = self.boundaries
+        if boundaries is None:
+            boundaries = [i * self.count // n for i in xrange(n + 1)]
+        return Partition.split(self.neighbor_data, self.count, boundaries,
+                               [None] * n)
+
+    @py.lazy(property)
+    def slot_capacities(self):
+        """The maximum number of entries each worker sends per step, found by
+        building and finalizing every partition's simulation."""
+        sims = [self.build(partition) for partition in self.partitions]
+        check_lockstep(sims)
+        return [find_halo(sim, partition).outgoing_capacity
+                for partition, sim in zip(self.partitions, sims)]
+
+    def run(self):
+        """Runs the network and returns a :class:`WorkerResult` for each
+        worker, in rank order."""
+        n = self.n_processes
+        capacities = self.slot_capacities
+        # two slots per worker, each a count followed by the entries
+        slot_offsets = numpy.cumsum([0] + [1 + capacity
+                                          for capacity in capacities])
+        ring = multiprocessing.RawArray('i', 2 * int(slot_offsets[-1]))
+        barrier = _Barrier(n)
+        results = multiprocessing.Queue()
+
+        workers = [multiprocessing.Process(target=_run_worker,
+            args=(self, rank, ring, slot_offsets, barrier, results))
+            for rank in xrange(n)]
+        for worker in workers:
+            worker.start()
+        outputs = { }
+        try:
+            while len(outputs) < n:
+                try:
+                    rank, output = results.get(timeout=self.poll_interval)
+                except Queue.Empty:
+                    self._check_workers(workers, outputs, barrier)
+                else:
+                    outputs[rank] = output
+        finally:
+            for worker in workers:
+                worker.join()
+
+        failures = [(_aborted_message in outputs[rank], rank)
+                    for rank in xrange(n)
+                    if isinstance(outputs[rank], basestring)]
+        if failures:
+            # report the worker which failed first, not those it aborted
+            rank = min(failures)[1]
+            raise Error("Worker %d failed:\n%s" % (rank, outputs[rank]))
+        return [outputs[rank] for rank in xrange(n)]
+
+    @staticmethod
+    def _check_workers(workers, outputs, barrier):
+        # workers which fail normally report the failure before exiting
+        for rank, worker in enumerate(workers):
+            exitcode = worker.exitcode
+            if rank not in outputs and exitcode not in (None, 0):
+                barrier.abort()
+                raise Error("Worker %d exited with code %d without reporting a"
+                            " result." % (rank, exitcode))
+
+    @staticmethod
+    def print_summary(results):
+        """Prints the timing of each worker."""
+        print "=== Distributed run: %d processes ===" % len(results)
+        for result in results:
+            print "%40s: %.3f s run, %.3f s exchange (%.3f s barrier), " \
+                "%d sent, %d received" % ("worker %d" % result.rank,
+                result.run_time, result.exchange_time, result.barrier_time,
+                result.n_sent, result.n_received)
+
+class WorkerResult(object):
+    """The result of one worker of a :class:`DistributedNetwork`."""
+    @py.autoinit
+    def __init__(self, rank, result, run_time, exchange_time, barrier_time,
+                 n_sent, n_received): pass
+
+    rank = None
+    """The worker's rank, i.e. its partition's index."""
+
+    result = None
+    """The value returned by ``collect``."""
+
+    run_time = None
+    """Seconds spent running, including the exchanges."""
+
+    exchange_time = None
+    """Seconds spent exchanging spikes, including waiting at the barrier."""
+
+    barrier_time = None
+    """Seconds spent waiting at the barrier for the other workers."""
+
+    n_sent = None
+    """The number of entries the worker sent."""
+
+    n_received = None
+    """The number of entries the worker received."""
+
+    @property
+    def communication_fraction(self):
+        """The fraction of the run time spent exchanging spikes."""
+        if not self.run_time:
+            return 0.0
+        return self.exchange_time / self.run_time
+
+def scaling_report(build, collect, count, neighbor_data, process_counts,
+                   context_factory=None):
+    """Runs the network with each number of processes in ``process_counts``,
+    prints the slowest worker's run and exchange times for each and returns
+    the lists of :class:`WorkerResult` instances, in the same order."""
+    print "=== Communication scaling ==="
+    print "%10s %12s %12s %12s %10s" % ("processes", "run (s)",
+        "exchange (s)", "barrier (s)", "fraction")
+    all_results = [ ]
+    for n_processes in process_counts:
+        results = DistributedNetwork(build, collect, count, neighbor_data,
+            n_processes, context_factory=context_factory).run()
+        slowest = max(results, key=lambda result: result.run_time)
+        print "%10d %12.3f %12.3f %12.3f %10.2f" % (n_processes,
+            slowest.run_time, max(result.exchange_time for result in results),
+            max(result.barrier_time for result in results),
+            slowest.communication_fraction)
+        all_results.append(results)
+    return all_results
+
+################################################################################
+# Internals
+################################################################################
+_aborted_message = "Another worker failed."
+
+class _Barrier(object):
+    # A reusable barrier for processes. Breaks for everyone once a worker
+    # fails, so the others do not wait forever.
+    def __init__(self, n):
+        self.n = n
+        self.condition = multiprocessing.Condition()
+        self.state = multiprocessing.RawArray('i', 3) # count, generation, broken
+
+    def wait(self):
+        state = self.state
+        with self.condition:
+            if state[2]:
+                raise Error(_aborted_message)
+            generation = state[1]
+            state[0] += 1
+            if state[0] == self.n:
+                state[0] = 0
+                state[1] += 1
+                self.condition.notify_all()
+                return
+            while state[1] == generation and not state[2]:
+                self.condition.wait()
+            if state[2]:
+                raise Error(_aborted_message)
+
+    def abort(self):
+        with self.condition:
+            self.state[2] = 1
+            self.condition.notify_all()
+
+def _run_worker(network, rank, ring, slot_offsets, barrier, results):
+    try:
+        results.put((rank, _run_partition(network, rank, ring, slot_offsets,
+                                          barrier)))
+    except:
+        barrier.abort()
+        results.put((rank, "".join(traceback.format_exception(
+            *sys.exc_info()))))
+
+def _run_partition(network, rank, ring, slot_offsets, barrier):
+    partition = network.partitions[rank]
+    if network.context_factory is not None:
+        partition.ctx = network.context_factory(rank)
+    sim = network.build(partition)
+    halo = find_halo(sim, partition)
+    sim.allocate()
+
+    ring = numpy.frombuffer(ring, numpy.int32)
+    n_slots = len(slot_offsets) - 1
+    ring_size = int(slot_offsets[-1])
+    stats = {"exchange": 0.0, "barrier": 0.0, "sent": 0, "received": 0,
+             "step": 0}
+
+    def exchange():
+        start = time.time()
+        half = (stats["step"] % 2) * ring_size
+        stats["step"] += 1
+
+        entries = halo.read_outgoing()
+        slot = half + slot_offsets[rank]
+        ring[slot] = len(entries)
+        ring[slot + 1:slot + 1 + len(entries)] = entries
+        stats["sent"] += len(entries)
+
+        barrier_start = time.time()
+        barrier.wait()
+        stats["barrier"] += time.time() - barrier_start
+
+        outgoing = [ ]
+        for other in xrange(n_slots):
+            if other != rank:
+                slot = half + slot_offsets[other]
+                outgoing.append(ring[slot + 1:slot + 1 + ring[slot]])
+        stats["received"] += halo.write_incoming(outgoing)
+        stats["exchange"] += time.time() - start
+
+    start = time.time()
+    run_partitions([sim], exchange)
+    run_time = time.time() - start
+    result = network.collect(sim)
+    sim.release()
+    return WorkerResult(rank, result, run_time, stats["exchange"],
+                        stats["barrier"], stats["sent"], stats["received"])
@@ -1,6 +1,8 @@
+import math
 import numpy
 import cypy as py
-from cl_egans import Node
+import clq.backends.opencl as clqcl
+from cl_egans import Node, Allocation, ConstantArray, Error
 from cl_egans.spiking import State, InitializeFromHost
 
 class Current(Node):
@@ -9,6 +11,8 @@ class Current(Node):
     @py.autoinit
     def __init__(self, parent, basename="Current"): pass
     
+    vectorizable = True
+    
     current = None
     """Current magnitude."""
     
@@ -17,8 +21,107 @@ class Current(Node):
         input_current += current
         """ << g
     
+class StreamedCurrent(Current):
+    """A current read, per element and timestep, from a host array too large to
+    upload all at once (typically a :class:`numpy.memmap`.)
+    
+    ``source`` should have shape ``(n_timesteps, count)``, where ``count`` is 
+    the model's count; all realizations receive the same trace. The device 
+    holds two chunks of ``chunk_timesteps`` timesteps each. While the device 
+    consumes one, the next is copied into the other as soon as the chunk before
+    it has been consumed, including during the burn-in.
+    """
+    
+    @py.autoinit
+    def __init__(self, parent, source, basename="StreamedCurrent",
+                 chunk_timesteps=1000): pass
+    
+    source = None
+    """The host array of currents, indexed by (timestep, element)."""
+    
+    chunk_timesteps = None
+    """The number of timesteps per chunk."""
+    
+    current = "current_trace[(timestep % chunk_timesteps)*count + idx_model]"
+    
+    vectorizable = False
+    
+    @py.lazy(property)
+    def trace_even(self):
+        """The :class:`Allocation` holding even-numbered chunks."""
+        return Allocation(self, "trace_even", 
+                          (self.chunk_timesteps*self.model.count,), clqcl.float)
+        
+    @py.lazy(property)
+    def trace_odd(self):
+        """The :class:`Allocation` holding odd-numbered chunks."""
+        return Allocation(self, "trace_odd", 
+                          (self.chunk_timesteps*self.model.count,), clqcl.float)
+        
+    def pre_finalize(self):
+        self.trace_even
+        self.trace_odd
+        
+    def on_finalize(self):
+        shape = self.source.shape
+        if len(shape) != 2 or shape[1] != self.model.count:
+            raise Error("Source must have shape (n_timesteps, %d)." % 
+                        self.model.count)
+        if shape[0] < self.sim.n_timesteps:
+            raise Error("Source only covers %d timesteps." % shape[0])
+        
+    def in_calculate_inputs(self, g):
+        """
+        current_trace = trace_even if (timestep / chunk_timesteps) % 2 == 0 else trace_odd
+        """ << g
+        super(StreamedCurrent, self).in_calculate_inputs(g)
+        
+    def _upload_chunk(self, chunk_num):
+        chunk_timesteps = self.chunk_timesteps
+        start = chunk_num * chunk_timesteps
+        if start >= self.sim.n_timesteps:
+            return
+        staging = self._staging
+        if staging is None:
+            staging = self._staging = numpy.empty(
+                (chunk_timesteps, self.model.count), numpy.float32)
+        chunk = self.source[start:start + chunk_timesteps]
+        staging[0:len(chunk)] = chunk
+        staging[len(chunk):] = 0
+        if chunk_num % 2 == 0:
+            buffer = self.trace_even.buffer
+        else:
+            buffer = self.trace_odd.buffer
+        self.sim.ctx.memcpy(buffer, staging)
+        
+    _staging = None
+        
+    def _upload_from(self, timestep):
+        chunk_num = timestep // self.chunk_timesteps
+        self._upload_chunk(chunk_num)
+        self._upload_chunk(chunk_num + 1)
+        
+    def on_initialize_memory(self, timestep_info): #@UnusedVariable
+        self._upload_from(0)
+        
+    def on_fork_warm_state(self, warm_state, timestep_info): #@UnusedVariable
+        self._upload_from(self.sim.n_burn_in_timesteps)
+        
+    def on_timestep_complete(self, timestep_info):
+        timesteps_done = timestep_info.timestep + 1
+        if timesteps_done % self.chunk_timesteps == 0:
+            # the chunk before the one now being consumed is free
+            self._upload_chunk(timesteps_done // self.chunk_timesteps + 1)
+            
+    on_burn_in_timestep_complete = on_timestep_complete
+    
 class GenericSynapse(Current):
-    """A generic synapse."""
+    """A generic synapse.
+    
+    If the parent model integrates its voltage using exponential Euler, the 
+    synapse instead contributes ``conductance*reversal`` to ``input_current`` 
+    and ``conductance`` to ``input_conductance``.
+    """
     
     @py.autoinit
     def __init__(self, parent, basename="GenericSynapse", 
@@ -33,23 +136,111 @@ class GenericSynapse(Current):
     spike_target = None
     """A reference to the state variable into which spikes should be sent."""
     
-class LocalPoisson(Node):
-    """Injects spikes via a homogeneous Poisson process into the parent synapse."""
-    @py.autoinit
-    def __init__(self, parent, basename="LocalPoisson", rate=1): pass
+    conductance = "g"
+    """Synaptic conductance, used when the voltage is integrated using 
+    exponential Euler."""
     
-    def pre_finalize(self):
-        self.next_spike
-        self.sim.rng
+    conductance_based = True
     
-    rate = None
-    """The rate, in Hz, of the Poisson process."""
+    def in_calculate_inputs(self, g):
+        model = self.model
+        if (getattr(model, 'using_exact_integration', False) and 
+            model.conductance_based):
+            """
+            input_current += conductance*(reversal)
+            input_conductance += conductance
+            """ << g
+        else:
+            super(GenericSynapse, self).in_calculate_inputs(g)
     
+def poisson_cdf(mean_count, tolerance=1e-7):
+    """Returns the cumulative distribution function of a Poisson distribution,
+    P(count <= k), for k = 0, 1, ... until within ``tolerance`` of 1, as a float
+    array suitable for use with :data:`poisson_count_sampler`."""
+    p = math.exp(-mean_count)
+    cdf = [p]
+    k = 0
+    while (1.0 - cdf[-1] > tolerance and p > 0.0) or k < mean_count:
+        k += 1
+        p *= mean_count / k
+        cdf.append(cdf[-1] + p)
+    return numpy.array(cdf, numpy.float32)
+
+poisson_count_sampler = """
+    u = randf(rng_state, get_global_id)
+    n_poisson_spikes = 0
+    for k in (0, cdf_size, 1):
+        if u > cdf[k]:
+            n_poisson_spikes += 1
+    """
+"""Code which draws ``n_poisson_spikes`` by inverting the table ``cdf`` of 
+length ``cdf_size`` produced by :func:`poisson_cdf`, using one uniform random 
+number and a fixed number of comparisons."""
+
+class PoissonCountTable(object):
+    """A mixin for nodes drawing spike counts using 
+    :data:`poisson_count_sampler`, providing its ``cdf`` table and 
+    ``cdf_size`` for the node's ``rate`` (in Hz)."""
     @property
     def rate_mHz(self):
         """Returns the rate in mHz."""
         return self.rate / 1000.0
     
+    @property
+    def mean_count(self):
+        """The mean number of spikes per timestep, rate*DT."""
+        return self.rate_mHz * self.sim.DT
+    
+    cdf_tolerance = 1e-7
+    """The count distribution table is truncated once the remaining probability 
+    mass falls below this value."""
+    
+    @py.lazy(property)
+    def cdf(self):
+        """A :class:`ConstantArray` containing the cumulative distribution 
+        function of the spike count, P(count <= k), for k = 0, 1, ... until 
+        within ``cdf_tolerance`` of 1."""
+        return ConstantArray(self, "cdf", 
+                             poisson_cdf(self.mean_count, self.cdf_tolerance))
+    
+    @property
+    def cdf_size(self):
+        """The number of entries in the count distribution table."""
+        return self.cdf.args[0].shape[0]
+
+class LocalPoisson(PoissonCountTable, Node):
+    """Injects spikes via a homogeneous Poisson process into the parent synapse.
+    
+    Two sampling modes are available, selected using ``sampling``:
+    
+    ``"interval"``
+        The time of the next spike is stored per element and exponentially 
+        distributed inter-spike intervals are drawn until it passes the end of
+        the current timestep. Cost grows with the rate.
+        
+    ``"count"``
+        The number of spikes in each timestep is drawn directly from a 
+        Poisson(rate*DT) distribution by inverting a cumulative distribution
+        table precomputed on the host, using a single uniform random number
+        and a fixed number of comparisons. No per-element state is needed.
+    """
+    @py.autoinit
+    def __init__(self, parent, basename="LocalPoisson", rate=1, 
+                 sampling="interval"): pass
+    
+    def pre_finalize(self):
+        if self.sampling == "count":
+            self.cdf
+        else:
+            self.next_spike
+        self.sim.rng
+        
+    sampling = None
+    """The sampling mode, either ``"interval"`` or ``"count"``."""
+    
+    rate = None
+    """The rate, in Hz, of the Poisson process."""
+    
     @property
     def reciprocal_rate_mHz(self):
         # Returns 1/rate_mHz
@@ -62,31 +253,54 @@ class LocalPoisson(Node):
     def next_spike(self):
         state = State(self, "next_spike", spike_updater=None, 
                       no_spike_updater=None)
-        initializer = InitializeFromHost(state, 
-            array_producer=lambda count, dtype: numpy.random.exponential(
-                self.rate_mHz, count).astype(dtype))
+        InitializeFromHost(state, array_producer=self._initial_intervals)
         return state
+    
+    def _initial_intervals(self, count, dtype):
+        return numpy.random.exponential(self.rate_mHz, count).astype(dtype)
         
     @property
     def next_spike_alloc(self):
         return self.next_spike.allocation
     
     def on_finalize(self):
-        self.next_spike
+        if self.sampling == "count":
+            self.cdf
+        elif self.sampling == "interval":
+            self.next_spike
+        else:
+            raise Error("Unknown sampling mode: %s" % self.sampling)
         
     def in_calculate_inputs(self, g):
+        if self.sampling == "count":
+            self._insert_count_code(g)
+        else:
+            self._insert_interval_code(g)
+            
+    def _insert_count_code(self, g):
+        poisson_count_sampler << g
+        """
+        spike_target += weight*n_poisson_spikes
+        """ << g
+            
+    def _insert_interval_code(self, g):
         """
         if t >= next_spike:
             spike_target += weight
-            isi = randexp(RNG_rng_state, randf, log, get_global_id)*reciprocal_rate_mHz
+            isi = randexp(rng_state, randf, log, get_global_id)*reciprocal_rate_mHz
             while isi < DT: # high rate processes may produce >1 spike/timestep
                 spike_target += weight
-                isi += randexp(RNG_rng_state, randf, log, get_global_id)*reciprocal_rate_mHz
+                isi += randexp(rng_state, randf, log, get_global_id)*reciprocal_rate_mHz
             next_spike_alloc[idx_state] = next_spike + isi
         """ << g
         
 class ExponentialSynapse(GenericSynapse):
-    """A synapse which produces exponential-shaped PSPs."""
+    """A synapse which produces exponential-shaped PSPs.
+    
+    If the effective ``integrator`` of the conductance state (see 
+    :data:`Simulation.integrator`) is ``"exact"``, the conductance is decayed 
+    using a precomputed propagator instead of forward Euler.
+    """
     
     @py.autoinit
     def __init__(self, parent, basename="ExponentialSynapse",
@@ -103,11 +317,24 @@ class ExponentialSynapse(GenericSynapse):
     
     def pre_finalize(self):
         g = self.g
-        g.spike_updater = g.no_spike_updater = self.g_updater
+        if g.getrec('integrator') == "exact":
+            g_updater = self.g_exact_updater
+        else:
+            g_updater = self.g_updater
+        g.spike_updater = g.no_spike_updater = g_updater
     
     tau = None
     """Synaptic integration time constant."""
     
     g_updater = "g - DT/tau*g"
-    """Synaptic conductance updater."""
+    """Synaptic conductance updater (forward Euler)."""
+    
+    g_exact_updater = "g*g_propagator"
+    """Synaptic conductance updater (exact)."""
+    
+    @property
+    def g_propagator(self):
+        """The precomputed propagator, ``exp(-DT/tau)``, using the step of
+        :data:`g`."""
+        return math.exp(-self.g.DT/self.tau)
 
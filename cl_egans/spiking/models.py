@@ -1,8 +1,10 @@
 """Neuron models live here."""
-import numpy
+import math
 import cypy as py
-from cl_egans import Model
-from cl_egans.spiking import State, InitializeFromHost
+import clq.backends.opencl as clqcl
+from cl_egans import Model, Allocation, Error
+from cl_egans.spiking import State, InitializeFromHost, Fill
+from cl_egans.spiking.inputs import PoissonCountTable, poisson_count_sampler
 
 class SpikingModel(Model):
     """The base class of all spiking models."""
@@ -25,11 +27,24 @@ class SpikingModel(Model):
         
     def in_calculate_inputs(self, g):
         """
-        input_current = 0
+        input_current = input_zero
         """ << g
         
+    @property
+    def input_zero(self):
+        """The initial value of the inputs, a vector in vector code."""
+        if self.vector_code:
+            return "vector_zero"
+        return "0"
+    
+    @property
+    def input_current(self):
+        """The local summing the input currents, see 
+        :meth:`Model.local_name <cl_egans.Model.local_name>`."""
+        return self.local_name("input_current")
+        
     def in_spike_processing(self, g):
-        g << ("if spike_condition:\n", g.tab)
+        g << ("\nif spike_condition:\n", g.tab)
         self.trigger_staged_cg_hook("spike_generated", g)
         g << ("pass # in case no one writes out any code in this branch\n", g.untab)
         g << ("else:\n", g.tab)
@@ -37,22 +52,96 @@ class SpikingModel(Model):
         g << ("pass # in case no one writes out any code in this branch\n", g.untab)
         
     def in_spike_generated(self, g):
-        self.trigger_staged_cg_hook("spike_state_updates", g)
+        if not self._states_selected:
+            self.trigger_staged_cg_hook("spike_state_updates", g)
         self.trigger_staged_cg_hook("spike_propagation", g)
         
     def in_no_spike_generated(self, g):
         self.trigger_staged_cg_hook("no_spike_state_updates", g)
         
+    ## Vectorized Code Generation
+    _states_selected = False
+    # True while generating the per-element spike code following vector code,
+    # whose state updates have already been made using select.
+    
+    def in_model_vector_code(self, g):
+        """Updates a full batch of elements at once. The state updates of both
+        branches of the spike condition are merged using ``select``. If any 
+        element spiked, the spike condition is stored in ``spike_mask`` and 
+        the "spike_generated" hook code, without the state updates, is run for
+        each element which spiked, using scalar indices."""
+        """
+        idx_model = idx_model_first
+        idx_state = idx_model + (realization_num - realization_start)*count
+        """ << g
+        self.trigger_staged_cg_hook("read_incoming_spikes", g)
+        self.trigger_staged_cg_hook("read_state", g)
+        self.trigger_staged_cg_hook("calculate_inputs", g)
+        self.trigger_staged_cg_hook("state_calculations", g)
+        self.trigger_staged_cg_hook("independent_state_updates", g)
+        """
+        spiked = spike_condition
+        """ << g
+        self.trigger_staged_cg_hook("vector_state_updates", g)
+        """
+        if any(spiked):
+            vstore(spiked, 0, spike_mask + gid*vector_width)
+            for lane in (0, vector_width, 1):
+                if spike_mask[gid*vector_width + lane] != 0:
+        """ << g
+        (g.tab, g.tab, g.tab) >> g
+        self.vector_code = False
+        self._states_selected = True
+        try:
+            self.generate_lane_idx_calculations(g)
+            self.trigger_staged_cg_hook("model_idx_calculations", g)
+            """
+            idx_state = idx_model + (realization_num - realization_start)*count
+            """ << g
+            self.trigger_staged_cg_hook("spike_generated", g)
+        finally:
+            self.vector_code = True
+            self._states_selected = False
+        (g.untab, g.untab, g.untab) >> g
+        
+    @py.lazy(property)
+    def spike_mask(self):
+        """The :class:`Allocation <cl_egans.Allocation>` holding the spike 
+        condition of the batch each work item is updating, in vector code."""
+        allocation = Allocation(self, "spike_mask", self._spike_mask_shape, 
+                                clqcl.int)
+        allocation.checkpointed = False
+        return allocation
+    
+    def _spike_mask_shape(self):
+        return (self.sim.n_work_items * self.sim.vector_width,)
+    
+    def post_finalize(self):
+        if self.vectorized:
+            self.spike_mask
+        
 class GenericIF(SpikingModel):
     """A generic integrate-and-fire model with absolute refractory period. 
     
     Subclasses should specify the form of the leak using the ``leak`` attribute 
     to make a specific integrate-and-fire model.
+    
+    If the effective ``integrator`` (see :data:`Simulation.integrator`) is 
+    ``"exact"``, the leak must also be given in linear form via 
+    ``leak_conductance`` and ``leak_reversal``. The voltage is then advanced 
+    using a precomputed exponential propagator if all inputs are currents, or 
+    using exponential Euler if any conductance-based synapses are attached.
+    
+    The model is ``vectorizable``, so it is vectorized if 
+    :data:`Simulation.vector_width <cl_egans.Simulation.vector_width>` is 
+    greater than 1 and all of its synapses, inputs and probes are too. Its 
+    expressions must then be valid for vector operands.
     """
+    vectorizable = True
     
     @py.autoinit
     def __init__(self, parent, basename="GenericIF", count=1, 
-                 v_update_eqn = "v + DT/tau*(leak + input_current)",
+                 v_update_eqn=None,
                  tau=None,
                  v_reset=None,
                  v_thresh=None,
@@ -63,18 +152,31 @@ class GenericIF(SpikingModel):
         """Voltage state variable."""
         
         return State(self, "v",
-            calculations="v_new = v_update_eqn if not abs_refractory_condition else v_reset",
+            calculations="v_new = v_new_eqn",
             spike_updater="v_reset",
             no_spike_updater="v_new")
         
+    @property
+    def v_new(self):
+        """The local holding the voltage computed by ``v_new_eqn``."""
+        return self.local_name("v_new")
+    
+    @property
+    def v_new_eqn(self):
+        """The voltage after this timestep, before the spike condition is 
+        checked. Refractory elements are held at ``v_reset``."""
+        if self.vector_code:
+            return ("select(vector_zero + (v_update_eqn), vector_zero + "
+                    "(v_reset), abs_refractory_condition)")
+        return "v_update_eqn if not abs_refractory_condition else v_reset"
+        
     @py.lazy(property)
     def abs_refractory_t_release(self):
         """Absolute refractory period state variable."""
         
         state = State(self, "abs_refractory_t_release",
                      spike_updater="t + abs_refractory_period")
-        InitializeFromHost(state,
-            lambda shape, dtype: numpy.zeros(shape, dtype))
+        InitializeFromHost(state, Fill(0))
         return state
         
     def pre_finalize(self):
@@ -82,8 +184,99 @@ class GenericIF(SpikingModel):
         self.abs_refractory_t_release
         # TODO: (post-init hook is really where this should go but its not implemented yet)
         
+    def on_finalize(self):
+        if self.using_exact_integration:
+            if self.leak_conductance is None or self.leak_reversal is None:
+                raise Error("Exact integration requires leak_conductance and "
+                            "leak_reversal to be specified.")
+        if self.v_update_eqn is None:
+            if not self.using_exact_integration:
+                self.v_update_eqn = self.euler_v_update_eqn
+            elif self.conductance_based:
+                self.v_update_eqn = self.exponential_euler_v_update_eqn
+            else:
+                self.v_update_eqn = self.exact_v_update_eqn
+    
+    @property
+    def using_exact_integration(self):
+        """Returns whether the voltage is integrated using exponential 
+        propagators rather than forward Euler."""
+        return self.v.getrec('integrator') == "exact"
+    
+    @property
+    def conductance_based(self):
+        """Returns whether any child synapse contributes a conductance (rather 
+        than just a current) to the voltage update."""
+        return any(getattr(child, 'conductance_based', False) 
+                   for child in self.children)
+    
+    @property
+    def input_conductance(self):
+        """The local summing the input conductances, for exponential Euler."""
+        return self.local_name("input_conductance")
+    
+    @property
+    def total_conductance(self):
+        """The local holding the leak and input conductances, for exponential 
+        Euler."""
+        return self.local_name("total_conductance")
+    
+    @property
+    def v_inf(self):
+        """The local holding the steady-state voltage, for exact 
+        integration."""
+        return self.local_name("v_inf")
+        
+    def in_calculate_inputs(self, g):
+        super(GenericIF, self).in_calculate_inputs(g)
+        if self.using_exact_integration and self.conductance_based:
+            """
+            input_conductance = input_zero
+            """ << g
+            
+    def in_state_calculations(self, g):
+        if self.using_exact_integration:
+            if self.conductance_based:
+                """
+                total_conductance = leak_conductance + input_conductance
+                v_inf = (leak_conductance*leak_reversal + input_current)/total_conductance
+                """ << g
+            else:
+                """
+                v_inf = leak_reversal + input_current/leak_conductance
+                """ << g
+        
     v_update_eqn = None
-    """Update equation for voltage."""
+    """Update equation for voltage. 
+    
+    If not specified, chosen based on the effective integrator from 
+    ``euler_v_update_eqn``, ``exact_v_update_eqn`` and 
+    ``exponential_euler_v_update_eqn``.
+    """
+    
+    euler_v_update_eqn = "v + DT/tau*(leak + input_current)"
+    """Forward Euler update equation for voltage."""
+    
+    exact_v_update_eqn = "v_inf + (v - v_inf)*v_propagator"
+    """Exact update equation for voltage when all inputs are currents."""
+    
+    exponential_euler_v_update_eqn = "v_inf + (v - v_inf)*exp(-DT/tau*total_conductance)"
+    """Exponential Euler update equation for conductance-based voltage.
+    
+    Synapses contribute the voltage-independent part of their current to 
+    ``input_current`` and their conductance to ``input_conductance``.
+    """
+    
+    @property
+    def v_propagator(self):
+        """The precomputed propagator, ``exp(-DT/tau*leak_conductance)``."""
+        return math.exp(-self.sim.DT/self.tau*self.leak_conductance)
+    
+    leak_conductance = None
+    """The (dimensionless) leak conductance, for exact integration."""
+    
+    leak_reversal = None
+    """The leak reversal potential, for exact integration."""
     
     tau = None
     """Membrane time constant."""
@@ -113,3 +306,42 @@ class ReducedLIF(GenericIF):
     def __init__(self, parent, basename="LIF", count=1): pass
 
     leak = "-v"
+    leak_conductance = 1.0
+    leak_reversal = 0.0
+
+class PoissonPopulation(PoissonCountTable, SpikingModel):
+    """A population of ``count`` independent Poisson spike sources, shared by 
+    all of the neurons they project to.
+    
+    Each source draws its spike count for the timestep once, using the same 
+    table-based sampler as :class:`LocalPoisson 
+    <cl_egans.spiking.inputs.LocalPoisson>` in ``"count"`` mode, and spikes are 
+    delivered through the regular connectivity nodes. For example, with an 
+    :class:`AtomicSender <cl_egans.spiking.connectivity.AtomicSender>` child
+    (with ``target_model`` set to the receiving model), random number 
+    generation costs ``count`` draws per timestep, rather than one process per 
+    target neuron per source as with independent :class:`LocalPoisson` inputs.
+    
+    The number of spikes emitted in the current timestep is available to 
+    children as ``n_poisson_spikes``. Child senders with the default 
+    ``int_weight`` send it as the weight.
+    """
+    
+    @py.autoinit
+    def __init__(self, parent, basename="PoissonPopulation", count=1, 
+                 rate=1): pass
+    
+    rate = None
+    """The rate, in Hz, of each source."""
+    
+    spike_condition = "n_poisson_spikes > 0"
+    
+    def pre_finalize(self):
+        self.cdf
+        self.sim.rng
+        for child in self.children:
+            if getattr(child, 'int_weight', None) == 1:
+                child.int_weight = "n_poisson_spikes"
+    
+    def in_state_calculations(self, g):
+        poisson_count_sampler << g
@@ -0,0 +1,441 @@
+"""Splits one large network across several devices.
+
+A single realization normally lives on one context, since model offsets and
+neighbor data index a single address space. A :class:`PartitionedNetwork`
+assigns contiguous ranges of a model's elements to several contexts (devices
+or CPU sub-devices), each running its own :class:`Simulation
+<cl_egans.Simulation>` of its range. Connections between elements of the same
+partition are propagated locally as usual. Spikes of *boundary* elements, which
+have targets in other partitions, are also appended to an outgoing list.
+Between steps, the host gathers these lists and hands each partition the
+entries its elements receive. They are then delivered by the partition's next
+step.
+
+Spikes crossing partitions therefore arrive one timestep later than local
+ones, i.e. inter-partition connections have an additional delay of ``DT``.
+
+The network is described by its global packed neighbor data (see
+:class:`AtomicSender <cl_egans.spiking.connectivity.AtomicSender>`). A
+``build`` function constructs the simulation of each :class:`Partition`,
+using its local neighbor data and adding a :class:`HaloExchange` to the
+sender::
+
+    def build(partition):
+        sim = Simulation(partition.ctx, n_timesteps=10000, DT=0.1)
+        neurons = ReducedLIF(sim, "LIF", count=partition.count, ...)
+        ...
+        sender = AtomicSender(neurons,
+            neighbor_data=ConstantArray(sim, "neighbor_data",
+                                        partition.local_neighbor_data),
+            target_calculation="ge if idx_global < %d else gi" % N_Exc)
+        HaloExchange(sender, partition)
+        return sim
+
+    network = PartitionedNetwork(build, [ctx_a, ctx_b], N, cm.packed())
+    network.run()
+
+Code in the sender, like ``target_calculation``, should use ``idx_global``,
+the element's index in the whole network, instead of ``idx_model``.
+"""
+import time
+import numpy
+import cypy as py
+import clq.backends.opencl as clqcl
+from cl_egans import Error, Node, Allocation, ConstantArray, clqstd
+from cl_egans.spiking.connectivity import (unpack_neighbor_data,
+                                           pack_neighbor_lists)
+
+class Partition(object):
+    """One context's contiguous share of a partitioned network."""
+    @py.autoinit
+    def __init__(self, index, start, stop, global_count, ctx,
+                 local_neighbor_data, remote_neighbor_data, boundary): pass
+
+    index = None
+    """The position of this partition."""
+
+    start = None
+    """The global index of the first element of this partition."""
+
+    stop = None
+    """One past the global index of the last element of this partition."""
+
+    global_count = None
+    """The number of elements in the whole network."""
+
+    ctx = None
+    """The context this partition runs on."""
+
+    local_neighbor_data = None
+    """Packed neighbor data of this partition's elements, with only their
+    targets in this partition, as local indices."""
+
+    remote_neighbor_data = None
+    """Packed neighbor data of every element in the network, with only their
+    targets in this partition, as local indices. Empty for this partition's
+    own elements, whose spikes are propagated locally."""
+
+    boundary = None
+    """An int array with a 1 for each of this partition's elements with
+    targets in other partitions."""
+
+    @property
+    def count(self):
+        """The number of elements in this partition."""
+        return self.stop - self.start
+
+    @py.lazy(property)
+    def receives(self):
+        """A boolean array, over the whole network, of the elements with
+        targets in this partition."""
+        data = self.remote_neighbor_data
+        return data[data[0:self.global_count]] > 0
+
+    @property
+    def n_boundary(self):
+        """The number of this partition's boundary elements."""
+        return int(numpy.count_nonzero(self.boundary))
+
+    @classmethod
+    def split(cls, neighbor_data, count, boundaries, contexts):
+        """Returns the partitions of a network of ``count`` elements with the
+        provided global packed neighbor data. Partition ``i`` covers the
+        elements from ``boundaries[i]`` to ``boundaries[i + 1]`` and runs on
+        ``contexts[i]``."""
+        if len(boundaries) != len(contexts) + 1:
+            raise Error("Need one more boundary than contexts.")
+        if boundaries[0] != 0 or boundaries[-1] != count:
+            raise Error("Boundaries must run from 0 to count.")
+        neighbor_lists = unpack_neighbor_data(neighbor_data, count)
+        dtype = numpy.asarray(neighbor_data).dtype
+
+        partitions = [ ]
+        for index, ctx in enumerate(contexts):
+            start, stop = boundaries[index], boundaries[index + 1]
+            if stop <= start:
+                raise Error("Partition %d is empty." % index)
+            local_lists = [ ]
+            boundary = numpy.zeros(stop - start, numpy.int32)
+            remote_lists = [ ]
+            for src, neighbors in enumerate(neighbor_lists):
+                inside = (neighbors >= start) & (neighbors < stop)
+                if start <= src < stop:
+                    local_lists.append(neighbors[inside] - start)
+                    boundary[src - start] = not inside.all()
+                    remote_lists.append(())
+                else:
+                    remote_lists.append(neighbors[inside] - start)
+            partitions.append(cls(index, start, stop, count, ctx,
+                                  pack_neighbor_lists(local_lists, dtype),
+                                  pack_neighbor_lists(remote_lists, dtype),
+                                  boundary))
+        return partitions
+
+class HaloExchange(Node):
+    """Sends the spikes of a partition's boundary elements to, and delivers
+    the spikes received from, the other partitions. The parent should be the
+    partition's :class:`AtomicSender
+    <cl_egans.spiking.connectivity.AtomicSender>`.
+
+    Received spikes are delivered after the main loop using the sender's
+    ``target_calculation``, ``int_weight`` and "spike_send" hook, with
+    ``idx_global`` set to the sending element's global index.
+    """
+    @py.autoinit
+    def __init__(self, parent, partition, basename="HaloExchange"): pass
+
+    vectorizable = True # only adds to the spike propagation
+
+    partition = None
+    """The :class:`Partition` the simulation covers."""
+
+    @property
+    def partition_start(self):
+        return self.partition.start
+
+    @property
+    def global_count(self):
+        return self.partition.global_count
+
+    @property
+    def outgoing_capacity(self):
+        """The maximum number of spikes sent per timestep."""
+        return max(self.partition.n_boundary, 1) * \
+            self.sim.n_realizations_per_division_max
+
+    @property
+    def incoming_capacity(self):
+        """The maximum number of spikes received per timestep."""
+        partition = self.partition
+        n_sources = int(numpy.count_nonzero(partition.receives))
+        return max(n_sources, 1) * self.sim.n_realizations_per_division_max
+
+    def _outgoing_shape(self):
+        return (self.outgoing_capacity,)
+
+    def _incoming_shape(self):
+        return (self.incoming_capacity,)
+
+    def pre_finalize(self):
+        if self.model.count != self.partition.count:
+            raise Error("%s covers %d elements, but its model has %d." %
+                        (self.name, self.partition.count, self.model.count))
+        partition = self.partition
+        self.boundary = ConstantArray(self, "boundary", partition.boundary)
+        self.remote_neighbor_data = ConstantArray(self, "remote_neighbor_data",
+            partition.remote_neighbor_data)
+        self.outgoing = Allocation(self, "outgoing", self._outgoing_shape,
+                                   clqcl.int)
+        self.n_outgoing = Allocation(self, "n_outgoing", (1,), clqcl.int)
+        self.incoming = Allocation(self, "incoming", self._incoming_shape,
+                                   clqcl.int)
+        self.n_incoming = Allocation(self, "n_incoming", (1,), clqcl.int)
+
+    def on_initialize_memory(self, timestep_info): #@UnusedVariable
+        clqstd.ew_set_0(self.n_outgoing.buffer)
+        clqstd.ew_set_0(self.n_incoming.buffer)
+
+    def read_outgoing(self):
+        """Returns the entries sent by the last step and empties the outgoing
+        list."""
+        ctx = self.sim.ctx
+        n = int(ctx.from_device(self.n_outgoing.buffer)[0])
+        entries = ctx.from_device(self.outgoing.buffer)[0:n]
+        ctx.memcpy(self.n_outgoing.buffer, numpy.zeros(1, numpy.int32))
+        return entries
+
+    def write_incoming(self, outgoing):
+        """Uploads the entries of the other partitions' outgoing lists which
+        this partition receives, for delivery by the next step. Returns their
+        number."""
+        partition = self.partition
+        receives = partition.receives
+        global_count = partition.global_count
+        incoming = [entries[receives[entries % global_count]]
+                    for entries in outgoing]
+        n = sum(len(entries) for entries in incoming)
+        ctx = self.sim.ctx
+        if n:
+            staging = self._staging
+            staging[0:n] = numpy.concatenate(incoming)
+            ctx.memcpy(self.incoming.buffer, staging)
+        ctx.memcpy(self.n_incoming.buffer, numpy.array([n], numpy.int32))
+        return n
+
+    @py.lazy(property)
+    def _staging(self):
+        # host copy of the incoming list, reused every step
+        return numpy.empty(self.incoming_capacity, numpy.int32)
+
+    def pre_spike_propagation(self, g):
+        """
+        idx_global = idx_model + partition_start
+        """ << g
+
+    def post_spike_propagation(self, g):
+        # entries encode the realization slot and the global source index
+        """
+        if boundary[idx_model]:
+            halo_slot = atom_inc(n_outgoing)
+            outgoing[halo_slot] = (realization_num - realization_start)*global_count + idx_global
+        """ << g
+
+    def post_main_loop(self, g):
+        """
+        for halo_idx in (gid, n_incoming[0], gsize):
+            halo_entry = incoming[halo_idx]
+            realization_num = halo_entry / global_count + realization_start
+            idx_global = halo_entry - (realization_num - realization_start)*global_count
+            target = target_calculation
+            target_offset = (realization_num - realization_start)*target_count
+            neighbors_offset = remote_neighbor_data[idx_global]
+            neighbor_size = remote_neighbor_data[neighbors_offset]
+            neighbors = remote_neighbor_data + neighbors_offset + 1
+            for i in (0, neighbor_size, i_stride):
+        """ << g
+        g << (g.tab, g.tab)
+        self.parent.trigger_staged_cg_hook("spike_send", g)
+        g << (g.untab, g.untab, "\n")
+
+class PartitionedNetwork(object):
+    """Runs a network split into contiguous partitions, one per context.
+
+    ``build`` is called with each :class:`Partition` and must return an
+    unfinalized :class:`Simulation <cl_egans.Simulation>` of the partition's
+    elements, bound to its context and containing a :class:`HaloExchange` for
+    it. The partitions' simulations must have the same numbers of timesteps
+    and realizations, and no burn-in. :class:`TerminationCondition
+    <cl_egans.TerminationCondition>` flags are not polled.
+
+    If ``boundaries`` is None, the elements are split evenly.
+    """
+    @py.autoinit
+    def __init__(self, build, contexts, count, neighbor_data,
+                 boundaries=None): pass
+
+    build = None
+    """The function building the simulation of a :class:`Partition`."""
+
+    contexts = None
+    """The contexts to run the partitions on."""
+
+    count = None
+    """The number of elements in the whole network."""
+
+    neighbor_data = None
+    """The packed neighbor data of the whole network, with global
+    indices."""
+
+    boundaries = None
+    """The first global index of each partition followed by ``count``."""
+
+    exchange_time = 0.0
+    """Seconds spent exchanging spikes between partitions during the last
+    :meth:`run`."""
+
+    n_exchanged = 0
+    """The number of spikes sent between partitions during the last
+    :meth:`run`."""
+
+    @py.lazy(property)
+    def partitions(self):
+        """The :class:`Partition` of each context."""
+        contexts = list(self.contexts)
+        boundaries = self.boundaries
+        if boundaries is None:
+            n = len(contexts)
+            boundaries = [i * self.count // n for i in xrange(n + 1)]
+        return Partition.split(self.neighbor_data, self.count, boundaries,
+                               contexts)
+
+    @py.lazy(property)
+    def simulations(self):
+        """The simulation of each partition."""
+        return [self.build(partition) for partition in self.partitions]
+
+    @py.lazy(property)
+    def halos(self):
+        """The :class:`HaloExchange` of each partition."""
+        return [find_halo(sim, partition)
+                for partition, sim in zip(self.partitions, self.simulations)]
+
+    def finalize(self):
+        """Finalizes every partition's simulation and checks that they can run
+        together."""
+        sims = self.simulations
+        check_lockstep(sims)
+        for partition, sim in zip(self.partitions, sims):
+            if sim.ctx is not partition.ctx:
+                raise Error("The simulation of partition %d is not bound to "
+                            "its context." % partition.index)
+        self.halos #@NoEffect
+
+    def allocate(self):
+        """Finalizes and allocates every partition's simulation."""
+        self.finalize()
+        for sim in self.simulations:
+            sim.allocate()
+
+    def release(self):
+        """Releases every partition's simulation."""
+        for sim in self.simulations:
+            sim.release()
+
+    def exchange(self):
+        """Moves the spikes sent by each partition's last step to the
+        partitions they target. Called by :meth:`run` after every step."""
+        start = time.time()
+        halos = self.halos
+        outgoing = [halo.read_outgoing() for halo in halos]
+        for idx, halo in enumerate(halos):
+            self.n_exchanged += halo.write_incoming(
+                outgoing[:idx] + outgoing[idx + 1:])
+        self.exchange_time += time.time() - start
+
+    def run(self):
+        """Runs every partition for their common number of timesteps, one
+        division at a time, exchanging spikes after each step.
+
+        Each simulation's hooks are triggered as by :meth:`Simulation.run
+        <cl_egans.Simulation.run>`.
+        """
+        self.allocate()
+        self.exchange_time = 0.0
+        self.n_exchanged = 0
+        run_partitions(self.simulations, self.exchange)
+
+def find_halo(sim, partition):
+    """Returns the :class:`HaloExchange` for ``partition`` in ``sim``."""
+    found = [node for node in sim._iter_nodes()
+             if isinstance(node, HaloExchange)]
+    if len(found) != 1 or found[0].partition is not partition:
+        raise Error("The simulation of partition %d needs exactly one "
+                    "HaloExchange for it." % partition.index)
+    return found[0]
+
+def check_lockstep(sims):
+    """Finalizes partition simulations and checks that they can run in
+    lockstep: with the same numbers of timesteps and realizations, and no
+    burn-in."""
+    first = sims[0]
+    for sim in sims:
+        sim.finalize()
+        if (sim.n_timesteps != first.n_timesteps or
+            sim.n_realizations != first.n_realizations or
+            sim.n_realizations_per_division_max !=
+                first.n_realizations_per_division_max):
+            raise Error("Partitions must have the same numbers of timesteps "
+                        "and realizations.")
+        if sim.n_burn_in_timesteps:
+            raise Error("Partitioned simulations cannot have a burn-in.")
+
+def run_partitions(sims, exchange):
+    """Runs allocated partition simulations in lockstep, one division at a
+    time, calling ``exchange`` after each step has been launched on all of
+    them. Each simulation's hooks are triggered as by :meth:`Simulation.run
+    <cl_egans.Simulation.run>`."""
+    first = sims[0]
+    n_timesteps = first.n_timesteps
+    step_fns = [(sim._step_fn_even, sim._step_fn_odd) for sim in sims]
+
+    run_infos = [ ]
+    for sim in sims:
+        run_info = sim.RunInfo(n_timesteps)
+        sim.trigger_hook("prepare_run", run_info)
+        run_infos.append(run_info)
+
+    max_realizations = first.n_realizations_per_division_max
+    for division_num in xrange(first.n_divisions):
+        realization_start = numpy.int32(division_num * max_realizations)
+        n_realizations = min(max_realizations,
+                             first.n_realizations - realization_start)
+        timestep_infos = [ ]
+        for sim, run_info in zip(sims, run_infos):
+            timestep_info = sim.TimestepInfo(run_info, division_num,
+                realization_start, n_realizations)
+            sim.trigger_hook("on_initialize_memory", timestep_info)
+            timestep_infos.append(timestep_info)
+
+        timestep = numpy.int32(0)
+        while timestep < n_timesteps:
+            # launch every partition before waiting on any of them
+            for step_fn_even, step_fn_odd in step_fns:
+                if timestep % 2 == 0:
+                    step_fn_even(timestep, realization_start)
+                else:
+                    step_fn_odd(timestep, realization_start)
+            exchange()
+
+            for sim, timestep_info in zip(sims, timestep_infos):
+                timestep_info.timestep = timestep
+                sim._run_position = (division_num, timestep + 1)
+                sim.trigger_hook("on_timestep_complete", timestep_info)
+            timestep += 1
+
+        for sim, timestep_info in zip(sims, timestep_infos):
+            sim._run_position = (division_num + 1, 0)
+            sim.trigger_hook("on_division_complete", timestep_info)
+
+    for sim, run_info in zip(sims, run_infos):
+        sim.ctx.queue.finish()
+        sim.trigger_hook("on_run_complete", run_info)
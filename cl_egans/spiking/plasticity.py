@@ -0,0 +1,264 @@
+"""Synaptic plasticity lives here."""
+import math
+import numpy
+import cypy as py
+import clq.backends.opencl as clqcl
+from cl_egans import Node, Allocation, ConstantArray, Error
+from cl_egans.spiking import State, InitializeFromHost, Fill
+from cl_egans.spiking.connectivity import AtomicSender, unpack_neighbor_data
+
+class STDPSender(AtomicSender):
+    """An :class:`AtomicSender <cl_egans.spiking.connectivity.AtomicSender>`
+    whose connections have plastic weights, learned on the device by
+    pair-based spike-timing-dependent plasticity.
+
+    Each connection, i.e. each entry of ``neighbor_data``, has a weight per
+    realization, stored in fixed point with ``weight_scale`` units per 1.0 so
+    it can be sent and updated using integer atomics. Spikes deliver the
+    weight, clamped to [``w_min``, ``w_max``], in place of ``int_weight``, so
+    the weights of the :class:`AtomicReceiver
+    <cl_egans.spiking.connectivity.AtomicReceiver>` nodes spikes are sent to
+    should be divided by ``weight_scale``.
+
+    The sending elements keep a presynaptic trace, ``pre_trace``, and the
+    target model keeps a postsynaptic trace (see :class:`STDPTarget`). Both
+    decay exponentially and are incremented by 1 on each spike. When an
+    element spikes, each of its connections is depressed by ``a_minus`` times
+    its target's trace. When a target spikes, each connection to it is
+    potentiated by ``a_plus`` times its source's trace. Updates are skipped for
+    weights already at the bound, so stored weights overshoot a bound by at
+    most one concurrent update. Traces of other elements may be read before or
+    after their update in the same timestep, so whether spikes in the same
+    timestep interact is unspecified.
+
+    Rows of ``neighbor_data`` must be indexed by the sending model's element
+    index. The learned weights are copied to :data:`learned_weights` after
+    each division.
+    """
+    @py.autoinit
+    def __init__(self, parent, basename="STDPSender"): pass
+
+    tau_plus = 20.0
+    """The time constant of the presynaptic trace."""
+
+    tau_minus = 20.0
+    """The time constant of the postsynaptic trace."""
+
+    a_plus = 0.01
+    """The potentiation per unit of presynaptic trace."""
+
+    a_minus = 0.012
+    """The depression per unit of postsynaptic trace."""
+
+    w_min = 0.0
+    """The lower bound of the weights."""
+
+    w_max = 1.0
+    """The upper bound of the weights."""
+
+    initial_weight = 1.0
+    """The initial weight of every connection, or an array with an initial
+    weight for each entry of ``neighbor_data``."""
+
+    weight_scale = 1024
+    """The number of fixed-point units per 1.0 of weight."""
+    
+    source_idx = "idx_model" # weights and traces are per sending element
+
+    learned_weights = None
+    """After the run, a float array of shape ``(n_realizations,
+    len(neighbor_data))``. The weight of the ``i``-th connection of element
+    ``src`` in realization ``r`` is ``learned_weights[r, neighbor_data[src] +
+    1 + i]``; other entries are meaningless."""
+
+    @property
+    def pre_decay(self):
+        return math.exp(-self.sim.DT/self.tau_plus)
+
+    @property
+    def a_minus_units(self):
+        return self.a_minus*self.weight_scale
+
+    @property
+    def w_min_units(self):
+        return int(round(self.w_min*self.weight_scale))
+
+    @property
+    def w_max_units(self):
+        return int(round(self.w_max*self.weight_scale))
+
+    @property
+    def neighbor_array(self):
+        """The host copy of ``neighbor_data``."""
+        return self.neighbor_data.args[0]
+
+    @property
+    def n_weight_slots(self):
+        """The number of weights per realization, one per entry of
+        ``neighbor_data``."""
+        return len(self.neighbor_array)
+
+    @property
+    def stdp_target(self):
+        """The :class:`STDPTarget` holding the postsynaptic side."""
+        return self._stdp_target
+
+    @py.lazy(property)
+    def pre_trace(self):
+        """The presynaptic trace of the sending elements."""
+        decay = "pre_trace*pre_decay"
+        state = State(self, "pre_trace", spike_updater=decay + " + 1.0",
+                      no_spike_updater=decay)
+        InitializeFromHost(state, Fill(0.0))
+        return state
+
+    @py.lazy(property)
+    def weights(self):
+        """The :class:`Allocation <cl_egans.Allocation>` of the fixed-point
+        weights."""
+        allocation = Allocation(self, "weights", self._weights_shape,
+                                clqcl.int)
+        allocation.realization_major = True
+        return allocation
+
+    def _weights_shape(self):
+        return (self.n_weight_slots * self.sim.n_realizations_per_division_max,)
+
+    def pre_finalize(self):
+        if self.source_idx != "idx_model":
+            raise Error("%s needs source_idx to be \"idx_model\"." % 
+                        self.name)
+        if not isinstance(self.neighbor_data, ConstantArray):
+            raise Error("%s needs neighbor_data to be a ConstantArray." %
+                        self.name)
+        target_model = self.target_model
+        if target_model is None:
+            target_model = self.model
+        self._stdp_target = STDPTarget(target_model, sender=self)
+        self.pre_finalize_added(self._stdp_target)
+        self.pre_trace
+        self.weights
+        self.sim.constants['atom_sub'] = clqcl.atom_sub
+
+    def on_initialize_memory(self, timestep_info): #@UnusedVariable
+        initial = numpy.empty(self.n_weight_slots, numpy.float64)
+        initial[:] = self.initial_weight
+        initial = numpy.round(initial*self.weight_scale).astype(numpy.int32)
+        self.sim.ctx.memcpy(self.weights.buffer, numpy.tile(initial,
+            self.sim.n_realizations_per_division_max))
+
+    def on_finalize(self):
+        self.learned_weights = numpy.zeros((self.sim.n_realizations,
+                                            self.n_weight_slots), numpy.float32)
+
+    def on_division_complete(self, timestep_info):
+        weights = self.sim.ctx.from_device(self.weights.buffer)
+        n = timestep_info.n_realizations
+        start = timestep_info.realization_start
+        self.learned_weights[start:start + n] = weights.reshape(
+            (-1, self.n_weight_slots))[0:n] / float(self.weight_scale)
+
+    def in_spike_send(self, g):
+        """
+        synapse_idx = (realization_num - realization_start)*n_weight_slots + neighbors_offset + 1 + i
+        synaptic_weight = weights[synapse_idx]
+        atom_add(target + target_offset + neighbors[i], min(max(synaptic_weight, w_min_units), w_max_units))
+        if synaptic_weight > w_min_units:
+            atom_sub(weights + synapse_idx, a_minus_units*post_trace[target_offset + neighbors[i]] + 0.5)
+        """ << g
+
+    @property
+    def post_trace(self):
+        return self.stdp_target.post_trace.allocation
+
+class STDPTarget(Node):
+    """The postsynaptic side of an :class:`STDPSender`, added by it to its
+    target model. Keeps the postsynaptic trace and potentiates the connections
+    to each element when it spikes, using an index of the incoming
+    connections of each element built on the host."""
+    @py.autoinit
+    def __init__(self, parent, sender, basename="STDPTarget"): pass
+
+    vectorizable = True # potentiates one spiking element at a time
+
+    sender = None
+    """The :class:`STDPSender` this is the target of."""
+
+    @property
+    def post_decay(self):
+        return math.exp(-self.sim.DT/self.sender.tau_minus)
+
+    @property
+    def a_plus_units(self):
+        return self.sender.a_plus*self.sender.weight_scale
+
+    @property
+    def w_max_units(self):
+        return self.sender.w_max_units
+
+    @property
+    def n_weight_slots(self):
+        return self.sender.n_weight_slots
+
+    @property
+    def pre_count(self):
+        return self.sender.model.count
+
+    @property
+    def pre_trace(self):
+        return self.sender.pre_trace.allocation
+
+    @property
+    def weights(self):
+        return self.sender.weights
+
+    @py.lazy(property)
+    def post_trace(self):
+        """The postsynaptic trace of the target elements."""
+        decay = "post_trace*post_decay"
+        state = State(self, "post_trace", spike_updater=decay + " + 1.0",
+                      no_spike_updater=decay)
+        InitializeFromHost(state, Fill(0.0))
+        return state
+
+    @py.lazy(property)
+    def incoming(self):
+        """A :class:`ConstantArray <cl_egans.ConstantArray>` indexing, for each
+        target element, its incoming connections: an offset per element, then
+        for each element its number of connections followed by a (source,
+        weight slot) pair for each."""
+        sender = self.sender
+        neighbor_array = sender.neighbor_array
+        lists = [[ ] for _ in xrange(self.model.count)]
+        for src, neighbors in enumerate(unpack_neighbor_data(neighbor_array,
+                                                             self.pre_count)):
+            slot = neighbor_array[src] + 1
+            for i, target in enumerate(neighbors):
+                lists[target].append((src, slot + i))
+
+        count = len(lists)
+        packed = numpy.empty(2*count + 2*sum(len(l) for l in lists),
+                             numpy.int32)
+        offset = count
+        for target, connections in enumerate(lists):
+            packed[target] = offset
+            packed[offset] = len(connections)
+            packed[offset + 1:offset + 1 + 2*len(connections)] = \
+                numpy.array(connections, numpy.int32).reshape(-1)
+            offset += 1 + 2*len(connections)
+        return ConstantArray(self, "incoming", packed[0:offset])
+
+    def pre_finalize(self):
+        self.post_trace
+        self.incoming
+
+    def post_spike_generated(self, g):
+        """
+        incoming_offset = incoming[idx_model]
+        n_incoming = incoming[incoming_offset]
+        for j in (0, n_incoming, 1):
+            pre_idx = incoming[incoming_offset + 1 + 2*j]
+            synapse_idx = (realization_num - realization_start)*n_weight_slots + incoming[incoming_offset + 2 + 2*j]
+            if weights[synapse_idx] < w_max_units:
+                atom_add(weights + synapse_idx, a_plus_units*pre_trace[(realization_num - realization_start)*pre_count + pre_idx] + 0.5)
+        """ << g
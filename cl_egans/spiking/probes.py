@@ -3,8 +3,8 @@
 import numpy
 import cypy as py
 import clq.backends.opencl as clqcl
-import clq.stdlib as clqstd
-from cl_egans import ConstrainedProbe, PerElementProbe, Allocation
+from cl_egans import ConstrainedProbe, PerElementProbe, Allocation, \
+    TerminationCondition, clqstd
 
 class SpikeRasterProbe(PerElementProbe):
     """A :class:`PerElementProbe <ahh.cl.egans.PerElementProbe>` which records
@@ -33,11 +33,14 @@ class SpikeListProbe(PerElementProbe):
     records the list of neurons which spiked at each timestep. 
     
     The count can be accessed via the ``counts`` attribute in the processor you 
-    add (e.g. :class:`ProcessOnHost <ahh.cl.egans.ProcessOnHost>`.
+    add (e.g. :class:`ProcessOnHost <ahh.cl.egans.ProcessOnHost>`. Each list is
+    sorted, so it does not depend on the order spikes were recorded in.
     """
     @py.autoinit
     def __init__(self, parent, basename="SpikeListProbe",
                  cl_dtype=clqcl.uint): pass
+    
+    vectorizable = True # records one spiking element at a time
 
     def on_finalize(self):
         super(SpikeListProbe, self).on_finalize()
@@ -65,7 +68,7 @@ class SpikeListProbe(PerElementProbe):
         for t, timeslice in enumerate(data):
             for r, realization in enumerate(timeslice):
                 count = counts[t, r]
-                new_data[t, r] = realization[0:count]
+                new_data[t, r] = numpy.sort(realization[0:count])
         
         mode.counts = counts        
         mode.data = new_data
@@ -77,6 +80,8 @@ class SpikeScatterProbe(ConstrainedProbe):
     @py.autoinit
     def __init__(self, parent, basename="SpikeScatterProbe"): pass
     
+    vectorizable = True # records one spiking element at a time
+    
     max_spikes = None
     """The maximum number of spikes. Defaults to one per timestep possible
     (almost certainly an overestimate.)"""
@@ -111,13 +116,15 @@ class SpikeScatterProbe(ConstrainedProbe):
     time_expr_cl_dtype = clqcl.uint  # should be inferrable but not yet
     
     def get_data(self):
-        """Return the spike_times and spike_indices."""
+        """Return the spike_times and spike_indices, sorted by time and then 
+        index, so they do not depend on the order spikes were recorded in."""
         get = self.sim.ctx.from_device
         count = get(self.count_allocation.buffer)[0]
         # With OpenCL 1.1 or CUDA we can get copy the first `count` elements
         spike_times = get(self.spike_times_allocation.buffer)[:count]
         spike_indices = get(self.spike_indices_allocation.buffer)[:count]
-        return spike_times, spike_indices
+        order = numpy.lexsort((spike_indices, spike_times))
+        return spike_times[order], spike_indices[order]
     
     def plot(self, **kwargs):
         """Produce a raster plot. See :func:`ahh.np.plotting.raster`."""
@@ -188,4 +195,154 @@ class BinnedSpikeCountProbe(PerElementProbe):
         self.unconstrain(g)
             
     timestep_expr = "bin"
-    
\ No newline at end of file
+    
+            
+class SpikeCountProbe(ConstrainedProbe):
+    """Counts the spikes produced by each element in device memory.
+    
+    Only the final counts are copied to the host, after each division, into 
+    the ``counts`` array of shape ``(n_realizations, n_elms)``. ``rates`` 
+    converts them to firing rates in Hz, over the timesteps each realization
+    actually ran for.
+    """
+    
+    @py.autoinit
+    def __init__(self, parent, basename="SpikeCountProbe"): pass
+    
+    vectorizable = True # counts one spiking element at a time
+    
+    def on_finalize(self):
+        super(SpikeCountProbe, self).on_finalize()
+        self.count_allocation = Allocation(self, "count", 
+            (self.n_realizations * self.n_elms,), clqcl.uint)
+        
+    def on_allocate(self):
+        self.counts = numpy.zeros((self.sim.n_realizations, self.n_elms), 
+                                  numpy.uint32)
+        self.timesteps_counted = numpy.zeros(self.sim.n_realizations, 
+                                             numpy.int32)
+        
+    def on_save_checkpoint(self, info):
+        info.add_array(self.name + "_counts", self.counts)
+        info.add_array(self.name + "_timesteps_counted", 
+                       self.timesteps_counted)
+        
+    def on_restore_checkpoint(self, info):
+        self.counts[...] = info[self.name + "_counts"]
+        self.timesteps_counted[...] = info[self.name + "_timesteps_counted"]
+        
+    def on_initialize_memory(self, timestep_info): #@UnusedVariable
+        clqstd.ew_set_0(self.count_allocation.buffer)
+        
+    def pre_spike_generated(self, g):
+        self.constrain(g)
+        """
+        count_idx = (realization_num - realization_start)*n_elms + idx_expr
+        count_allocation[count_idx] = count_allocation[count_idx] + 1
+        """ << g
+        self.unconstrain(g)
+        
+    idx_expr = "(idx - idx_start)/idx_step"
+    
+    def on_division_complete(self, timestep_info):
+        counts = self.sim.ctx.from_device(self.count_allocation.buffer)
+        n = timestep_info.n_realizations
+        start = timestep_info.realization_start
+        self.counts[start:start + n] = counts.reshape(
+            (self.n_realizations, self.n_elms))[0:n]
+        self.timesteps_counted[start:start + n] = max(
+            self.t_stop_reached(timestep_info) - self.t_start, 0)
+        
+    timesteps_counted = None
+    """After allocation, the number of timesteps spikes were counted over in
+    each realization, which is less than ``t_stop - t_start`` for divisions
+    stopped early."""
+        
+    @property
+    def rates(self):
+        """The firing rates in Hz, assuming DT is in ms. Zero for realizations
+        stopped before ``t_start``."""
+        duration_ms = self.timesteps_counted * self.sim.DT
+        duration_ms = numpy.where(duration_ms > 0, duration_ms, numpy.inf)
+        return self.counts / duration_ms[:, numpy.newaxis] * 1000.0
+
+class PopulationRateTermination(TerminationCondition):
+    """A :class:`TerminationCondition <cl_egans.TerminationCondition>` which 
+    triggers once the population firing rate of the model it is added to has 
+    been below ``min_rate`` or above ``max_rate`` (in Hz, assuming DT is in ms)
+    for ``n_consecutive`` timesteps.
+    
+    Spikes are counted per realization in device memory. Each timestep, the 
+    first work items evaluate the previous timestep's count, one realization 
+    each.
+    """
+    
+    @py.autoinit
+    def __init__(self, parent, basename="PopulationRateTermination",
+                 min_rate=None,
+                 max_rate=None,
+                 n_consecutive=1,
+                 reason=None): pass
+    
+    vectorizable = True # counts one spiking element at a time
+    
+    min_rate = None
+    """The rate below which the population is considered silent, or None."""
+    
+    max_rate = None
+    """The rate above which the population is considered runaway, or None."""
+    
+    n_consecutive = None
+    """The number of consecutive out-of-bounds timesteps needed to trigger."""
+    
+    def on_finalize(self):
+        super(PopulationRateTermination, self).on_finalize()
+        assert self.min_rate is not None or self.max_rate is not None
+        n_realizations = self.sim.n_realizations_per_division_max
+        self.spike_count = Allocation(self, "spike_count", 
+            (2 * n_realizations,), clqcl.uint)
+        self.streak = Allocation(self, "streak", (n_realizations,), 
+                                 clqcl.int)
+        
+    def on_initialize_memory(self, timestep_info):
+        super(PopulationRateTermination, self).on_initialize_memory(
+            timestep_info)
+        clqstd.ew_set_0(self.spike_count.buffer)
+        clqstd.ew_set_0(self.streak.buffer)
+        
+    @property
+    def rate_scale(self):
+        """Converts a spike count in one timestep to a population rate in 
+        Hz."""
+        return 1000.0 / (self.model.count * self.sim.DT)
+    
+    @property
+    def out_of_bounds(self):
+        """The condition on ``rate`` which counts towards termination."""
+        conditions = [ ]
+        if self.min_rate is not None:
+            conditions.append("rate < min_rate")
+        if self.max_rate is not None:
+            conditions.append("rate > max_rate")
+        return " or ".join(conditions)
+        
+    def pre_spike_generated(self, g):
+        """
+        atom_inc(spike_count + (timestep % 2)*n_realizations_per_division_max + realization_num - realization_start)
+        """ << g
+        
+    def post_main_loop(self, g):
+        # the previous timestep's count is complete since kernel launches are 
+        # globally synchronized, and no work item writes it this timestep
+        """
+        if gid < n_realizations_per_division_max and timestep > n_burn_in_timesteps:
+            prev_count_idx = ((timestep + 1) % 2)*n_realizations_per_division_max + gid
+            rate = spike_count[prev_count_idx] * rate_scale
+            spike_count[prev_count_idx] = 0
+            if out_of_bounds:
+                streak[gid] = streak[gid] + 1
+            else:
+                streak[gid] = 0
+            if streak[gid] >= n_consecutive and flag[gid] == 0:
+                flag[gid] = timestep
+        """ << g